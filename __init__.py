@@ -12,6 +12,8 @@ import apa.config
 import apa.analysis
 import apa.path
 import apa.annotation
+import apa.trim
+import apa.pas
 import apa.extract
 import apa.map
 import apa.bed
@@ -2,11 +2,13 @@ import apa
 import os
 import pybio
 import glob
-import struct
 import fcntl
 import random
 import errno
 import time
+import numpy as np
+
+read_tables = {} # (lib_id, sidecar) -> ReadTable
 
 def init():
     apa.annotation.libs = {}
@@ -19,24 +21,72 @@ def init():
         if os.path.exists(annotation_tab):
             apa.annotation.libs[lib_id] = apa.annotation.Library(lib_id)
 
-def aremoved(lib_id, read_id):
-    filename = os.path.join(apa.path.data_folder, lib_id, "%s.aremoved.bin" % (lib_if))
+class ReadTable:
+    """
+    Memory-mapped per-read sidecar of a library, indexed by read number (written by apa.extract):
+
+    .. code-block:: bash
+
+        ${data_folder}/${lib_id}/${lib_id}.rnd.bin      # uint32 random barcode id per read
+        ${data_folder}/${lib_id}/${lib_id}.aremoved.bin # uint8 number of removed tail nucleotides per read
+
+    The file is mapped once; read numbers beyond the end of the file return 0.
+    """
+
+    def __init__(self, filename, dtype):
+        self.filename = filename
+        self.dtype = dtype
+        if os.path.exists(filename) and os.path.getsize(filename)>=np.dtype(dtype).itemsize:
+            self.data = np.memmap(filename, dtype=dtype, mode="r")
+        else:
+            self.data = np.zeros(0, dtype=dtype)
+
+    def __len__(self):
+        return len(self.data)
+
+    def lookup(self, read_ids):
+        """
+        Vectorized lookup of an array of read numbers.
+        """
+        read_ids = np.asarray(read_ids, dtype=np.int64)
+        result = np.zeros(len(read_ids), dtype=self.dtype)
+        inside = (read_ids>=0) & (read_ids<len(self.data))
+        result[inside] = self.data[read_ids[inside]]
+        return result
+
+    def get(self, read_id):
+        if 0<=read_id<len(self.data):
+            return int(self.data[read_id])
+        return 0
+
+def rnd_table(lib_id):
+    """
+    Returns (cached) :class:`ReadTable` of random barcode ids of library lib_id.
+    """
+    if (lib_id, "rnd") not in apa.annotation.read_tables:
+        filename = os.path.join(apa.path.data_folder, lib_id, "%s.rnd.bin" % (lib_id))
+        apa.annotation.read_tables[(lib_id, "rnd")] = ReadTable(filename, np.uint32)
+    return apa.annotation.read_tables[(lib_id, "rnd")]
+
+def aremoved_table(lib_id):
+    """
+    Returns (cached) :class:`ReadTable` of removed tail lengths of library lib_id, None if the library has no aremoved.bin.
+    """
+    filename = os.path.join(apa.path.data_folder, lib_id, "%s.aremoved.bin" % (lib_id))
     if not os.path.exists(filename):
         return None
-    aremoved_file = open(filename, "rb")
-    aremoved_file.seek(read_id)
-    data = aremoved_file.read(1)
-    if len(data)==0:
-        return 0
-    return struct.unpack("B", data)[0]
+    if (lib_id, "aremoved") not in apa.annotation.read_tables:
+        apa.annotation.read_tables[(lib_id, "aremoved")] = ReadTable(filename, np.uint8)
+    return apa.annotation.read_tables[(lib_id, "aremoved")]
+
+def aremoved(lib_id, read_id):
+    table = aremoved_table(lib_id)
+    if table==None:
+        return None
+    return table.get(read_id)
 
 def rndcode(lib_id, read_id):
-    rndcode_file = open(os.path.join(apa.path.data_folder, lib_id, "%s.rnd.bin" % (lib_id)), "rb")
-    rndcode_file.seek(read_id*4)
-    data = rndcode_file.read(4)
-    if len(data)==0:
-        return 0
-    return struct.unpack("I", data)[0]
+    return rnd_table(lib_id).get(read_id)
 
 class Library:
 
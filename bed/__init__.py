@@ -7,17 +7,183 @@ import glob
 import sys
 import regex
 import gzip
-import glob
+import array
+import multiprocessing
+import hashlib
+import socket
+import json
+import numpy as np
 
 upstream_defaults = {"pAseq":100, "paseq":100, "aseq":100, "lexrev":5, "lexfwd":100, "nano":100, "RNAseq":100}
 downstream_defaults = {"pAseq":25, "paseq":25, "aseq":25, "lexrev":5, "lexfwd":25, "nano":25, "RNAseq":100}
 
+# how each protocol defines the polyA site of an alignment (used by bed_raw)
+# end: "3" = last aligned nucleotide in read orientation, "5" = first aligned nucleotide in read orientation
+# reverse: reads are antisense to the transcript, turn strand
+# ip_raw: internally primed alignments are also omitted from the R track
+site_rules = {
+    "pAseq":  {"end":"3", "reverse":False, "ip_raw":False},
+    "paseq":  {"end":"3", "reverse":False, "ip_raw":False},
+    "aseq":   {"end":"3", "reverse":False, "ip_raw":False},
+    "lexrev": {"end":"5", "reverse":True, "ip_raw":False},
+    "lexfwd": {"end":"3", "reverse":False, "ip_raw":True},
+    "nano":   {"end":"3", "reverse":False, "ip_raw":True},
+}
+
+def manifest_filename(filename):
+    """
+    Manifest of output filename (see :class:`Manifest`): ${filename}.manifest
+    """
+    return filename + ".manifest"
+
+class Lock:
+    """
+    Exclusive lock file, created with O_CREAT|O_EXCL and holding "hostname pid" of the owner. A lock left by a
+    process that is not alive anymore (same host) or by an earlier (failed) call of this process is taken over; locks
+    of other hosts are always respected.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def acquire(self):
+        """
+        Take the lock; returns False if another live process holds it.
+        """
+        for _ in range(2):
+            try:
+                fd = os.open(self.filename, os.O_CREAT|os.O_EXCL|os.O_WRONLY)
+            except FileExistsError:
+                if self.alive():
+                    return False
+                try:
+                    os.remove(self.filename) # stale lock
+                except FileNotFoundError:
+                    pass
+                continue
+            os.write(fd, ("%s %s" % (socket.gethostname(), os.getpid())).encode())
+            os.close(fd)
+            return True
+        return False
+
+    def holder(self):
+        """
+        (hostname, pid) of the lock owner, None if there is no lock or it is not written yet.
+        """
+        try:
+            owner = open(self.filename, "rt").read().split(" ")
+        except FileNotFoundError:
+            return None
+        if len(owner)!=2 or not owner[1].isdigit():
+            return None
+        return owner[0], int(owner[1])
+
+    def alive(self):
+        """
+        True if the lock file exists and its owner (another process) could still be running.
+        """
+        if not os.path.exists(self.filename):
+            return False
+        holder = self.holder()
+        if holder==None or holder[0]!=socket.gethostname():
+            return True
+        if holder[1]==os.getpid():
+            return False
+        try:
+            os.kill(holder[1], 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def release(self):
+        if self.holder()==(socket.gethostname(), os.getpid()):
+            os.remove(self.filename)
+
+class Manifest:
+    """
+    Inputs (size, mtime and for small inputs sha1) and parameters an output was computed from, stored next to each
+    output file as ${output}.manifest (json, :func:`manifest_filename`). The manifests are written only after the
+    outputs are complete, so interrupted runs and runs with changed inputs or parameters are recomputed, everything
+    else is skipped. Up to date checks read the manifest of the first output. Inputs that do not exist are not listed.
+
+    Outputs are written under an exclusive lock (${output}.lock, :class:`Lock`), taken by :func:`Manifest.start` and
+    released by :func:`Manifest.done`, so two jobs never write the same outputs.
+    """
+
+    hash_limit = 16<<20 # only inputs up to this size (config, atlas, ...) are hashed, larger (BAM) by size and mtime
+
+    def __init__(self, outputs, inputs, params):
+        self.outputs = outputs
+        self.inputs = [fname for fname in inputs if fname!=None and os.path.exists(fname)]
+        self.params = params
+        self.filename = manifest_filename(outputs[0])
+        self.lock = Lock(outputs[0] + ".lock")
+
+    def current(self):
+        """
+        True if all outputs exist and were computed from the same inputs (content) and parameters.
+        """
+        if not os.path.exists(self.filename) or not all(os.path.exists(fname) for fname in self.outputs):
+            return False
+        try:
+            data = json.load(open(self.filename, "rt"))
+        except ValueError:
+            return False
+        if data.get("params", None)!=self.params or sorted(data.get("inputs", {}).keys())!=sorted(self.inputs):
+            return False
+        for fname in self.inputs:
+            stored = data["inputs"][fname]
+            stat = os.stat(fname)
+            if stored["size"]!=stat.st_size:
+                return False
+            if stored["mtime"]!=stat.st_mtime_ns and (stored.get("sha1", None)==None or stored["sha1"]!=file_sha1(fname)): # touched small files are hashed
+                return False
+        return True
+
+    def start(self):
+        """
+        Take the lock and remove the manifests before outputs are (re)written. Returns False if another job is writing
+        the outputs.
+        """
+        if not self.lock.acquire():
+            return False
+        for fname in self.outputs:
+            if os.path.exists(manifest_filename(fname)):
+                os.remove(manifest_filename(fname))
+        return True
+
+    def done(self):
+        """
+        Store manifest of finished outputs and release the lock.
+        """
+        inputs = {}
+        for fname in self.inputs:
+            stat = os.stat(fname)
+            inputs[fname] = {"size":stat.st_size, "mtime":stat.st_mtime_ns}
+            if stat.st_size<=self.hash_limit:
+                inputs[fname]["sha1"] = file_sha1(fname)
+        for fname in self.outputs[::-1]: # first output last, it marks the outputs up to date
+            f = open(manifest_filename(fname)+".temp", "wt")
+            json.dump({"inputs":inputs, "params":self.params, "outputs":self.outputs}, f, indent=1, sort_keys=True)
+            f.close()
+            os.rename(manifest_filename(fname)+".temp", manifest_filename(fname))
+        self.lock.release()
+
+def file_sha1(filename, block_size=1<<20):
+    h = hashlib.sha1()
+    f = open(filename, "rb")
+    block = f.read(block_size)
+    while block:
+        h.update(block)
+        block = f.read(block_size)
+    f.close()
+    return h.hexdigest()
+
 # http://www.cgat.org/~andreas/documentation/pysam/api.html
 # Coordinates in pysam are always 0-based (following the python convention). SAM text files use 1-based coordinates.
 
-# Gruber et al.
-PAS_hexamers = ['AATAAA', 'ATTAAA', 'TATAAA', 'AGTAAA', 'AATACA', 'CATAAA', 'AATATA', 'GATAAA', 'AATGAA', 'AAGAAA', 'ACTAAA', 'AATAGA', 'AATAAT', 'AACAAA', 'ATTACA', 'ATTATA', 'AACAAG', 'AATAAG']
-
 """
 25201104=D. Zheng and B. Tian, Systems Biology of RNA binding proteins. 2014
 "This problem, commonly known as the "internal priming issue" can be partially
@@ -34,49 +200,140 @@ def ip(s):
             return True
     return False
 
-def match_pas(seq):
-    for hexamer in PAS_hexamers:
-        if seq.find(hexamer)!=-1:
-            return True
-    return False
-
 def ip_check(genome, chr, strand, pos):
     internal_priming = False
     check_seq = pybio.genomes.seq(genome, chr, strand, pos, start=-30, stop=10)
     if ip(check_seq[20:]): # check -10..10 region
         internal_priming = True
-        if match_pas(check_seq[:-10]): # check -30..0 region
+        if apa.pas.match_pas(check_seq[:-10]): # check -30..0 region
             internal_priming = False
     return internal_priming
 
-def save(data, key, pos_end, read_id):
-    level_1 = data.get(key, {})
-    level_2 = level_1.get(pos_end, set())
-    level_2.add(read_id)
-    level_1[pos_end] = level_2
-    data[key] = level_1
+def ip_window_any(values, lo, hi, n):
+    """
+    For positions p=0..n-1 return True if any values[i] is True for i in [p+lo, p+hi].
+    """
+    cs = np.concatenate(([0], np.cumsum(values, dtype=np.int64)))
+    p = np.arange(n)
+    left = np.clip(p+lo, 0, len(values))
+    right = np.clip(p+hi+1, 0, len(values))
+    return (cs[right] - cs[left]) > 0
 
-def write_bed(d, filename):
+def ip_verdicts(seq):
     """
-    Save bedGraph file from dictionary d (chr->strand->position->value) to filename.
+    Vectorized :func:`ip_check` for every position of seq (+ strand sequence); returns (plus, minus) boolean arrays.
+    Same rules as ip_check: -10..10 region has 7 continuous As or a 10 nt window with >=8 As, and no PAS hexamer in -30..0.
+    Positions closer than 30 nt to the ends of seq are not reliable (the caller adds padding).
     """
-    f = gzip.open(filename, "wt")
-    for chr_strand, pos_data in d.items():
-        chr, strand = chr_strand.split(":")
-        positions = [(pos, len(rnd_set)) for pos, rnd_set in pos_data.items()]
-        positions.sort()
-        for pos, cDNA in positions:
-            if strand=="+":
-                f.write("%s\t%s\t%s\t%s\n" % (chr, pos, pos+1, cDNA))
-            else:
-                f.write("%s\t%s\t%s\t-%s\n" % (chr, pos, pos+1, cDNA))
-    f.close()
+    n = len(seq)
+    seq = seq.upper()
+    b = np.frombuffer(seq.encode(), dtype=np.uint8)
+    hexamer, valid = apa.pas.hexamer_codes(seq)
+    result = []
+    for strand in ["+", "-"]:
+        if strand=="+":
+            nt_A = b==ord("A")
+            pas_lo, pas_hi = -30, -5 # hexamer start, -30..0 region upstream of the site
+        else:
+            nt_A = b==ord("T") # A on the minus strand
+            pas_lo, pas_hi = 0, 25 # upstream of the site is downstream on the + strand
+        cs = np.concatenate(([0], np.cumsum(nt_A, dtype=np.int64)))
+        run7 = (cs[7:] - cs[:-7])==7
+        win10 = (cs[10:] - cs[:-10])>=8
+        ip_region = ip_window_any(run7, -10, 4, n) | ip_window_any(win10, -10, 1, n)
+        pas = (apa.pas.pas_tables[strand][hexamer]>=0) & valid # PAS hexamer (any) starts here
+        result.append(ip_region & ~ip_window_any(pas, pas_lo, pas_hi, n))
+    return result[0], result[1]
+
+def ip_mask_build(genome, chromosomes, chunk_size=10000000, force=False):
+    """
+    One-off build of the internal priming mask for genome. chromosomes is a list of (chr, length), e.g. zip(bam_file.references, bam_file.lengths).
 
-# make gene expression table (htcount and gtf)
+    For every chromosome and strand a bitmap (1 bit per position, :func:`ip_check` verdict) is stored to :func:`apa.path.ip_mask_filename`.
+    The verdict only depends on genome sequence, so the mask is shared by all libraries mapped to the genome.
+    """
+    pad = 30
+    chunk_size = chunk_size - chunk_size%8 # chunks need to pack to whole bytes
+    for chr, length in chromosomes:
+        fname_plus = apa.path.ip_mask_filename(genome, chr, "+")
+        fname_minus = apa.path.ip_mask_filename(genome, chr, "-")
+        if os.path.exists(fname_plus) and os.path.exists(fname_minus) and not force:
+            continue
+        if not os.path.exists(os.path.dirname(fname_plus)):
+            os.makedirs(os.path.dirname(fname_plus))
+        print("%s : IP mask : %s (%.1fM)" % (genome, chr, length/1e6))
+        f_plus = open(fname_plus+".temp", "wb")
+        f_minus = open(fname_minus+".temp", "wb")
+        for start in range(0, length, chunk_size):
+            stop = min(start+chunk_size, length)
+            seq_start = max(0, start-pad)
+            seq = pybio.genomes.seq(genome, chr, "+", seq_start, start=0, stop=min(stop+pad, length)-seq_start-1)
+            seq = "N"*(pad-(start-seq_start)) + seq # N padding at chromosome start and end
+            seq = seq + "N"*(stop-start+2*pad-len(seq))
+            plus, minus = ip_verdicts(seq)
+            np.packbits(plus[pad:pad+stop-start]).tofile(f_plus)
+            np.packbits(minus[pad:pad+stop-start]).tofile(f_minus)
+        f_plus.close()
+        f_minus.close()
+        os.rename(fname_plus+".temp", fname_plus)
+        os.rename(fname_minus+".temp", fname_minus)
+
+class IPMask:
+    """
+    Memory-mapped internal priming bitmaps of a genome (see :func:`ip_mask_build`).
+    Chromosomes without a bitmap are checked with :func:`ip_check`, verdicts are cached per site.
+    """
+
+    def __init__(self, genome):
+        self.genome = genome
+        self.bitmaps = {}
+        self.cache = {}
+
+    def bitmap(self, chr, strand):
+        """
+        Returns memory-mapped bitmap of chr and strand, None if it was not built.
+        """
+        if (chr, strand) not in self.bitmaps:
+            fname = apa.path.ip_mask_filename(self.genome, chr, strand)
+            if os.path.exists(fname) and os.path.getsize(fname)>0:
+                self.bitmaps[(chr, strand)] = np.memmap(fname, dtype=np.uint8, mode="r")
+            else:
+                self.bitmaps[(chr, strand)] = None
+        return self.bitmaps[(chr, strand)]
+
+    def lookup(self, chr, strand, positions):
+        """
+        Internal priming verdicts (boolean array) for an array of positions on chr and strand.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        bitmap = self.bitmap(chr, strand)
+        if bitmap is not None:
+            return ((bitmap[positions >> 3] >> (7 - (positions & 7))) & 1).astype(bool)
+        sites, inverse = np.unique(positions, return_inverse=True)
+        verdicts = []
+        for pos in sites.tolist():
+            if (chr, strand, pos) not in self.cache:
+                self.cache[(chr, strand, pos)] = ip_check(self.genome, chr, strand, pos)
+            verdicts.append(self.cache[(chr, strand, pos)])
+        return np.array(verdicts, dtype=bool)[inverse]
+
+# make gene expression table (counts reads per gene from the GTF annotation, htseq-count union mode)
 def gene_expression(lib_id, map_id=1):
+    """
+    Count reads per gene for all experiments of lib_id and store raw counts and TMM normalized cpm:
+
+    .. code-block:: bash
+
+        ${data_folder}/${lib_id}/${lib_id}_gene_expression.tab
+        ${data_folder}/${lib_id}/${lib_id}_gene_expression_cpm.tab
+
+    The gene index is built once from the genome GTF (:class:`GeneIndex`), BAM files are counted in parallel
+    (apa.config.cores workers). Reads are counted like htseq-count (union mode, unique alignments with MAPQ>=10);
+    lexrev reads are counted on the reverse strand.
+    """
     library = apa.annotation.libs[lib_id]
-    script_fname = os.path.join(apa.path.data_folder, lib_id, "%s_gene_expression.sh" % lib_id)
     table_fname = os.path.join(apa.path.data_folder, lib_id, "%s_gene_expression.tab" % lib_id)
+    cpm_fname = os.path.join(apa.path.data_folder, lib_id, "%s_gene_expression_cpm.tab" % lib_id)
     gtf_files = glob.glob(os.path.join(apa.path.pybio_folder, "genomes", "%s.annotation.*/*.gtf.gz" % library.genome))
     if len(gtf_files)==0:
         gtf_files = glob.glob(os.path.join(apa.path.pybio_folder, "genomes", "%s.annotation.*/*.gff.gz" % library.genome))
@@ -85,53 +342,188 @@ def gene_expression(lib_id, map_id=1):
     if len(gtf_files)==0:
         gtf_files = glob.glob(os.path.join(apa.path.pybio_folder, "genomes", "%s.annotation.*/*.gtf" % library.genome))
     gtf_fname = gtf_files[0]
-    map_to = set()
-    f = open(script_fname, "wt")
-    f.write("bam_files=\"\n")
-    header = ["gene_id", "gene_name"]
-    for exp_id, exp_data in library.experiments.items():
-        map_to.add(exp_data["map_to"])
-        bam_filename = os.path.join(apa.path.data_folder, lib_id, "e%s" % exp_id, "m%s" % map_id, "%s_e%s_m%s.bam" % (lib_id, exp_id, map_id))
-        f.write(bam_filename+"\n")
-        header.append("e%s" % exp_id)
-    map_to = list(map_to)[0]
-    pybio.genomes.load(map_to)
-    f.write("\"\n")
-    additional_parameters = ""
-    if library.method=="lexrev":
-        additional_parameters = "-s reverse" # -s reverse: important, since lexrev maps in the opposite direction relative to the orientation of the gene
-    f.write("htseq-count %s -f bam ${bam_files} %s > %s" % (additional_parameters, gtf_fname, table_fname))
+    print("%s : gene expression : reading %s" % (lib_id, gtf_fname))
+    index = GeneIndex(gtf_fname)
+
+    reverse = library.method=="lexrev" # important, since lexrev maps in the opposite direction relative to the orientation of the gene
+    exp_ids = list(library.experiments.keys())
+    tasks = [(apa.path.bam_filename(lib_id, exp_id, map_id=map_id), index, reverse) for exp_id in exp_ids]
+    pool = multiprocessing.Pool(processes=max(1, min(apa.config.cores, len(tasks))))
+    counts = pool.map(gene_counts_bam, tasks)
+    pool.close()
+    pool.join()
+
+    header = ["gene_id", "gene_name"] + ["e%s" % exp_id for exp_id in exp_ids]
+    gene_ids = sorted(index.gene_names.keys())
+    raw = np.array([[c.get(gene_id, 0) for c in counts] for gene_id in gene_ids], dtype=np.int64).reshape(len(gene_ids), len(exp_ids))
+    f = open(table_fname, "wt")
+    f.write("\t".join(header)+"\n")
+    for gene_id, row in zip(gene_ids, raw.tolist()):
+        f.write("\t".join([gene_id, index.gene_names[gene_id]] + [str(x) for x in row])+"\n")
     f.close()
-    os.system("chmod +x %s" % script_fname)
-    os.system(script_fname)
-    f1 = open(table_fname)
-    f2 = open(table_fname+".temp", "wt")
-    f2.write("\t".join(header)+"\n")
-    r = f1.readline()
-    while r:
-        r = r.replace("\r", "").replace("\n", "").split("\t")
-        gene_id = r[0]
-        gene = apa.polya.get_gene(map_to, gene_id) # annotate gene names
-        if gene!={}:
-            gene_name = gene.get("gene_name", "")
+
+    # normalize to cpm (edgeR TMM normalization factors, as in comps/gene_expression_raw_cpm.R)
+    lib_size = raw.sum(axis=0).astype(np.float64)
+    cpm = np.round(raw / (lib_size * tmm_factors(raw) / 1e6), 1)
+    f = open(cpm_fname, "wt")
+    f.write("\t".join(header)+"\n")
+    for gene_id, row in zip(gene_ids, cpm.tolist()):
+        f.write("\t".join([gene_id, index.gene_names[gene_id]] + [("%.1f" % x).rstrip("0").rstrip(".") for x in row])+"\n")
+    f.close()
+
+class GeneIndex:
+    """
+    Exons of genes (GTF) as disjoint steps per (chr, strand), each step stores the set of genes covering it.
+    """
+
+    def __init__(self, gtf_fname):
+        self.gene_names = {}
+        self.bounds = {}
+        self.steps = {}
+        exons = {}
+        f = gzip.open(gtf_fname, "rt") if gtf_fname.endswith(".gz") else open(gtf_fname, "rt")
+        for r in f:
+            if r.startswith("#"):
+                continue
+            r = r.rstrip("\r\n").split("\t")
+            if len(r)<9 or r[2]!="exon":
+                continue
+            attributes = gtf_attributes(r[8])
+            gene_id = attributes.get("gene_id", None)
+            if gene_id==None:
+                continue
+            if gene_id not in self.gene_names:
+                self.gene_names[gene_id] = attributes.get("gene_name", "")
+            exons.setdefault((r[0], r[6]), []).append((int(r[3])-1, int(r[4]), gene_id)) # GTF is 1-based, inclusive
+        f.close()
+        for key, intervals in exons.items():
+            events = {}
+            for start, stop, gene_id in intervals:
+                events.setdefault(start, []).append((gene_id, 1))
+                events.setdefault(stop, []).append((gene_id, -1))
+            bounds = sorted(events.keys())
+            active = {}
+            steps = []
+            interned = {}
+            for pos in bounds:
+                for gene_id, change in events[pos]:
+                    active[gene_id] = active.get(gene_id, 0) + change
+                    if active[gene_id]==0:
+                        del active[gene_id]
+                genes = frozenset(active.keys())
+                steps.append(interned.setdefault(genes, genes))
+            self.bounds[key] = np.array(bounds, dtype=np.int64)
+            self.steps[key] = steps
+
+    def genes(self, chr, strand, blocks):
+        """
+        Set of genes with exons overlapping any of the blocks [(start, stop), ...] on chr and strand.
+        """
+        result = set()
+        bounds = self.bounds.get((chr, strand), None)
+        if bounds is None:
+            return result
+        steps = self.steps[(chr, strand)]
+        for start, stop in blocks:
+            i = max(0, int(np.searchsorted(bounds, start, side="right"))-1)
+            j = int(np.searchsorted(bounds, stop, side="left"))
+            for k in range(i, j):
+                result.update(steps[k])
+        return result
+
+def gtf_attributes(text):
+    """
+    Parse GTF (key "value";) or GFF (key=value;) attribute column.
+    """
+    attributes = {}
+    for el in text.strip().split(";"):
+        el = el.strip()
+        if el=="":
+            continue
+        if "=" in el and " " not in el.split("=")[0]:
+            key, value = el.split("=", 1)
         else:
-            gene_name = ""
-        r2 = [r[0]] + [gene_name] + r[1:]
-        f2.write("\t".join(str(x) for x in r2)+"\n")
-        r = f1.readline()
-    f1.close()
-    f2.close()
-    os.system("mv %s.temp %s" % (table_fname, table_fname))
-    # remove last 5 lines of the generated file (no feature, ambiguous, )
-    os.system("head -n -5 %s > %s.temp" % (table_fname, table_fname))
-    os.system("mv %s.temp %s" % (table_fname, table_fname))
-
-    # normalize to cpm
-    R_file = os.path.join(apa.path.root_folder, "comps", "gene_expression_raw_cpm.R")
-    input_fname = os.path.join(apa.path.data_folder, lib_id, "%s_gene_expression.tab" % lib_id)
-    output_fname = os.path.join(apa.path.data_folder, lib_id, "%s_gene_expression_cpm.tab" % lib_id)
-    command = "R --vanilla --args %s %s < %s" % (input_fname, output_fname, R_file)
-    pybio.utils.Cmd(command).run()
+            key, _, value = el.partition(" ")
+        attributes[key] = value.strip().strip("\"")
+    return attributes
+
+def gene_counts_bam(pars):
+    """
+    Count reads per gene in BAM file. Only the first mate of paired reads is counted.
+    """
+    bam_filename, index, reverse = pars
+    counts = {}
+    if not os.path.exists(bam_filename):
+        return counts
+    bam_file = pysam.AlignmentFile(bam_filename)
+    references = bam_file.references
+    for a in bam_file.fetch(until_eof=True):
+        if a.is_unmapped or a.is_secondary or a.is_supplementary or a.is_read2:
+            continue
+        if a.mapping_quality<10 or (a.has_tag("NH") and a.get_tag("NH")>1):
+            continue
+        strand = "-" if a.is_reverse else "+"
+        if reverse:
+            strand = {"+":"-", "-":"+"}[strand]
+        genes = index.genes(references[a.reference_id], strand, a.get_blocks())
+        if len(genes)==1:
+            gene_id = next(iter(genes))
+            counts[gene_id] = counts.get(gene_id, 0) + 1
+    bam_file.close()
+    return counts
+
+def tmm_factors(counts, logratio_trim=0.3, sum_trim=0.05):
+    """
+    edgeR calcNormFactors(method="TMM") for a genes x samples count matrix.
+    """
+    counts = counts[counts.sum(axis=1)>0].astype(np.float64)
+    lib_size = counts.sum(axis=0)
+    samples = counts.shape[1]
+    if samples==0 or len(counts)==0:
+        return np.ones(samples)
+    f75 = np.quantile(counts/lib_size, 0.75, axis=0)
+    if np.median(f75)<1e-20:
+        ref = int(np.argmax(np.sqrt(counts).sum(axis=0)))
+    else:
+        ref = int(np.argmin(np.abs(f75-f75.mean())))
+    factors = np.ones(samples)
+    for i in range(samples):
+        obs, nO = counts[:, i], lib_size[i]
+        ref_counts, nR = counts[:, ref], lib_size[ref]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            log_r = np.log2((obs/nO)/(ref_counts/nR))
+            abs_e = (np.log2(obs/nO) + np.log2(ref_counts/nR))/2
+            v = (nO-obs)/nO/obs + (nR-ref_counts)/nR/ref_counts
+        fin = np.isfinite(log_r) & np.isfinite(abs_e)
+        log_r, abs_e, v = log_r[fin], abs_e[fin], v[fin]
+        if len(log_r)==0 or np.max(np.abs(log_r))<1e-6:
+            continue
+        n = len(log_r)
+        lo_l = np.floor(n*logratio_trim) + 1
+        hi_l = n + 1 - lo_l
+        lo_s = np.floor(n*sum_trim) + 1
+        hi_s = n + 1 - lo_s
+        rank_r, rank_e = average_rank(log_r), average_rank(abs_e)
+        keep = (rank_r>=lo_l) & (rank_r<=hi_l) & (rank_e>=lo_s) & (rank_e<=hi_s)
+        f = np.nansum(log_r[keep]/v[keep]) / np.nansum(1/v[keep])
+        factors[i] = 2**(0 if np.isnan(f) else f)
+    return factors / np.exp(np.mean(np.log(factors)))
+
+def average_rank(values):
+    """
+    Ranks (1-based) with ties averaged, as R rank().
+    """
+    order = np.argsort(values, kind="mergesort")
+    sorted_values = values[order]
+    ranks = np.empty(len(values))
+    i = 0
+    while i<len(values):
+        j = i
+        while j+1<len(values) and sorted_values[j+1]==sorted_values[i]:
+            j += 1
+        ranks[order[i:j+1]] = (i+j)/2.0 + 1
+        i = j+1
+    return ranks
 
 def polya_expression(lib_id, poly_id, map_id=1, upstream=None, downstream=None):
     if poly_id==None:
@@ -139,45 +531,36 @@ def polya_expression(lib_id, poly_id, map_id=1, upstream=None, downstream=None):
     lib = apa.annotation.libs[lib_id]
     lib.add_status("polya_expression")
     lib.save()
-    polyadb_filename = apa.path.polyadb_filename(poly_id)
+    atlas = AtlasIndex(poly_id)
     result = {}
     header = ["chr", "strand", "pos", "gene_id", "gene_name"]
     keys = set()
     map_to = set()
     for exp_id, exp_data in lib.experiments.items():
-        if upstream==None:
-            upstream = upstream_defaults[exp_data["method"]]
-        if downstream==None:
-            downstream = downstream_defaults[exp_data["method"]]
+        exp_upstream = upstream_defaults[exp_data["method"]] if upstream==None else upstream
+        exp_downstream = downstream_defaults[exp_data["method"]] if downstream==None else downstream
         header.append("e%s" % exp_id)
         map_to.add(exp_data["map_to"])
         result[exp_id] = {}
         r_filename = apa.path.r_filename(lib_id, exp_id, map_id=map_id)
-        bam_filename = apa.path.bam_filename(lib_id, exp_id, map_id=map_id)
-        e_filename = apa.path.e_filename(lib_id, exp_id, map_id=map_id, poly_id=poly_id)
-        print("{lib_id}_e{exp_id}_m{map_id} : E BED, upstream={upstream}, downstream={downstream}".format(lib_id=lib_id, exp_id=exp_id, map_id=map_id, upstream=upstream, downstream=downstream))
-        e = pybio.data.Bedgraph()
-        e.overlay(polyadb_filename, r_filename, start=-upstream, stop=downstream)
-        for chr, strand, pos, val in e.fetch():
-            key = (chr, strand, pos)
-            keys.add(key)
-            result[exp_id][key] = val
+        print("{lib_id}_e{exp_id}_m{map_id} : E BED, upstream={upstream}, downstream={downstream}".format(lib_id=lib_id, exp_id=exp_id, map_id=map_id, upstream=exp_upstream, downstream=exp_downstream))
+        counts = atlas.overlay(r_filename, exp_upstream, exp_downstream)
+        for (chr, strand), values in counts.items():
+            sites = atlas.sites[(chr, strand)]
+            for pos, val in zip(sites[values>0].tolist(), values[values>0].tolist()):
+                key = (chr, strand, pos)
+                keys.add(key)
+                result[exp_id][key] = int(val)
     map_to = list(map_to)[0]
-    pybio.genomes.load(map_to)
+    annotation = apa.polya.AtlasAnnotation(poly_id, species=map_to)
     table_fname = os.path.join(apa.path.data_folder, lib_id, "%s_polya_expression.tab" % lib_id)
     f = open(table_fname, "wt")
     f.write("\t".join(str(x) for x in header)+"\n")
     keys = list(keys)
-    keys = sorted(keys, key=lambda tup: (int(tup[0]) if tup[0].isdigit() else tup[0],tup[1], tup[2]))
+    keys = sorted(keys, key=lambda tup: (chr_order(tup[0]), tup[1], tup[2]))
     for chr, strand, pos in keys:
-        _, gid, _, _, _ = pybio.genomes.annotate(map_to, chr, strand, pos, extension=5000)
-        gene_id = ""
-        gene_name = ""
-        if gid!=None:
-            gene = apa.polya.get_gene(map_to, gid)
-            gene_id = gid
-            gene_name = gene["gene_name"]
-        row = [chr, strand, pos, gene_id, gene_name]
+        gene_id, gene_name, _ = annotation.get(chr, strand, pos, extension=5000)
+        row = [chr, strand, pos, "" if gene_id==None else gene_id, gene_name]
         for exp_id, _ in lib.experiments.items():
             row.append(result[exp_id].get((chr, strand, pos), 0))
         f.write("\t".join(str(x) for x in row)+"\n")
@@ -185,10 +568,15 @@ def polya_expression(lib_id, poly_id, map_id=1, upstream=None, downstream=None):
     lib.remove_status("polya_expression")
     lib.save()
 
-def bed_raw(lib_id, exp_id, map_id=1, force=False, ip_filter=True):
+def bed_raw(lib_id, exp_id, map_id=1, force=False, ip_filter=True, parallel=False, tile_size=None, approximate=False, dedup=False):
     """
-    :param force: overwrite existing bedGraph files if True
+    :param force: recompute bedGraph files even if they are up to date (see :class:`Manifest`)
     :param map_id: which mapping to take; default 1
+    :param ip_filter: remove internally primed alignments from the T (and for lexfwd/nano also R) track
+    :param parallel: split the BAM file into shards (using the BAM index) and process them with apa.config.cores workers
+    :param tile_size: shard size in nt when parallel; default None = one shard per reference
+    :param approximate: count distinct read ids per site with HyperLogLog registers instead of exact (see :class:`SiteCounter`)
+    :param dedup: count distinct random barcodes (${lib_id}.rnd.bin) per site instead of reads
     Generates raw bedGraph files for lib_id and exp_id.
 
     The bedGraph files are stored in:
@@ -198,342 +586,426 @@ def bed_raw(lib_id, exp_id, map_id=1, force=False, ip_filter=True):
         ${data_folder}/${lib_id}/e${exp_id}/m${map_id}/${lib_id}_e${exp_id}_m${map_id}.R.bed # R=raw, unfiltered bedGraph files
         ${data_folder}/${lib_id}/e${exp_id}/m${map_id}/${lib_id}_e${exp_id}_m${map_id}.T.bed # T=tail, filtered bedGraph files
 
+    All protocols are processed by the same engine (:func:`bed_raw_sites`), the protocol specific part (which end of
+    the alignment is the polyA site and on which strand) is defined in :data:`site_rules`.
     """
     lib = apa.annotation.libs[lib_id]
     exp_data = lib.experiments[exp_id]
-    if exp_data["method"] in ["pAseq", "paseq"]:
-        apa.bed.bed_raw_paseq(lib_id, exp_id, map_id=map_id, force=force, ip_filter=ip_filter)
-    if exp_data["method"] in ["aseq"]:
-        apa.bed.bed_raw_aseq(lib_id, exp_id, map_id=map_id, force=force, ip_filter=ip_filter)
-    if exp_data["method"]=="lexrev":
-        apa.bed.bed_raw_lexrev(lib_id, exp_id, map_id=map_id, force=force, ip_filter=ip_filter)
-    if exp_data["method"]=="lexfwd":
-        apa.bed.bed_raw_lexfwd(lib_id, exp_id, map_id=map_id, force=force, ip_filter=ip_filter)
-    if exp_data["method"]=="nano":
-        apa.bed.bed_raw_nano(lib_id, exp_id, map_id=map_id, force=force, ip_filter=ip_filter)
-
-def bed_raw_paseq(lib_id, exp_id, map_id, force=False, ip_filter=True):
-    assert(apa.annotation.libs[lib_id].experiments[exp_id]["method"] in ["pAseq", "paseq"])
-    # http://www.cgat.org/~andreas/documentation/pysam/api.html
-    # Coordinates in pysam are always 0-based (following the python convention). SAM text files use 1-based coordinates.
+    method = exp_data["method"]
+    if method not in site_rules:
+        print("{lib_id}_e{exp_id}_m{map_id} : R/T BED : unknown method {method}".format(lib_id=lib_id, exp_id=exp_id, map_id=map_id, method=method))
+        return
 
     r_filename = apa.path.r_filename(lib_id, exp_id, map_id=map_id)
     t_filename = apa.path.t_filename(lib_id, exp_id, map_id=map_id)
 
-    # don't redo analysis if files exists
-    if (os.path.exists(r_filename) and not force) or (os.path.exists(t_filename) and not force):
-        print("{lib_id}_e{exp_id}_m{map_id} : R/T BED : already processed or currently processing".format(lib_id=lib_id, exp_id=exp_id, map_id=map_id))
-        return
-
-    lib = apa.annotation.libs[lib_id]
-    exp_data = lib.experiments[exp_id]
-
-    open(r_filename, "wt").close()
-    open(t_filename, "wt").close()
-
-    dataR = {}
-    dataT = {}
-    genome = apa.annotation.libs[lib_id].experiments[exp_id]["map_to"]
-    bam_filename = os.path.join(apa.path.data_folder, lib_id, "e%s" % exp_id, "m%s" % map_id, "%s_e%s_m%s.bam" % (lib_id, exp_id, map_id))
-    bam_file = pysam.Samfile(bam_filename)
-    a_number = 0
-    ip_number = 0
-    for a in bam_file.fetch():
-        a_number += 1
-        if a_number%10000==0:
-            print("{lib_id}_e{exp_id}_m{map_id} : {processed}M reads processed : {bam_filename}".format(lib_id=lib_id, exp_id=exp_id, map_id=map_id, processed=a_number/1e6, bam_filename=bam_filename))
-
-        # do not process spliced reads
-        #cigar = a.cigar
-        #cigar_types = [t for (t, v) in cigar]
-        #if 3 in cigar_types:
-        #    continue
-
-        read_id = int(a.qname)
-        chr = bam_file.getrname(a.tid)
-        strand = "+" if not a.is_reverse else "-"
-
-        if strand=="+":
-            pos_end = a.positions[-1] # aend points to one past the last aligned residue, also see a.positions
-        else:
-            pos_end = a.positions[0]
-        rnd_code = apa.annotation.rndcode(lib_id, read_id)
-
-        key = "%s:%s" % (chr, strand)
-
-        save(dataR, key, pos_end, read_id)
+    genome = exp_data["map_to"]
+    bam_filename = apa.path.bam_filename(lib_id, exp_id, map_id=map_id)
 
-        # internal priming
-        if ip_check(genome, chr, strand, pos_end):
-            ip_number += 1
-            continue
-        save(dataT, key, pos_end, read_id)
+    # don't redo analysis if files are up to date (same BAM content and parameters)
+    rnd_filename = os.path.join(apa.path.data_folder, lib_id, "%s.rnd.bin" % lib_id) if dedup else None
+    if dedup and not os.path.exists(rnd_filename):
+        print("{lib_id}_e{exp_id}_m{map_id} : R/T BED : dedup without random barcodes, {rnd_filename} not found".format(lib_id=lib_id, exp_id=exp_id, map_id=map_id, rnd_filename=rnd_filename))
+        return
+    manifest = Manifest([r_filename, t_filename], [bam_filename, rnd_filename], {"method":method, "genome":genome, "ip_filter":ip_filter, "approximate":approximate, "dedup":dedup})
+    if manifest.current() and not force:
+        print("{lib_id}_e{exp_id}_m{map_id} : R/T BED : up to date".format(lib_id=lib_id, exp_id=exp_id, map_id=map_id))
+        return
+    if not manifest.start():
+        print("{lib_id}_e{exp_id}_m{map_id} : R/T BED : currently processing".format(lib_id=lib_id, exp_id=exp_id, map_id=map_id))
+        return
 
-    write_bed(dataR, r_filename)
-    write_bed(dataT, t_filename)
+    bam_file = pysam.AlignmentFile(bam_filename)
+    references = bam_file.references
+    label = "%s_e%s_m%s" % (lib_id, exp_id, map_id)
+    rnd_lib = lib_id if dedup else None
+
+    # finished chromosomes are written out as soon as they are final (coordinate sorted BAM or shards in reference order)
+    f_r = gzip.open(r_filename, "wt")
+    f_t = gzip.open(t_filename, "wt")
+    def flush(dataR, dataT, tid=None):
+        write_site_lines(dataR.pop(tid), references, f_r)
+        write_site_lines(dataT.pop(tid), references, f_t)
+
+    if parallel and bam_file.has_index():
+        shards = bam_shards(bam_file, tile_size=tile_size)
+        bam_file.close()
+        dataR, dataT, a_number, ip_number = bed_raw_parallel(bam_filename, shards, method, genome, ip_filter=ip_filter, label=label, approximate=approximate, rnd_lib=rnd_lib, flush=flush)
+    else:
+        dataR, dataT, a_number, ip_number = bed_raw_sites(bam_file, method, genome, ip_filter=ip_filter, label=label, approximate=approximate, rnd_lib=rnd_lib, flush=flush)
+        bam_file.close()
+    flush(dataR, dataT)
+    f_r.close()
+    f_t.close()
 
     f_ip = open(os.path.join(apa.path.data_folder, lib_id, "e%s" % exp_id, "m%s" % map_id, "%s_e%s_m%s.ip_stats.txt" % (lib_id, exp_id, map_id)), "wt")
     f_ip.write("%s total processed alignments\n" % a_number)
     f_ip.write("%s (%.2f %%) alignments omitted due to internal priming\n" % (ip_number, ip_number/float(max(1, a_number))*100))
     f_ip.close()
+    manifest.done()
 
-def bed_raw_aseq(lib_id, exp_id, map_id, force=False, ip_filter=True):
-    assert(apa.annotation.libs[lib_id].experiments[exp_id]["method"] in ["aseq"])
-    # http://www.cgat.org/~andreas/documentation/pysam/api.html
-    # Coordinates in pysam are always 0-based (following the python convention). SAM text files use 1-based coordinates.
-
-    r_filename = apa.path.r_filename(lib_id, exp_id, map_id=map_id)
-    t_filename = apa.path.t_filename(lib_id, exp_id, map_id=map_id)
-
-    # don't redo analysis if files exists
-    if (os.path.exists(r_filename) and not force) or (os.path.exists(t_filename) and not force):
-        print("{lib_id}_e{exp_id}_m{map_id} : R/T BED : already processed or currently processing".format(lib_id=lib_id, exp_id=exp_id, map_id=map_id))
-        return
-
-    lib = apa.annotation.libs[lib_id]
-    exp_data = lib.experiments[exp_id]
-
-    open(r_filename, "wt").close()
-    open(t_filename, "wt").close()
-
-    dataR = {}
-    dataT = {}
-    genome = apa.annotation.libs[lib_id].experiments[exp_id]["map_to"]
-    bam_filename = os.path.join(apa.path.data_folder, lib_id, "e%s" % exp_id, "m%s" % map_id, "%s_e%s_m%s.bam" % (lib_id, exp_id, map_id))
-    bam_file = pysam.Samfile(bam_filename)
+def bed_raw_sites(bam_file, method, genome, ip_filter=True, batch_size=100000, label="", region=None, approximate=False, rnd_lib=None, flush=None):
+    """
+    Single pass over the alignments of bam_file; returns (dataR, dataT, a_number, ip_number).
+    If region (chr, start, stop) is given, only alignments starting inside [start, stop) are processed (requires BAM index).
+    If rnd_lib is given, random barcodes of reads are looked up in rnd_lib (:func:`apa.annotation.rnd_table`) and distinct barcodes are counted.
+
+    Alignments are read in batches of batch_size into integer arrays (tid, strand, start, end). The polyA site of each
+    alignment is computed on the whole batch according to site_rules[method]. Internal priming is answered from the
+    genome IP mask (:func:`ip_mask_build`) or, if there is none, checked once per distinct site. dataR and dataT are
+    :class:`SiteCounter` objects (distinct read ids per site).
+
+    If the BAM file is coordinate sorted and flush is given, flush(dataR, dataT, tid) is called each time the
+    alignments move to the next reference (tid), so that finished references can be written out and freed; memory is
+    then bounded by the largest chromosome.
+    """
+    rule = site_rules[method]
+    dataR = SiteCounter(approximate=approximate)
+    dataT = SiteCounter(approximate=approximate)
+    ip_mask = IPMask(genome)
+    rnd_table = None if rnd_lib==None else apa.annotation.rnd_table(rnd_lib)
+    references = bam_file.references
     a_number = 0
     ip_number = 0
-    for a in bam_file.fetch():
-        a_number += 1
-        if a_number%10000==0:
-            print("{lib_id}_e{exp_id}_m{map_id} : {processed}M reads processed : {bam_filename}".format(lib_id=lib_id, exp_id=exp_id, map_id=map_id, processed=a_number/1e6, bam_filename=bam_filename))
-
-        read_id = a.qname
-        chr = bam_file.getrname(a.tid)
-        strand = "+" if not a.is_reverse else "-"
-
-        if strand=="+":
-            pos_end = a.positions[-1] # aend points to one past the last aligned residue, also see a.positions
-        else:
-            pos_end = a.positions[0]
-
-        key = "%s:%s" % (chr, strand)
-        save(dataR, key, pos_end, read_id)
-
-        # internal priming
-        if ip_check(genome, chr, strand, pos_end):
-            ip_number += 1
+    batch = SiteBatch()
+    coordinate_sorted = bam_file.header.to_dict().get("HD", {}).get("SO", "")=="coordinate"
+    last_tid = -1
+    if region==None:
+        alignments = bam_file.fetch(until_eof=True)
+    else:
+        chr, start, stop = region
+        alignments = bam_file.fetch(chr, start, stop)
+    for a in alignments:
+        if a.is_unmapped:
             continue
-        save(dataT, key, pos_end, read_id)
-
-    write_bed(dataR, r_filename)
-    write_bed(dataT, t_filename)
-
-    f_ip = open(os.path.join(apa.path.data_folder, lib_id, "e%s" % exp_id, "m%s" % map_id, "%s_e%s_m%s.ip_stats.txt" % (lib_id, exp_id, map_id)), "wt")
-    f_ip.write("%s total processed alignments\n" % a_number)
-    f_ip.write("%s (%.2f %%) alignments omitted due to internal priming\n" % (ip_number, ip_number/float(max(1, a_number))*100))
-    f_ip.close()
-
-def bed_raw_lexrev(lib_id, exp_id, map_id, force=False, ip_filter=True):
-    assert(apa.annotation.libs[lib_id].experiments[exp_id]["method"]=="lexrev")
-    read_len = apa.get_read_len(lib_id, exp_id)
-
-    r_filename = apa.path.r_filename(lib_id, exp_id, map_id=map_id)
-    t_filename = apa.path.t_filename(lib_id, exp_id, map_id=map_id)
-
-    # don't redo analysis if files exists
-    if (os.path.exists(t_filename) and not force):
-        print("%s_e%s_m%s : tail BED : already processed or currently processing" % (lib_id, exp_id, map_id))
-        return
-
-    lib = apa.annotation.libs[lib_id]
-    exp_data = lib.experiments[exp_id]
-
-    open(t_filename, "wt").close()
-    dataT = {}
-
-    open(r_filename, "wt").close()
-    dataR = {}
-
-    genome = apa.annotation.libs[lib_id].experiments[exp_id]["map_to"]
-    bam_filename = os.path.join(apa.path.data_folder, lib_id, "e%s" % exp_id, "m%s" % map_id, "%s_e%s_m%s.bam" % (lib_id, exp_id, map_id))
-    bam_file = pysam.Samfile(bam_filename)
+        if region!=None and a.reference_start<start: # alignment overlaps the shard but belongs to the previous one
+            continue
+        if a.reference_id!=last_tid and coordinate_sorted and flush!=None:
+            assert(a.reference_id>last_tid) # BAM header claims coordinate sorted
+            a_number += len(batch)
+            ip_number += batch.process(rule, references, dataR, dataT, ip_mask, ip_filter, rnd_table=rnd_table)
+            batch = SiteBatch()
+            flush(dataR, dataT, a.reference_id)
+        last_tid = a.reference_id
+        batch.add(a)
+        if len(batch)>=batch_size:
+            a_number += len(batch)
+            ip_number += batch.process(rule, references, dataR, dataT, ip_mask, ip_filter, rnd_table=rnd_table)
+            batch = SiteBatch()
+            print("%s : %.1fM processed, ip-filtering: %s" % (label, a_number/1e6, ip_filter))
+    a_number += len(batch)
+    ip_number += batch.process(rule, references, dataR, dataT, ip_mask, ip_filter, rnd_table=rnd_table)
+    return dataR, dataT, a_number, ip_number
+
+def bam_shards(bam_file, tile_size=None):
+    """
+    Split indexed bam_file into shards (chr, start, stop); one shard per reference or tiles of tile_size nt.
+    References without mapped alignments (according to the index) are skipped.
+    """
+    shards = []
+    for stat in bam_file.get_index_statistics():
+        if stat.mapped==0:
+            continue
+        length = bam_file.get_reference_length(stat.contig)
+        step = length if tile_size==None else tile_size
+        for start in range(0, length, step):
+            shards.append((stat.contig, start, min(start+step, length)))
+    return shards
+
+def bed_raw_shard(pars):
+    bam_filename, region, method, genome, ip_filter, label, approximate, rnd_lib = pars
+    bam_file = pysam.AlignmentFile(bam_filename)
+    result = bed_raw_sites(bam_file, method, genome, ip_filter=ip_filter, label="%s %s:%s-%s" % ((label,)+region), region=region, approximate=approximate, rnd_lib=rnd_lib)
+    bam_file.close()
+    return result
+
+def bed_raw_parallel(bam_filename, shards, method, genome, ip_filter=True, label="", approximate=False, rnd_lib=None, flush=None):
+    """
+    Process shards of bam_filename with a pool of apa.config.cores workers and merge the partial R/T tables.
+    Results are merged in shard order, so the output does not depend on which worker finished first.
+    Shards are in reference order, flush(dataR, dataT, tid) is called before the first shard of each reference.
+    """
+    bam_file = pysam.AlignmentFile(bam_filename)
+    references = bam_file.references
+    bam_file.close()
+    dataR = SiteCounter(approximate=approximate)
+    dataT = SiteCounter(approximate=approximate)
     a_number = 0
     ip_number = 0
-    for a in bam_file.fetch():
-        a_number += 1
-
-        if a_number%10000==0:
-            print("{lib_id}_e{exp_id}_m{map_id} : {processed}M reads processed : {bam_filename}".format(lib_id=lib_id, exp_id=exp_id, map_id=map_id, processed=a_number/1e6, bam_filename=bam_filename))
+    tasks = [(bam_filename, region, method, genome, ip_filter, label, approximate, rnd_lib) for region in shards]
+    pool = multiprocessing.Pool(processes=max(1, min(apa.config.cores, len(tasks))))
+    last_tid = -1
+    for region, (shard_R, shard_T, shard_a, shard_ip) in zip(shards, pool.imap(bed_raw_shard, tasks)):
+        tid = references.index(region[0])
+        if tid!=last_tid and flush!=None:
+            flush(dataR, dataT, tid)
+        last_tid = tid
+        dataR.merge(shard_R)
+        dataT.merge(shard_T)
+        a_number += shard_a
+        ip_number += shard_ip
+    pool.close()
+    pool.join()
+    print("%s : %.1fM processed in %s shards, ip-filtering: %s" % (label, a_number/1e6, len(shards), ip_filter))
+    return dataR, dataT, a_number, ip_number
+
+def site_key(tid, strand):
+    """
+    Integer key of (reference id, strand); strand is 0 (+) or 1 (-).
+    """
+    return tid*2 + strand
 
-        cigar = a.cigar
-        cigar_types = [t for (t, v) in cigar]
+class SiteBatch:
+    """
+    Batch of alignments stored column-wise in integer arrays.
+    """
 
-        read_id = a.qname
-        chr = bam_file.getrname(a.tid)
-        strand = "+" if not a.is_reverse else "-"
-        # we use the reference positions of the aligned read (aend, pos)
-        # relative positions are stored in qend, qstart
-        if strand=="+":
-            pos_end = a.positions[0]
+    def __init__(self):
+        self.tid = array.array("q")
+        self.reverse = array.array("b")
+        self.start = array.array("q")
+        self.end = array.array("q")
+        self.read_ids = array.array("q")
+
+    def __len__(self):
+        return len(self.read_ids)
+
+    def add(self, a):
+        self.tid.append(a.reference_id)
+        self.reverse.append(a.is_reverse)
+        self.start.append(a.reference_start)
+        self.end.append(a.reference_end)
+        self.read_ids.append(read_id_int(a.query_name))
+
+    def sites(self, rule):
+        """
+        Returns arrays (keys, positions) of polyA sites for the batch.
+        """
+        tid = np.frombuffer(self.tid, dtype=np.int64)
+        reverse = np.frombuffer(self.reverse, dtype=np.int8).astype(np.int64)
+        start = np.frombuffer(self.start, dtype=np.int64)
+        end = np.frombuffer(self.end, dtype=np.int64) - 1 # reference_end points to one past the last aligned residue
+        if rule["end"]=="3":
+            positions = np.where(reverse==1, start, end)
         else:
-            pos_end = a.positions[-1]
-
-        strand = {"+":"-", "-":"+"}[strand] # for lexrev, we turn strand
-        key = "%s:%s" % (chr, strand)
-
-        save(dataR, key, pos_end, read_id)
-
-        # internal priming
+            positions = np.where(reverse==1, end, start)
+        strand = (1 - reverse) if rule["reverse"] else reverse
+        return site_key(tid, strand), positions
+
+    def process(self, rule, references, dataR, dataT, ip_mask, ip_filter, rnd_table=None):
+        """
+        Adds batch sites to dataR and dataT; returns the number of internally primed alignments.
+        With rnd_table, random barcode ids are counted instead of read ids (reads without a barcode are counted by read id).
+        """
+        if len(self)==0:
+            return 0
+        keys, positions = self.sites(rule)
+        internal_primed = np.zeros(len(self), dtype=bool)
         if ip_filter:
-            if ip_check(genome, chr, strand, pos_end):
-                ip_number += 1
-                continue
-        save(dataT, key, pos_end, read_id)
-
-    write_bed(dataR, r_filename)
-    write_bed(dataT, t_filename)
-
-    f_ip = open(os.path.join(apa.path.data_folder, lib_id, "e%s" % exp_id, "m%s" % map_id, "%s_e%s_m%s.ip_stats.txt" % (lib_id, exp_id, map_id)), "wt")
-    f_ip.write("%s total processed alignments\n" % a_number)
-    f_ip.write("%s (%.2f %%) alignments omitted due to internal priming\n" % (ip_number, ip_number/float(max(1, a_number))*100))
-    f_ip.close()
-
-def bed_raw_lexfwd(lib_id, exp_id, map_id, force=False, ip_filter=True):
-    assert(apa.annotation.libs[lib_id].experiments[exp_id]["method"]=="lexfwd")
-
-    # http://www.cgat.org/~andreas/documentation/pysam/api.html
-    # Coordinates in pysam are always 0-based (following the python convention). SAM text files use 1-based coordinates.
-
-    t_filename = apa.path.t_filename(lib_id, exp_id, map_id=map_id)
-    r_filename = apa.path.r_filename(lib_id, exp_id, map_id=map_id)
-
-    # don't redo analysis if files exists
-    if (os.path.exists(r_filename) and not force) or (os.path.exists(t_filename) and not force):
-        print("%s_e%s_m%s : R/T BED : already processed" % (lib_id, exp_id, map_id))
-        return
-
-    lib = apa.annotation.libs[lib_id]
-    exp_data = lib.experiments[exp_id]
+            for key in np.unique(keys).tolist():
+                index = keys==key
+                internal_primed[index] = ip_mask.lookup(references[key//2], "+-"[key%2], positions[index])
+        read_ids = np.frombuffer(self.read_ids, dtype=np.int64)
+        if rnd_table!=None:
+            rnd_codes = rnd_table.lookup(read_ids).astype(np.int64)
+            read_ids = np.where(rnd_codes>0, -rnd_codes, read_ids) # barcodes negated, they can't clash with read numbers
+        raw = ~internal_primed if rule["ip_raw"] else np.ones(len(self), dtype=bool)
+        dataR.add(keys[raw], positions[raw], read_ids[raw])
+        dataT.add(keys[~internal_primed], positions[~internal_primed], read_ids[~internal_primed])
+        return int(internal_primed.sum())
+
+def read_id_int(read_id):
+    """
+    Integer id of a read name; reads are numbered by apa.extract, other names are hashed to 64 bits.
+    """
+    if read_id.isdigit():
+        return int(read_id)
+    return int.from_bytes(hashlib.blake2b(read_id.encode(), digest_size=8).digest(), "little", signed=True)
 
-    open(t_filename, "wt").close()
-    open(r_filename, "wt").close()
+class SiteCounter:
+    """
+    Number of distinct read (or random barcode) ids per site, sites are (site_key, position).
 
-    dataR = {}
-    dataT = {}
-    genome = apa.annotation.libs[lib_id].experiments[exp_id]["map_to"]
-    raw_bam_filename = os.path.join(apa.path.data_folder, lib_id, "e%s" % exp_id, "m%s" % map_id, "%s_e%s_m%s.bam" % (lib_id, exp_id, map_id))
-    raw_bam_file = pysam.Samfile(raw_bam_filename)
+    exact (default): sorted unique (site, id) pairs in numpy arrays; new ids are buffered and merged when the buffer
+    is as large as the merged arrays (amortized sorting), 16 bytes per distinct pair instead of a python set per site.
 
-    a_number = 0
-    ip_number = 0
-    for a in raw_bam_file.fetch():
-
-        a_number += 1
-        if a_number%100000==0:
-            print("%s_e%s_m%s : %sM processed : %s, ip-filtering: %s" % (lib_id, exp_id, map_id, a_number/1e6, os.path.basename(raw_bam_filename), ip_filter))
+    approximate: HyperLogLog registers per site (registers bytes per site), memory depends only on the number of sites;
+    small counts are estimated with linear counting (off by a few ids at most), standard error is 1.04/sqrt(registers)
+    for large counts.
+    """
 
-        read_id = a.qname
-        chr = raw_bam_file.getrname(a.tid)
-        strand = "+" if not a.is_reverse else "-"
-        # we use the reference positions of the aligned read (aend, pos)
-        # relative positions are stored in qend, qstart
-        if strand=="+":
-            pos_end = a.aend - 1 # aend points to one past the last aligned residue, also see a.positions
-            assert(pos_end==a.positions[-1])
+    def __init__(self, approximate=False, registers=64):
+        self.approximate = approximate
+        self.registers = registers
+        self.p = registers.bit_length()-1
+        assert(registers==2**self.p)
+        # exact
+        self.sites = np.zeros(0, dtype=np.int64)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.pending = []
+        self.pending_len = 0
+        # approximate
+        self.rows = {}
+        self.hll = np.zeros((0, registers), dtype=np.uint8)
+
+    def add(self, keys, positions, read_ids):
+        if len(keys)==0:
+            return
+        sites = (np.asarray(keys, dtype=np.int64) << 32) | np.asarray(positions, dtype=np.int64)
+        read_ids = np.asarray(read_ids, dtype=np.int64)
+        if self.approximate:
+            h = hash64(read_ids)
+            buckets = (h & np.uint64(self.registers-1)).astype(np.int64)
+            ranks = (64 - self.p) - bit_length(h >> np.uint64(self.p)) + 1
+            rows = self.site_rows(sites)
+            np.maximum.at(self.hll, (rows, buckets), ranks.astype(np.uint8))
+            return
+        self.buffer(sites, read_ids)
+
+    def buffer(self, sites, read_ids):
+        """
+        Buffer (site, id) pairs, merge when the buffer is as large as the merged arrays (each pair is sorted
+        O(log n) times in total, also for many merged shards).
+        """
+        self.pending.append((sites, read_ids))
+        self.pending_len += len(sites)
+        if self.pending_len>=max(1000000, len(self.sites)):
+            self.compact()
+
+    def compact(self):
+        """
+        Merge buffered (site, id) pairs into the sorted unique arrays.
+        """
+        if len(self.pending)==0:
+            return
+        sites = np.concatenate([self.sites] + [el[0] for el in self.pending])
+        ids = np.concatenate([self.ids] + [el[1] for el in self.pending])
+        order = np.lexsort((ids, sites))
+        sites, ids = sites[order], ids[order]
+        keep = np.ones(len(sites), dtype=bool)
+        keep[1:] = (sites[1:]!=sites[:-1]) | (ids[1:]!=ids[:-1])
+        self.sites, self.ids = sites[keep], ids[keep]
+        self.pending = []
+        self.pending_len = 0
+
+    def site_rows(self, sites):
+        """
+        HyperLogLog register rows of sites (new sites get new rows).
+        """
+        unique_sites, inverse = np.unique(sites, return_inverse=True)
+        rows = np.empty(len(unique_sites), dtype=np.int64)
+        for i, site in enumerate(unique_sites.tolist()):
+            row = self.rows.get(site, None)
+            if row==None:
+                row = len(self.rows)
+                self.rows[site] = row
+            rows[i] = row
+        if len(self.rows)>len(self.hll):
+            hll = np.zeros((max(len(self.rows), 2*len(self.hll)), self.registers), dtype=np.uint8)
+            hll[:len(self.hll)] = self.hll
+            self.hll = hll
+        return rows[inverse]
+
+    def merge(self, other):
+        """
+        Add all ids of other SiteCounter (e.g. from another shard).
+        """
+        if self.approximate:
+            if len(other.rows)>0:
+                rows = self.site_rows(np.array(list(other.rows.keys()), dtype=np.int64))
+                other_rows = np.array(list(other.rows.values()), dtype=np.int64)
+                self.hll[rows] = np.maximum(self.hll[rows], other.hll[other_rows])
+            return
+        other.compact()
+        if len(other.sites)>0:
+            self.buffer(other.sites, other.ids)
+
+    def pop(self, tid=None):
+        """
+        Remove and return (as new SiteCounter) all sites of references before tid; all sites if tid is None.
+        """
+        result = SiteCounter(approximate=self.approximate, registers=self.registers)
+        limit = np.iinfo(np.int64).max if tid==None else site_key(tid, 0) << 32
+        if self.approximate:
+            rows = {}
+            for site, row in self.rows.items():
+                if site<limit:
+                    result.rows[site] = len(result.rows)
+                else:
+                    rows[site] = len(rows)
+            result.hll = self.hll[[row for site, row in self.rows.items() if site<limit]]
+            self.hll = self.hll[[row for site, row in self.rows.items() if site>=limit]]
+            self.rows = rows
         else:
-            pos_end = a.pos
-            assert(pos_end==a.positions[0])
-
-        key = "%s:%s" % (chr, strand)
-
-        # internal priming
-        if ip_filter:
-            if ip_check(genome, chr, strand, pos_end):
-                ip_number += 1
-                continue
-
-        # we try this: just IP filter reads
-        save(dataT, key, pos_end, read_id)
-        save(dataR, key, pos_end, read_id)
-
-    write_bed(dataT, t_filename)
-    write_bed(dataR, r_filename)
-
-    f_ip = open(os.path.join(apa.path.data_folder, lib_id, "e%s" % exp_id, "m%s" % map_id, "%s_e%s_m%s.ip_stats.txt" % (lib_id, exp_id, map_id)), "wt")
-    f_ip.write("%s total processed alignments\n" % a_number)
-    f_ip.write("%s (%.2f %%) alignments omitted due to internal priming\n" % (ip_number, ip_number/float(max(1, a_number))*100))
-    f_ip.close()
-
-    return
-
-def bed_raw_nano(lib_id, exp_id, map_id, force=False, ip_filter=True):
-    assert(apa.annotation.libs[lib_id].experiments[exp_id]["method"]=="nano")
-
-    # http://www.cgat.org/~andreas/documentation/pysam/api.html
-    # Coordinates in pysam are always 0-based (following the python convention). SAM text files use 1-based coordinates.
-
-    t_filename = apa.path.t_filename(lib_id, exp_id, map_id=map_id)
-    r_filename = apa.path.r_filename(lib_id, exp_id, map_id=map_id)
-
-    # don't redo analysis if files exists
-    if (os.path.exists(r_filename) and not force) or (os.path.exists(t_filename) and not force):
-        print("%s_e%s_m%s : R/T BED : already processed" % (lib_id, exp_id, map_id))
-        return
-
-    lib = apa.annotation.libs[lib_id]
-    exp_data = lib.experiments[exp_id]
-
-    open(t_filename, "wt").close()
-    open(r_filename, "wt").close()
-
-    dataR = {}
-    dataT = {}
-    genome = apa.annotation.libs[lib_id].experiments[exp_id]["map_to"]
-    raw_bam_filename = os.path.join(apa.path.data_folder, lib_id, "e%s" % exp_id, "m%s" % map_id, "%s_e%s_m%s.bam" % (lib_id, exp_id, map_id))
-    raw_bam_file = pysam.Samfile(raw_bam_filename)
-
-    a_number = 0
-    ip_number = 0
-    for a in raw_bam_file.fetch():
-
-        a_number += 1
-        if a_number%100000==0:
-            print("%s_e%s_m%s : %sM processed : %s, ip-filtering: %s" % (lib_id, exp_id, map_id, a_number/1e6, os.path.basename(raw_bam_filename), ip_filter))
-
-        read_id = a.qname
-        chr = raw_bam_file.getrname(a.tid)
-        strand = "+" if not a.is_reverse else "-"
-        # we use the reference positions of the aligned read (aend, pos)
-        # relative positions are stored in qend, qstart
-        if strand=="+":
-            pos_end = a.aend - 1 # aend points to one past the last aligned residue, also see a.positions
-            assert(pos_end==a.positions[-1])
+            self.compact()
+            i = np.searchsorted(self.sites, limit)
+            result.sites, result.ids = self.sites[:i], self.ids[:i]
+            self.sites, self.ids = self.sites[i:], self.ids[i:]
+        return result
+
+    def counts(self):
+        """
+        Returns (keys, positions, counts) arrays, sorted by site_key and position.
+        """
+        if self.approximate:
+            sites = np.array(list(self.rows.keys()), dtype=np.int64)
+            rows = np.array(list(self.rows.values()), dtype=np.int64)
+            order = np.argsort(sites)
+            sites, rows = sites[order], rows[order]
+            counts = hll_estimate(self.hll[rows], self.registers)
         else:
-            pos_end = a.pos
-            assert(pos_end==a.positions[0])
-
-        key = "%s:%s" % (chr, strand)
-
-        # internal priming
-        if ip_filter:
-            if ip_check(genome, chr, strand, pos_end):
-                ip_number += 1
-                continue
-
-        # we try this: just IP filter reads
-        save(dataT, key, pos_end, read_id)
-        save(dataR, key, pos_end, read_id)
-
-    write_bed(dataT, t_filename)
-    write_bed(dataR, r_filename)
+            self.compact()
+            sites, counts = np.unique(self.sites, return_counts=True)
+        return sites >> 32, sites & 0xffffffff, counts
 
-    f_ip = open(os.path.join(apa.path.data_folder, lib_id, "e%s" % exp_id, "m%s" % map_id, "%s_e%s_m%s.ip_stats.txt" % (lib_id, exp_id, map_id)), "wt")
-    f_ip.write("%s total processed alignments\n" % a_number)
-    f_ip.write("%s (%.2f %%) alignments omitted due to internal priming\n" % (ip_number, ip_number/float(max(1, a_number))*100))
-    f_ip.close()
+def hash64(values):
+    """
+    splitmix64 mix of int64 values, returns uint64 array.
+    """
+    z = values.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+def bit_length(values):
+    values = values.copy()
+    n = np.zeros(len(values), dtype=np.int64)
+    for shift in [32, 16, 8, 4, 2, 1]:
+        big = values >= (np.uint64(1) << np.uint64(shift))
+        n[big] += shift
+        values[big] >>= np.uint64(shift)
+    return n + (values>0)
+
+def hll_estimate(hll, m):
+    """
+    HyperLogLog estimate for each row of registers, with linear counting for small cardinalities.
+    """
+    alpha = 0.7213/(1+1.079/m)
+    estimate = alpha * m * m / np.power(2.0, -hll.astype(np.float64)).sum(axis=1)
+    zeros = (hll==0).sum(axis=1)
+    small = (estimate<=2.5*m) & (zeros>0)
+    estimate[small] = m * np.log(m / zeros[small].astype(np.float64))
+    return np.maximum(1, np.round(estimate)).astype(np.int64)
+
+def write_sites(data, references, filename):
+    """
+    Save bedGraph file from data (:class:`SiteCounter`) to filename.
+    Sites are written in the order of BAM references, first + and then - strand.
+    """
+    f = gzip.open(filename, "wt")
+    write_site_lines(data, references, f)
+    f.close()
 
-    return
+def write_site_lines(data, references, f):
+    """
+    Write bedGraph lines of data (:class:`SiteCounter`) to open file f.
+    """
+    keys, positions, counts = data.counts()
+    for key, pos, cDNA in zip(keys.tolist(), positions.tolist(), counts.tolist()):
+        if key%2==0:
+            f.write("%s\t%s\t%s\t%s\n" % (references[key//2], pos, pos+1, cDNA))
+        else:
+            f.write("%s\t%s\t%s\t-%s\n" % (references[key//2], pos, pos+1, cDNA))
 
 def bed_expression(lib_id, exp_id, map_id=1, force=False, poly_id=None, upstream=None, downstream=None):
     """
@@ -549,6 +1021,7 @@ def bed_expression(lib_id, exp_id, map_id=1, force=False, poly_id=None, upstream
 
         ${data_folder}/${lib_id}/e${exp_id}/m${map_id}/${lib_id}_e${exp_id}_m${map_id}.E.bed # E=expression
 
+    Same engine as :func:`bed_expression_lib` (:func:`bed_expression_atlas`), so both write the same E files.
     """
     exp_id = int(exp_id)
     exp_data = apa.annotation.libs[lib_id].experiments[exp_id]
@@ -571,101 +1044,181 @@ def bed_expression(lib_id, exp_id, map_id=1, force=False, poly_id=None, upstream
         apa.bed.bed_expression_nano(lib_id, exp_id=exp_id, map_id=map_id, map_to=map_to, poly_id=poly_id, force=force, upstream=upstream, downstream=downstream)
 
 def bed_expression_paseq(lib_id, exp_id, map_id, map_to, poly_id, force=False, upstream=100, downstream=25):
-    genome = apa.annotation.libs[lib_id].experiments[exp_id]["map_to"]
-    r_filename = apa.path.r_filename(lib_id, exp_id, map_id=map_id)
-    e_filename = apa.path.e_filename(lib_id, exp_id, map_id=map_id, poly_id=poly_id)
-    bam_filename = apa.path.bam_filename(lib_id, exp_id, map_id=map_id)
     if poly_id==None:
         poly_id = map_to
-    polyadb_filename = apa.path.polyadb_filename(poly_id)
-
-    e_filename = apa.path.e_filename(lib_id, exp_id, map_id=map_id, poly_id=poly_id)
-    if os.path.exists(e_filename) and not force:
-        print("%s_e%s_m%s : E BED : already processed or currently processing" % (lib_id, exp_id, map_id))
-    else:
-        print("%s_e%s_m%s : E BED, upstream=%s, downstream=%s" % (lib_id, exp_id, map_id, upstream, downstream))
-        open(e_filename, "wt").close() # touch E BED (processing)
-        e = pybio.data.Bedgraph()
-        e.overlay(polyadb_filename, r_filename, start=-upstream, stop=downstream)
-        #e.overlay2(polyadb_filename, bam_filename, start=-upstream, stop=downstream)
-        e.save(e_filename, track_id="%s_e%s_m1" % (lib_id, exp_id))
+    bed_expression_atlas(lib_id, exp_id, map_id, poly_id, upstream, downstream, force=force)
 
 def bed_expression_aseq(lib_id, exp_id, map_id, map_to, poly_id, force=False, upstream=100, downstream=25):
-    genome = apa.annotation.libs[lib_id].experiments[exp_id]["map_to"]
-    r_filename = apa.path.r_filename(lib_id, exp_id, map_id=map_id)
-    e_filename = apa.path.e_filename(lib_id, exp_id, map_id=map_id, poly_id=poly_id)
-    bam_filename = apa.path.bam_filename(lib_id, exp_id, map_id=map_id)
     if poly_id==None:
         poly_id = map_to
-    polyadb_filename = apa.path.polyadb_filename(poly_id)
-
-    e_filename = apa.path.e_filename(lib_id, exp_id, map_id=map_id, poly_id=poly_id)
-    if os.path.exists(e_filename) and not force:
-        print("%s_e%s_m%s : E BED : already processed or currently processing" % (lib_id, exp_id, map_id))
-    else:
-        print("%s_e%s_m%s : E BED, upstream=%s, downstream=%s" % (lib_id, exp_id, map_id, upstream, downstream))
-        open(e_filename, "wt").close() # touch E BED (processing)
-        e = pybio.data.Bedgraph()
-        e.overlay(polyadb_filename, r_filename, start=-upstream, stop=downstream)
-        #e.overlay2(polyadb_filename, bam_filename, start=-upstream, stop=downstream)
-        e.save(e_filename, track_id="%s_e%s_m1" % (lib_id, exp_id))
+    bed_expression_atlas(lib_id, exp_id, map_id, poly_id, upstream, downstream, force=force)
 
 def bed_expression_lexrev(lib_id, exp_id, map_id, map_to, poly_id, force=False, upstream=5, downstream=5):
-    genome = apa.annotation.libs[lib_id].experiments[exp_id]["map_to"]
-    r_filename = apa.path.r_filename(lib_id, exp_id, map_id=map_id)
     if poly_id==None:
         poly_id = map_to
-    polyadb_filename = apa.path.polyadb_filename(poly_id)
-
-    bam_filename = apa.path.bam_filename(lib_id, exp_id, map_id=map_id)
-    e_filename = apa.path.e_filename(lib_id, exp_id, map_id=map_id, poly_id=poly_id)
-    e_filename_norm = apa.path.e_filename_norm(lib_id, exp_id, map_id=map_id, poly_id=poly_id)
-    if os.path.exists(e_filename) and not force:
-        print("%s_e%s_m%s : E BED : already processed or currently processing" % (lib_id, exp_id, map_id))
-    else:
-        print("%s_e%s_m%s : E BED, upstream=%s, downstream=%s" % (lib_id, exp_id, map_id, upstream, downstream))
-        open(e_filename, "wt").close() # touch E BED (processing)
-        e = pybio.data.Bedgraph()
-        e.overlay(polyadb_filename, r_filename, start=-upstream, stop=downstream)
-        #e.overlay2(polyadb_filename, bam_filename, start=-upstream, stop=downstream, reverse_strand=True)
-        e.save(e_filename, track_id="%s_e%s_m1" % (lib_id, exp_id))
-        e.norm()
-        e.save(e_filename_norm, track_id="%s_e%s_m1" % (lib_id, exp_id), db_save="cpm")
+    bed_expression_atlas(lib_id, exp_id, map_id, poly_id, upstream, downstream, force=force)
 
 def bed_expression_lexfwd(lib_id, exp_id, map_id, map_to, poly_id, force=False, upstream=100, downstream=25):
-    genome = apa.annotation.libs[lib_id].experiments[exp_id]["map_to"]
-    r_filename = apa.path.r_filename(lib_id, exp_id, map_id=map_id)
     if poly_id==None:
         poly_id = map_to
-    polyadb_filename = apa.path.polyadb_filename(poly_id)
-
-    bam_filename = apa.path.bam_filename(lib_id, exp_id, map_id=map_id)
-    e_filename = apa.path.e_filename(lib_id, exp_id, map_id=map_id, poly_id=poly_id)
-    if os.path.exists(e_filename) and not force:
-        print("%s_e%s_m%s_ : E BED : already processed or currently processing" % (lib_id, exp_id, map_id))
-    else:
-        print("%s_e%s_m%s : E BED, upstream=%s, downstream=%s" % (lib_id, exp_id, map_id, upstream, downstream))
-        open(e_filename, "wt").close() # touch E BED (processing)
-        e = pybio.data.Bedgraph()
-        e.overlay(polyadb_filename, r_filename, start=-upstream, stop=downstream)
-        #e.overlay2(polyadb_filename, bam_filename, start=-upstream, stop=downstream)
-        e.save(e_filename, track_id="%s_e%s_m1" % (lib_id, exp_id))
+    bed_expression_atlas(lib_id, exp_id, map_id, poly_id, upstream, downstream, force=force)
 
 def bed_expression_nano(lib_id, exp_id, map_id, map_to, poly_id, force=False, upstream=100, downstream=25):
-    genome = apa.annotation.libs[lib_id].experiments[exp_id]["map_to"]
-    r_filename = apa.path.r_filename(lib_id, exp_id, map_id=map_id)
     if poly_id==None:
         poly_id = map_to
-    polyadb_filename = apa.path.polyadb_filename(poly_id)
+    bed_expression_atlas(lib_id, exp_id, map_id, poly_id, upstream, downstream, force=force)
 
-    bam_filename = apa.path.bam_filename(lib_id, exp_id, map_id=map_id)
-    e_filename = apa.path.e_filename(lib_id, exp_id, map_id=map_id, poly_id=poly_id)
-    if os.path.exists(e_filename) and not force:
-        print("%s_e%s_m%s_ : E BED : already processed or currently processing" % (lib_id, exp_id, map_id))
-    else:
-        print("%s_e%s_m%s : E BED, upstream=%s, downstream=%s" % (lib_id, exp_id, map_id, upstream, downstream))
-        open(e_filename, "wt").close() # touch E BED (processing)
-        e = pybio.data.Bedgraph()
-        e.overlay(polyadb_filename, r_filename, start=-upstream, stop=downstream)
-        #e.overlay2(polyadb_filename, bam_filename, start=-upstream, stop=downstream)
-        e.save(e_filename, track_id="%s_e%s_m1" % (lib_id, exp_id))
+def chr_order(chr):
+    """
+    Sort key for chromosome names: numbered chromosomes first (numerically), then the rest alphabetically.
+    """
+    return (0, int(chr), "") if chr.isdigit() else (1, 0, chr)
+
+def read_bed_sites(filename):
+    """
+    Read bedGraph file (chr, start, stop, value; negative values are - strand) into dictionary
+    (chr, strand) -> (positions, values), both sorted numpy arrays. Intervals are expanded to positions start..stop-1
+    (as pybio.data.Bedgraph.load).
+    """
+    data = {}
+    f = gzip.open(filename, "rt")
+    for r in f:
+        if r.startswith("track"):
+            continue
+        r = r.rstrip("\r\n").split("\t")
+        if len(r)<4:
+            continue
+        value = float(r[3])
+        strand = "+" if value>=0 else "-"
+        level_1 = data.setdefault((r[0], strand), ([], []))
+        for pos in range(int(r[1]), int(r[2])):
+            level_1[0].append(pos)
+            level_1[1].append(abs(value))
+    f.close()
+    for key, (positions, values) in data.items():
+        positions = np.array(positions, dtype=np.int64)
+        values = np.array(values)
+        order = np.argsort(positions, kind="stable")
+        data[key] = (positions[order], values[order])
+    return data
+
+class AtlasIndex:
+    """
+    polyA atlas (:func:`apa.path.polyadb_filename`) loaded once into sorted position arrays per (chr, strand).
+    Experiments are assigned to atlas sites with :func:`AtlasIndex.overlay`.
+    """
+
+    def __init__(self, poly_id):
+        self.poly_id = poly_id
+        self.sites = {}
+        for key, (positions, _) in read_bed_sites(apa.path.polyadb_filename(poly_id)).items():
+            self.sites[key] = positions
+
+    def keys(self):
+        return sorted(self.sites.keys(), key=lambda key: (chr_order(key[0]), key[1]))
+
+    def overlay(self, r_filename, upstream, downstream):
+        """
+        Sum R bedGraph values in [pos-upstream, pos+downstream] (in transcript orientation) of each atlas site.
+        As in pybio.data.Bedgraph.overlay, windows are narrowed to half the distance to the neighbouring atlas sites
+        on the same strand (:func:`AtlasIndex.windows`), so sites do not share reads.
+        Returns dictionary (chr, strand) -> counts aligned with self.sites[(chr, strand)].
+        """
+        data = read_bed_sites(r_filename)
+        result = {}
+        for key, sites in self.sites.items():
+            positions, values = data.get(key, (np.zeros(0, dtype=np.int64), np.zeros(0)))
+            cs = np.concatenate(([0], np.cumsum(values)))
+            lo, hi = self.windows(sites, key[1], upstream, downstream)
+            counts = cs[np.searchsorted(positions, hi, side="right")] - cs[np.searchsorted(positions, lo, side="left")]
+            result[key] = counts
+        return result
+
+    @staticmethod
+    def windows(sites, strand, upstream, downstream):
+        """
+        Genomic windows [lo, hi] of sorted sites: upstream/downstream (transcript orientation) limited to half the
+        distance to the previous/next site, (d-1)//2 for neighbours at distance d (same as pybio overlay). Windows are
+        only narrowed if both upstream and downstream are >0.
+        """
+        up = np.full(len(sites), upstream, dtype=np.int64)
+        down = np.full(len(sites), downstream, dtype=np.int64)
+        if upstream>0 and downstream>0 and len(sites)>1:
+            half = np.maximum((np.diff(sites)-1)//2, 0)
+            left = np.concatenate(([max(upstream, downstream)], half)) # half distance to the site on the left (genome)
+            right = np.concatenate((half, [max(upstream, downstream)])) # and on the right
+            if strand=="+":
+                up, down = np.minimum(up, left), np.minimum(down, right)
+            else:
+                up, down = np.minimum(up, right), np.minimum(down, left)
+        if strand=="+":
+            return sites-up, sites+down
+        return sites-down, sites+up
+
+    def save(self, counts, filename, track_id, norm=False):
+        """
+        Save expression bedGraph of counts (result of :func:`AtlasIndex.overlay`); only sites with counts>0 are stored.
+        If norm, counts are scaled to counts per million.
+        """
+        scale = 1
+        if norm:
+            scale = 1e6/max(1, sum(c.sum() for c in counts.values()))
+        f = gzip.open(filename, "wt")
+        f.write("track type=bedGraph name=\"%s\" description=\"%s\" altColor=\"200,120,59\" color=\"120,101,172\" maxHeightPixels=\"100:50:0\" visibility=\"full\" priority=\"20\"\n" % (track_id, track_id))
+        for chr, strand in self.keys():
+            sites = self.sites[(chr, strand)]
+            values = counts[(chr, strand)]
+            sign = "" if strand=="+" else "-"
+            for pos, value in zip(sites[values>0].tolist(), values[values>0].tolist()):
+                if norm:
+                    value = "%.3f" % (value*scale)
+                else:
+                    value = "%d" % value if float(value).is_integer() else "%.5f" % value # as pybio.data.Bedgraph.save
+                f.write("%s\t%s\t%s\t%s%s\n" % (chr, pos, pos+1, sign, value))
+        f.close()
+
+def bed_expression_lib(lib_id, map_id=1, force=False, poly_id=None, upstream=None, downstream=None):
+    """
+    Generates expression bedGraph files for all experiments of lib_id in one run (see :func:`bed_expression`).
+
+    The polyA atlas is read and indexed only once; R counts of each experiment are assigned to atlas sites with
+    searchsorted over the upstream/downstream windows. For lexrev also the cpm normalized file is stored.
+    """
+    lib = apa.annotation.libs[lib_id]
+    atlases = {}
+    for exp_id, exp_data in lib.experiments.items():
+        exp_poly_id = exp_data["map_to"] if poly_id==None else poly_id
+        exp_upstream = upstream_defaults[exp_data["method"]] if upstream==None else upstream
+        exp_downstream = downstream_defaults[exp_data["method"]] if downstream==None else downstream
+        if not os.path.exists(apa.path.r_filename(lib_id, exp_id, map_id=map_id)):
+            continue
+        bed_expression_atlas(lib_id, exp_id, map_id, exp_poly_id, exp_upstream, exp_downstream, force=force, atlases=atlases)
+
+def bed_expression_atlas(lib_id, exp_id, map_id, poly_id, upstream, downstream, force=False, atlases=None):
+    """
+    Expression bedGraph of experiment exp_id: R counts assigned to the sites of atlas poly_id (:class:`AtlasIndex`,
+    taken from the dictionary atlases poly_id -> AtlasIndex if given). For lexrev also the cpm normalized file is stored.
+    """
+    method = apa.annotation.libs[lib_id].experiments[exp_id]["method"]
+    r_filename = apa.path.r_filename(lib_id, exp_id, map_id=map_id)
+    outputs = [apa.path.e_filename(lib_id, exp_id, map_id=map_id, poly_id=poly_id)]
+    if method=="lexrev":
+        outputs.append(apa.path.e_filename_norm(lib_id, exp_id, map_id=map_id, poly_id=poly_id))
+    manifest = Manifest(outputs, [r_filename, apa.path.polyadb_filename(poly_id)], {"upstream":upstream, "downstream":downstream})
+    if manifest.current() and not force:
+        print("%s_e%s_m%s : E BED : up to date" % (lib_id, exp_id, map_id))
+        return
+    if not manifest.start():
+        print("%s_e%s_m%s : E BED : currently processing" % (lib_id, exp_id, map_id))
+        return
+    print("%s_e%s_m%s : E BED, upstream=%s, downstream=%s" % (lib_id, exp_id, map_id, upstream, downstream))
+    if atlases==None:
+        atlases = {}
+    if poly_id not in atlases:
+        atlases[poly_id] = AtlasIndex(poly_id)
+    atlas = atlases[poly_id]
+    counts = atlas.overlay(r_filename, upstream, downstream)
+    atlas.save(counts, outputs[0], track_id="%s_e%s_m1" % (lib_id, exp_id))
+    if method=="lexrev":
+        atlas.save(counts, outputs[1], track_id="%s_e%s_m1" % (lib_id, exp_id), norm=True)
+    manifest.done()
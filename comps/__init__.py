@@ -313,6 +313,7 @@ def process_comps(comps_id, map_id=1, clean=True):
         for poly_type in comps.poly_type:
             polydb.load(apa.path.polyadb_filename(comps.polya_db, poly_type=poly_type, filetype="bed"), meta=poly_type)
         polydb_annotated = apa.polya.read_polydb(comps.polya_db)
+        atlas_annotation = apa.polya.AtlasAnnotation(comps.polya_db, species=comps.species, polydb=polydb_annotated)
 
     replicates = []
     expression = {} # keys = c1, c2, c3, t1, t2, t3...items = bedgraph files
@@ -396,13 +397,13 @@ def process_comps(comps_id, map_id=1, clean=True):
                 pos_set = list(pos_set)
                 for pos in pos_set:
                     num_sites += 1
-                    (gene_up, gene_id, gene_down, gene_interval, gene_feature) = pybio.genomes.annotate(comps.species, chr, strand, pos)
+                    gene_id, _, gene_interval = atlas_annotation.get(chr, strand, pos)
                     if gene_id==None: # only consider polya sites inside genes
                         continue
                     num_sites_genes += 1
                     num_genes.add(gene_id)
                     sites = gsites.get(gene_id, {})
-                    site_data = {"chr":chr, "strand":strand, "pos":pos, "gene_interval":list(gene_interval), "gene_feature":gene_feature} # store position and gene_interval (start, stop, exon/intron), clip binding
+                    site_data = {"chr":chr, "strand":strand, "pos":pos, "gene_interval":list(gene_interval), "gene_feature":None} # store position and gene_interval (start, stop, exon/intron), clip binding
 
                     # get clip data
                     for clip_name in comps.CLIP:
@@ -450,6 +451,11 @@ def process_comps(comps_id, map_id=1, clean=True):
                 if site_data["cDNA_sum"] < (minor_major_thr * max_exp):
                     del sites[pos]
 
+        # gene_feature is not stored in the atlas, the genome is annotated only for the final sites
+        for gene_id, sites in gsites.items():
+            for pos, site_data in sites.items():
+                site_data["gene_feature"] = pybio.genomes.annotate(comps.species, site_data["chr"], site_data["strand"], pos)[4]
+
         num_sites_per_gene = {}
         for gene_id, sites in gsites.items():
             num_sites_per_gene[len(sites.keys())] = num_sites_per_gene.get(len(sites.keys()), 0) + 1
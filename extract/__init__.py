@@ -5,15 +5,407 @@ import os
 import sys
 import gzip
 import glob
-import struct
 import time
+import collections
+import hashlib
+import heapq
+import json
+import concurrent.futures
+import multiprocessing
+import numpy as np
 
 # parameters
 min_read_length = 10
 tail_window = 20
 A_percentage = 0.85
 
-def process_lib_ok(library_id, force=False):
+nt_codes = np.full(256, 255, dtype=np.uint8)
+for i, nt in enumerate("ACGT"):
+    nt_codes[ord(nt)] = i
+nt_chars = np.array(list("ACGT"))
+
+def encode_barcodes(codes):
+    """
+    Pack barcodes (list of str) into uint64: leading 1 bit followed by 2 bits per nucleotide (A=0, C=1, G=2, T=3).
+    Barcodes with other characters (N) or longer than 31 nt can not be packed and get 0.
+    """
+    keys = np.zeros(len(codes), dtype=np.uint64)
+    lengths = np.array([len(code) for code in codes], dtype=np.int64)
+    for length in np.unique(lengths).tolist():
+        if length>31:
+            continue
+        index = np.flatnonzero(lengths==length)
+        values = nt_codes[np.frombuffer("".join([codes[i] for i in index.tolist()]).encode("latin-1", "replace"), dtype=np.uint8)].reshape(len(index), length)
+        packed = np.ones(len(index), dtype=np.uint64)
+        for j in range(length):
+            packed = (packed << np.uint64(2)) | values[:, j].astype(np.uint64)
+        valid = (values!=255).all(axis=1)
+        keys[index[valid]] = packed[valid]
+    return keys
+
+def decode_barcodes(keys):
+    """
+    Inverse of :func:`encode_barcodes` for packed keys (numpy array of str).
+    """
+    result = np.empty(len(keys), dtype=np.dtype("U31"))
+    for length in range(0, 32):
+        index = np.flatnonzero((keys >> np.uint64(2*length))==1)
+        if len(index)==0:
+            continue
+        chars = np.empty((len(index), length), dtype=np.dtype("U1"))
+        for j in range(length):
+            chars[:, j] = nt_chars[((keys[index] >> np.uint64(2*(length-1-j))) & np.uint64(3)).astype(np.int64)]
+        result[index] = ["".join(row) for row in chars.tolist()]
+    return result
+
+def barcode_hash(keys):
+    z = keys + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+class BarcodeTable:
+    """
+    Random barcodes -> (id, freq). Barcodes are packed with :func:`encode_barcodes` and stored in an open addressing
+    (linear probing) hash table of numpy arrays (keys, ids, freq); barcodes that can not be packed are kept in a dict.
+    Ids are assigned from 1 in order of first occurrence. With counts=False frequencies are not stored (see
+    :class:`HeavyHitters` for approximate reports).
+    """
+
+    def __init__(self, capacity=1<<20, counts=True):
+        self.counts = counts
+        self.keys = np.zeros(capacity, dtype=np.uint64)
+        self.ids = np.zeros(capacity, dtype=np.uint32)
+        self.freq = np.zeros(capacity if counts else 0, dtype=np.uint64)
+        self.packed = 0
+        self.escaped = {} # barcode -> [id, freq]
+
+    def __len__(self):
+        return self.packed + len(self.escaped)
+
+    def slots(self, keys):
+        """
+        Slot of each key in the table: the slot holding the key or the empty slot where the key would be stored.
+        """
+        mask = len(self.keys)-1
+        slots = (barcode_hash(keys) & np.uint64(mask)).astype(np.int64)
+        todo = np.arange(len(keys))
+        while len(todo)>0:
+            found = self.keys[slots[todo]]
+            todo = todo[(found!=keys[todo]) & (found!=0)]
+            slots[todo] = (slots[todo]+1) & mask
+        return slots
+
+    def insert(self, keys, ids):
+        """
+        Store distinct keys that are not in the table yet.
+        """
+        while len(keys)>0:
+            slots = self.slots(keys)
+            _, first = np.unique(slots, return_index=True) # keys competing for the same empty slot: first one wins
+            self.keys[slots[first]] = keys[first]
+            self.ids[slots[first]] = ids[first]
+            rest = np.ones(len(keys), dtype=bool)
+            rest[first] = False
+            keys, ids = keys[rest], ids[rest]
+
+    def grow(self, size):
+        capacity = len(self.keys)
+        while size*2>capacity:
+            capacity *= 2
+        if capacity==len(self.keys):
+            return
+        occupied = np.flatnonzero(self.keys)
+        keys, ids = self.keys[occupied], self.ids[occupied]
+        self.keys = np.zeros(capacity, dtype=np.uint64)
+        self.ids = np.zeros(capacity, dtype=np.uint32)
+        self.insert(keys, ids)
+        if self.counts:
+            freq = self.freq[occupied]
+            self.freq = np.zeros(capacity, dtype=np.uint64)
+            self.freq[self.slots(keys)] = freq
+
+    def add(self, codes, counts=None):
+        """
+        Add barcodes (list of str) with counts (default 1 per barcode), returns numpy array of barcode ids.
+        """
+        counts = np.ones(len(codes), dtype=np.uint64) if counts is None else np.asarray(counts, dtype=np.uint64)
+        keys = encode_barcodes(codes)
+        result = np.zeros(len(codes), dtype=np.uint32)
+        new = [] # (first position, key or escaped barcode)
+
+        packed = np.flatnonzero(keys)
+        uniq, first, inverse = np.unique(keys[packed], return_index=True, return_inverse=True)
+        self.grow(self.packed + len(uniq))
+        slots = self.slots(uniq)
+        missing = np.flatnonzero(self.keys[slots]==0)
+        new.extend(zip(packed[first[missing]].tolist(), uniq[missing].tolist()))
+        escaped = {}
+        for i in np.flatnonzero(keys==0).tolist():
+            if codes[i] not in self.escaped and codes[i] not in escaped:
+                escaped[codes[i]] = i
+                new.append((i, codes[i]))
+
+        # new barcodes get ids in order of first occurrence
+        new.sort(key=lambda item: item[0])
+        new_keys = []
+        new_ids = []
+        for rnd_code_id, (_, key) in enumerate(new, len(self)+1):
+            if type(key)==str:
+                self.escaped[key] = [rnd_code_id, 0]
+            else:
+                new_keys.append(key)
+                new_ids.append(rnd_code_id)
+        self.insert(np.array(new_keys, dtype=np.uint64), np.array(new_ids, dtype=np.uint32))
+        self.packed += len(new_keys)
+
+        slots = self.slots(uniq)
+        if self.counts:
+            self.freq[slots] += np.bincount(inverse, weights=counts[packed], minlength=len(uniq)).astype(np.uint64)
+        result[packed] = self.ids[slots][inverse]
+        for i in np.flatnonzero(keys==0).tolist():
+            item = self.escaped[codes[i]]
+            item[1] += int(counts[i])
+            result[i] = item[0]
+        return result
+
+    def save(self, filename):
+        """
+        Store snapshot of the table (numpy .npz).
+        """
+        f = open(filename, "wb")
+        np.savez(f, keys=self.keys, ids=self.ids, freq=self.freq, packed=np.array([self.packed]), escaped_codes=np.array(list(self.escaped.keys()), dtype=str), escaped_values=np.array(list(self.escaped.values()), dtype=np.uint64).reshape(-1, 2))
+        f.close()
+
+    def load(self, filename):
+        """
+        Restore table from a snapshot stored with :func:`save`.
+        """
+        data = np.load(filename)
+        self.keys, self.ids, self.freq = data["keys"], data["ids"], data["freq"]
+        self.counts = len(self.freq)==len(self.keys)
+        self.packed = int(data["packed"][0])
+        self.escaped = dict((code, [int(rnd_code_id), int(freq)]) for code, (rnd_code_id, freq) in zip(data["escaped_codes"].tolist(), data["escaped_values"].tolist()))
+
+    def write(self, filename, top=None):
+        """
+        Write barcodes (freq, random_code, random_code_id) sorted by decreasing frequency; only the top most frequent
+        barcodes if top is given.
+        """
+        occupied = np.flatnonzero(self.keys)
+        freq = np.concatenate([self.freq[occupied], np.array([item[1] for item in self.escaped.values()], dtype=np.uint64)])
+        ids = np.concatenate([self.ids[occupied], np.array([item[0] for item in self.escaped.values()], dtype=np.uint32)])
+        selected = np.arange(len(freq))
+        if top!=None and top<len(freq):
+            threshold = np.partition(freq, len(freq)-top)[len(freq)-top]
+            selected = np.flatnonzero(freq>=threshold)
+        packed = selected[selected<len(occupied)]
+        escaped_codes = list(self.escaped.keys())
+        codes = np.array(decode_barcodes(self.keys[occupied[packed]]).tolist() + [escaped_codes[i-len(occupied)] for i in selected[len(packed):].tolist()], dtype=str)
+        freq, ids = freq[selected], ids[selected]
+        order = np.lexsort((ids, codes, freq))[::-1] # decreasing (freq, random_code, random_code_id)
+        if top!=None:
+            order = order[:top]
+        f = open(filename, "wt")
+        f.write("freq\trandom_code\trandom_code_id\n")
+        for i in order.tolist():
+            f.write("%s\t%s\t%s\n" % (freq[i], codes[i], ids[i]))
+        f.close()
+
+def string_keys(items):
+    """
+    64 bit keys of strings (numpy uint64 array): barcodes are packed with :func:`encode_barcodes` (vectorized, keys
+    are mixed by :func:`barcode_hash` in the sketch), only strings that can not be packed (N, longer than 31 nt) are
+    hashed one by one.
+    """
+    keys = encode_barcodes(items)
+    for i in np.flatnonzero(keys==0).tolist():
+        keys[i] = int.from_bytes(hashlib.blake2b(items[i].encode(), digest_size=8).digest(), "little")
+    return keys
+
+class CountMin:
+    """
+    Count-min sketch (depth rows of width counters) of item frequencies; estimates are upper bounds, the error is at
+    most total/width*e with probability 1-exp(-depth).
+    """
+
+    def __init__(self, width=1<<16, depth=4):
+        self.counts = np.zeros((depth, width), dtype=np.int64)
+
+    def columns(self, keys):
+        depth, width = self.counts.shape
+        return [(barcode_hash(keys ^ np.uint64(row+1)) % np.uint64(width)).astype(np.int64) for row in range(depth)]
+
+    def add(self, keys, counts):
+        width = self.counts.shape[1]
+        for row, columns in enumerate(self.columns(keys)):
+            self.counts[row] += np.bincount(columns, weights=counts, minlength=width).astype(np.int64)
+
+    def query(self, keys):
+        return np.min([self.counts[row][columns] for row, columns in enumerate(self.columns(keys))], axis=0)
+
+class HeavyHitters:
+    """
+    Approximate top k most frequent items (with a value per item, e.g. id) in bounded memory: frequencies are counted
+    with :class:`CountMin`, the k items with the highest estimates are kept. The lowest kept item is found with a
+    min-heap of (estimate, insertion number, item) entries; entries of updated or removed items are skipped when they
+    come up (lazy invalidation), so replacing an item is O(log k).
+    """
+
+    def __init__(self, k=1000, width=1<<16, depth=4):
+        self.k = k
+        self.sketch = CountMin(width=width, depth=depth)
+        self.top = {} # item -> [estimate, value, insertion number]
+        self.heap = []
+        self.inserted = 0
+        self.threshold = 0 # lowest estimate in top (when full)
+
+    def add(self, items, counts, values=None):
+        if len(items)==0:
+            return
+        keys = string_keys(items)
+        self.sketch.add(keys, np.asarray(counts, dtype=np.int64))
+        estimates = self.sketch.query(keys)
+        for i in np.flatnonzero(estimates>self.threshold).tolist():
+            item = items[i]
+            value = None if values is None else values[i]
+            if item not in self.top:
+                if len(self.top)>=self.k:
+                    del self.top[self.lowest()[2]]
+                    heapq.heappop(self.heap)
+                self.top[item] = [0, None, self.inserted]
+                self.inserted += 1
+            self.top[item][0] = int(estimates[i])
+            self.top[item][1] = value
+            heapq.heappush(self.heap, (self.top[item][0], self.top[item][2], item))
+            if len(self.heap)>4*self.k:
+                self.rebuild()
+            if len(self.top)==self.k:
+                self.threshold = self.lowest()[0]
+
+    def lowest(self):
+        """
+        Heap entry (estimate, insertion number, item) of the kept item with the lowest estimate (the first inserted on
+        equal estimates), stale entries on top of the heap are removed.
+        """
+        while len(self.heap)>0:
+            estimate, number, item = self.heap[0]
+            if item in self.top and self.top[item][0]==estimate and self.top[item][2]==number:
+                return self.heap[0]
+            heapq.heappop(self.heap)
+        return None
+
+    def rebuild(self):
+        """
+        Rebuild the heap from the kept items only (drop stale entries).
+        """
+        self.heap = [(estimate, number, item) for item, (estimate, _, number) in self.top.items()]
+        heapq.heapify(self.heap)
+
+    def items(self):
+        """
+        [(estimate, item, value), ...] sorted by decreasing estimate.
+        """
+        return sorted([(estimate, item, value) for item, (estimate, value, _) in self.top.items()], reverse=True)
+
+    def save(self, filename):
+        f = open(filename, "wb")
+        np.savez(f, counts=self.sketch.counts, k=np.array([self.k, self.threshold]), items=np.array(list(self.top.keys()), dtype=str), estimates=np.array([val[0] for val in self.top.values()], dtype=np.int64), values=np.array([-1 if val[1]==None else val[1] for val in self.top.values()], dtype=np.int64))
+        f.close()
+
+    def load(self, filename):
+        data = np.load(filename)
+        self.sketch.counts = data["counts"]
+        self.k, self.threshold = [int(x) for x in data["k"]]
+        self.top = dict((item, [estimate, None if value==-1 else value, number]) for number, (item, estimate, value) in enumerate(zip(data["items"].tolist(), data["estimates"].tolist(), data["values"].tolist())))
+        self.inserted = len(self.top)
+        self.rebuild()
+
+class SidecarWriter:
+    """
+    Per read sidecar file (value of read n at offset n*itemsize, zeros for reads without value), as read by
+    :class:`apa.annotation.ReadTable`. Values are buffered in a preallocated array of block_size reads and written
+    in contiguous blocks.
+    """
+
+    def __init__(self, filename, dtype, block_size=1<<20):
+        self.f = open(filename, "wb")
+        self.dtype = np.dtype(dtype)
+        self.block = np.zeros(block_size, dtype=self.dtype)
+        self.base = 0 # read number of block[0]
+        self.last = -1 # last index set in block
+
+    def set(self, read_number, value):
+        """
+        Set value of read_number; read numbers must not decrease below the current block (already written).
+        """
+        i = read_number - self.base
+        if i<0:
+            raise ValueError("%s: read %s set after read %s (read numbers must be increasing)" % (self.f.name, read_number, self.base))
+        if i>=len(self.block):
+            self.flush()
+            self.base = read_number
+            i = 0
+        self.block[i] = value
+        self.last = max(self.last, i)
+
+    def flush(self):
+        if self.last>=0:
+            self.f.seek(self.base*self.dtype.itemsize)
+            self.f.write(self.block[:self.last+1].tobytes())
+            self.block[:self.last+1] = 0
+        self.last = -1
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+class GzipWriter:
+    """
+    Text file writer with block parallel gzip compression: written text is collected into blocks of block_size bytes,
+    blocks are compressed as independent gzip members by a pool of threads (zlib releases the GIL) and appended to the
+    file in order. Concatenated gzip members are a valid gzip stream (zcat, STAR, salmon).
+
+    Writers of the same job can share one thread pool (pool, a concurrent.futures.ThreadPoolExecutor of threads
+    workers, shut down by the caller); without pool the writer starts its own pool of threads.
+    """
+
+    def __init__(self, filename, level=6, block_size=1<<22, threads=4, pool=None):
+        self.f = open(filename, "wb")
+        self.level = level
+        self.block_size = block_size
+        self.buffer = []
+        self.buffer_size = 0
+        self.own_pool = pool==None
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads) if pool==None else pool
+        self.pending = collections.deque()
+        self.max_pending = 2*threads
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffer_size += len(text)
+        if self.buffer_size>=self.block_size:
+            self.submit()
+
+    def submit(self):
+        if self.buffer_size>0:
+            self.pending.append(self.pool.submit(gzip.compress, "".join(self.buffer).encode(), self.level))
+            self.buffer = []
+            self.buffer_size = 0
+        while len(self.pending)>self.max_pending:
+            self.f.write(self.pending.popleft().result())
+
+    def close(self):
+        self.submit()
+        while len(self.pending)>0:
+            self.f.write(self.pending.popleft().result())
+        if self.f.tell()==0: # nothing written: empty gzip stream instead of a 0 byte file
+            self.f.write(gzip.compress(b"", self.level))
+        if self.own_pool:
+            self.pool.shutdown()
+        self.f.close()
+
+def process_lib_ok(library_id, force=False, rnd_top=None, compress_level=6):
 
     start_time = time.time()
 
@@ -34,25 +426,28 @@ def process_lib_ok(library_id, force=False):
     lib = apa.annotation.libs[library_id]
     demulti_codes = {}
     fastq_files = {}
+    # one compression pool for all writers of the library (apa.config.cores threads)
+    threads = max(1, apa.config.cores)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
     for exp_id, exp_data in lib.experiments.items():
         assert(demulti_codes.get(exp_data["dcode"], None)==None) # only allow unique demulti codes
         demulti_codes[exp_data["dcode"]] = exp_id
         experiment_folder = os.path.join(apa.path.data_folder, library_id, "e%s" % exp_id)
         if not os.path.exists(experiment_folder):
             os.makedirs(experiment_folder)
-        fastq_files[exp_id] = gzip.open(os.path.join(apa.path.data_folder, library_id, "e%s" % exp_id, "%s_e%s.fastq.gz" % (library_id, exp_id)), "w")
-    aremoved_file = open(os.path.join(apa.path.data_folder, library_id, "%s.aremoved.bin" % (library_id)), "wb")
-    rnd_file = open(os.path.join(apa.path.data_folder, library_id, "%s.rnd.bin" % (library_id)), "wb")
+        fastq_files[exp_id] = GzipWriter(os.path.join(apa.path.data_folder, library_id, "e%s" % exp_id, "%s_e%s.fastq.gz" % (library_id, exp_id)), level=compress_level, threads=threads, pool=pool)
+    aremoved_file = SidecarWriter(os.path.join(apa.path.data_folder, library_id, "%s.aremoved.bin" % (library_id)), np.uint8)
+    rnd_file = SidecarWriter(os.path.join(apa.path.data_folder, library_id, "%s.rnd.bin" % (library_id)), np.uint32)
 
     # take care of unmatched reads
     experiment_folder = os.path.join(apa.path.data_folder, library_id, "unmatched")
     if not os.path.exists(experiment_folder):
         os.makedirs(experiment_folder)
-    fastq_files["unmatched"] = gzip.open(os.path.join(apa.path.data_folder, library_id, "unmatched", "%s_unmatched.fastq.gz" % (library_id)), "w")
+    fastq_files["unmatched"] = GzipWriter(os.path.join(apa.path.data_folder, library_id, "unmatched", "%s_unmatched.fastq.gz" % (library_id)), level=compress_level, threads=threads, pool=pool)
 
-    db_random = {}
+    db_random = BarcodeTable()
+    pending = [] # (read_number, rnd_code) of reads waiting for random barcode ids
     read_number = 1 # number reads, starting with 1
-    rnd_code_number = 1 # number random barcodes, starting with 1
     unmatched_stats = {}
     lib_stats = {"all_reads" : 0}
 
@@ -78,18 +473,10 @@ def process_lib_ok(library_id, force=False):
             dcode = read_id.split("#")[-1][:lib.dcode_len] # experiment demulti code
             rnd_code = read_id.split("#")[-1][lib.dcode_len:] + sequence[:6]  # now: rnd_code #N from first_5 definition and first 6 nt of read
 
-            # for each rnd_code of the read, check if you already have it in the database
-            # if not, assign a new integer id
-            rnd_code_id, rnd_code_freq = db_random.get(rnd_code, (None, None))
-            if rnd_code_id==None:
-                db_random[rnd_code] = (rnd_code_number, 1)
-                rnd_code_id = rnd_code_number
-                rnd_code_number += 1
-            else:
-                rnd_code_freq += 1
-                db_random[rnd_code] = (rnd_code_id, rnd_code_freq)
-            rnd_file.seek(read_number*4)
-            rnd_file.write(struct.pack("I", rnd_code_id))
+            # random barcodes get integer ids (in order of first occurrence) in batches
+            pending.append((read_number, rnd_code))
+            if len(pending)>=100000:
+                store_barcodes(db_random, pending, rnd_file)
 
             exp_id = demulti_codes.get(dcode, "unmatched")
             lib_stats[exp_id] = lib_stats.get(exp_id, 0) + 1
@@ -98,32 +485,27 @@ def process_lib_ok(library_id, force=False):
 
             tail_len = len(f.sequence) - len(sequence)
             if tail_len>0:
-                aremoved_file.seek(read_number)
-                aremoved_file.write(struct.pack("B", tail_len))
+                aremoved_file.set(read_number, tail_len)
             fastq_files[exp_id].write("@%s\n%s\n+\n%s\n" % (read_number, sequence, quality))
 
             if f.count%100000==0:
                 num_reads = "%.1f" % (f.count/float(1000000))
-                num_bar = "%.1f" % (rnd_code_number/float(1000000))
+                num_bar = "%.1f" % (len(db_random)/float(1000000))
                 print("{library_id}, EXTRACT : {num_reads} M reads, unique random barcodes = {num_bar} M".format(library_id=library_id, num_reads=num_reads, num_bar=num_bar))
-                f_log.write(library_id + ": EXTRACT : %.1fM reads" % (f.count/float(1000000)) + ", unique random barcodes = %.1fM\n" % (rnd_code_number/float(1000000)))
+                f_log.write(library_id + ": EXTRACT : %.1fM reads" % (f.count/float(1000000)) + ", unique random barcodes = %.1fM\n" % (len(db_random)/float(1000000)))
 
             read_number += 1 # next read
 
+    store_barcodes(db_random, pending, rnd_file)
     aremoved_file.close()
     rnd_file.close()
 
     for f in fastq_files.values():
         f.close()
+    pool.shutdown()
 
     # write down random barcodes and their ids (just for readability)
-    rnd_txt_file = open(os.path.join(apa.path.data_folder, library_id, "%s.rnd.txt" % (library_id)), "wt")
-    rnd_txt_file.write("freq\trandom_code\trandom_code_id\n")
-    L = [(rnd_code_freq, rnd_code, rnd_code_id) for rnd_code, (rnd_code_id, rnd_code_freq) in db_random.items()]
-    L.sort(reverse=True)
-    for (rnd_code_freq, rnd_code, rnd_code_id) in L:
-        rnd_txt_file.write("%s\t%s\t%s\n" % (rnd_code_freq, rnd_code, rnd_code_id))
-    rnd_txt_file.close()
+    db_random.write(os.path.join(apa.path.data_folder, library_id, "%s.rnd.txt" % (library_id)), top=rnd_top)
 
     # print out unmatched code stats
     L = [(val, k) for k, val in unmatched_stats.items()]
@@ -151,25 +533,33 @@ def process_lib_ok(library_id, force=False):
 
 
 def remove_tail(sequence):
-    # 2. search for A rich region
-    for i in range(10, len(sequence)):
-        tail = sequence[i:i+tail_window]
-        tail_len = len(tail)
-        num_A = tail.count("A")
-        if tail.startswith("AAAAAAAAAAAAAAA"): # 15A? trim here
-            return i
-        if not tail.startswith("A"):
-            continue
-        if len(tail)>1 and not tail.startswith("AA"):
-            continue
-        if len(tail)>2 and not tail.startswith("AAA"):
-            continue
-        percentage_A = num_A / float(tail_len)
-        if percentage_A>=A_percentage:
-            return i
-    return N
-
-def process_lib(library_id, force=False):
+    """
+    Position of the poly-A tail in sequence (len(sequence) if there is none), see :func:`apa.trim.remove_tails`.
+    """
+    return apa.trim.remove_tail(sequence, window=tail_window, percentage=A_percentage)
+
+def process_lib(library_id, force=False, chunk_size=100000, rnd_top=None, compress_level=6, checkpoint_reads=10000000, sketch=False, sketch_top=1000):
+    """
+    Demultiplex FASTQ files of library_id into per experiment FASTQ files (reads numbered from 1 in input order) and store
+    random barcode ids of reads (${library_id}.rnd.bin).
+
+    The extraction is pipelined: the main process reads chunks of chunk_size reads, a pool of apa.config.cores workers
+    (:func:`extract_chunk`) demultiplexes and gzip compresses the chunks, and the main process appends the compressed
+    chunks (gzip members) to the experiment files in input order. Random barcode ids are assigned in the main process in
+    order of first occurrence (:class:`BarcodeTable`), so output is the same as with a single process. The random barcode
+    report (${library_id}.rnd.txt) lists all barcodes or only the rnd_top most frequent ones. FASTQ files are compressed
+    with gzip level compress_level.
+
+    Every checkpoint_reads reads a checkpoint is stored (status/extract.checkpoint, see :func:`save_checkpoint`). An
+    interrupted run continues from the last checkpoint when called again (only with the same input files and settings,
+    otherwise it starts from scratch); force=True starts from scratch. status/extract.status is written when the
+    extraction is complete. The run holds status/extract.lock (:class:`apa.bed.Lock`), a run of the library that is
+    still alive is never resumed or restarted.
+
+    With sketch=True the QC reports use bounded memory: frequencies of random barcodes and unmatched demulti codes are
+    estimated with :class:`HeavyHitters` and only the sketch_top (or rnd_top) most frequent are reported in rnd.txt
+    and demulti_codes.txt (same formats, frequencies are upper bound estimates). Barcode ids in rnd.bin stay exact.
+    """
 
     start_time = time.time()
 
@@ -177,17 +567,38 @@ def process_lib(library_id, force=False):
     # assert(check_unique_id(library_id)==True)
 
     status_folder = os.path.join(apa.path.data_folder, library_id, "status")
-
-    if os.path.exists(os.path.join(status_folder, "extract.status")) and force==False:
-        print("{library_id}: extract already processed or processing at the moment".format(library_id=library_id))
-        return False
-
     if not os.path.exists(status_folder):
         os.makedirs(status_folder)
-    f_log = open(os.path.join(status_folder, "extract.log"), "wt")
-    f_status = open(os.path.join(status_folder, "extract.status"), "wt")
-
+    # only one extraction of the library at a time, also a forced or resumed one (status/extract.lock)
+    lock = apa.bed.Lock(os.path.join(status_folder, "extract.lock"))
+    if not lock.acquire():
+        print("{library_id}: extract processing at the moment, locked by {lock}".format(library_id=library_id, lock=lock.filename))
+        return False
     lib = apa.annotation.libs[library_id]
+    # a checkpoint is only resumed with the same input files and settings
+    settings = {"fastq_files":list(lib.fastq_files), "dcode_len":lib.dcode_len, "dcodes":[[exp_id, exp_data["dcode"]] for exp_id, exp_data in lib.experiments.items()], "sketch":sketch, "sketch_top":(sketch_top if rnd_top==None else rnd_top) if sketch else None}
+    settings = json.loads(json.dumps(settings))
+    checkpoint_fname = os.path.join(status_folder, "extract.checkpoint")
+    status_fname = os.path.join(status_folder, "extract.status") # written when the extraction is complete
+    checkpoint = None
+    if os.path.exists(checkpoint_fname) and force==False:
+        checkpoint = json.load(open(checkpoint_fname, "rt"))
+        if checkpoint.get("settings", None)!=settings:
+            print("{library_id}: extract checkpoint of other input files or settings, starting from scratch".format(library_id=library_id))
+            checkpoint = None
+        else:
+            print("{library_id}: extract resumed after {read_number} reads".format(library_id=library_id, read_number=checkpoint["read_number"]))
+    elif os.path.exists(status_fname) and force==False:
+        print("{library_id}: extract already processed".format(library_id=library_id))
+        lock.release()
+        return False
+    if checkpoint==None:
+        remove_checkpoint(checkpoint_fname)
+        if os.path.exists(status_fname):
+            os.remove(status_fname)
+
+    f_log = open(os.path.join(status_folder, "extract.log"), "wt" if checkpoint==None else "at")
+
     demulti_codes = {}
     fastq_files = {}
     for exp_id, exp_data in lib.experiments.items():
@@ -196,81 +607,121 @@ def process_lib(library_id, force=False):
         experiment_folder = os.path.join(apa.path.data_folder, library_id, "e%s" % exp_id)
         if not os.path.exists(experiment_folder):
             os.makedirs(experiment_folder)
-        fastq_files[exp_id] = gzip.open(os.path.join(apa.path.data_folder, library_id, "e%s" % exp_id, "%s_e%s.fastq.gz" % (library_id, exp_id)), "w")
-    rnd_file = open(os.path.join(apa.path.data_folder, library_id, "%s.rnd.bin" % (library_id)), "wb")
+        fastq_files[exp_id] = os.path.join(apa.path.data_folder, library_id, "e%s" % exp_id, "%s_e%s.fastq.gz" % (library_id, exp_id))
+    fastq_files["rnd"] = os.path.join(apa.path.data_folder, library_id, "%s.rnd.bin" % (library_id))
 
     # take care of unmatched reads
     experiment_folder = os.path.join(apa.path.data_folder, library_id, "unmatched")
     if not os.path.exists(experiment_folder):
         os.makedirs(experiment_folder)
-    fastq_files["unmatched"] = gzip.open(os.path.join(apa.path.data_folder, library_id, "unmatched", "%s_unmatched.fastq.gz" % (library_id)), "w")
-
-    db_random = {}
+    fastq_files["unmatched"] = os.path.join(apa.path.data_folder, library_id, "unmatched", "%s_unmatched.fastq.gz" % (library_id))
+
+    # open outputs (on resume: cut outputs back to the checkpoint positions and continue writing)
+    for key, fname in fastq_files.items():
+        if checkpoint==None:
+            fastq_files[key] = open(fname, "wb")
+        else:
+            fastq_files[key] = open(fname, "r+b")
+            fastq_files[key].truncate(checkpoint["positions"][str(key)])
+            fastq_files[key].seek(0, os.SEEK_END)
+    rnd_file = fastq_files.pop("rnd")
+
+    db_random = BarcodeTable(counts=not sketch)
+    snapshots = {"barcodes":db_random}
+    if sketch:
+        snapshots["barcodes_top"] = HeavyHitters(k=sketch_top if rnd_top==None else rnd_top)
+        snapshots["unmatched_top"] = HeavyHitters(k=sketch_top)
     read_number = 0
-    rnd_code_number = 1 # number random barcodes, starting with 1
     unmatched_stats = {}
     lib_stats = {"all_reads" : 0}
-
-    for fastq_filename in lib.fastq_files: # iterate over all fastq files in library
-        print(fastq_filename)
-        f = pybio.data.Fastq(os.path.join(apa.path.data_folder, library_id, fastq_filename))
-        while f.read():
-            read_number += 1 # id of current read (starts with 1)
-            lib_stats["all_reads"] += 1
-            read_id = f.id.rstrip("/2")
-            sequence = f.sequence
-            quality = f.quality
-
-            if len(sequence)<min_read_length: # do not process too short reads
-                lib_stats["too_short"] = lib_stats.get("too_short", 0) + 1
+    if checkpoint!=None:
+        for name, snapshot in snapshots.items():
+            snapshot.load(checkpoint["snapshots"][name])
+        read_number = checkpoint["read_number"]
+        unmatched_stats = dict(checkpoint["unmatched_stats"])
+        lib_stats = dict((key, val) for key, val in checkpoint["lib_stats"])
+    checkpoint_at = [read_number + checkpoint_reads]
+
+    def store(result, fastq_index, file_reads):
+        start, codes, inverse, counts, chunk_stats, chunk_unmatched, members = result
+        # assign new ids to random barcodes in order of first occurrence
+        ids = np.zeros(len(codes)+1, dtype=np.uint32) # inverse==-1 (too short reads) -> id 0
+        ids[1:] = db_random.add(codes, counts)
+        if sketch:
+            snapshots["barcodes_top"].add(codes, counts, values=ids[1:].tolist())
+            snapshots["unmatched_top"].add(list(chunk_unmatched.keys()), list(chunk_unmatched.values()))
+            chunk_unmatched = {}
+        valid = np.flatnonzero(inverse>=0)
+        if len(valid)>0:
+            rnd_file.seek(start*4)
+            rnd_file.write(ids[inverse[:valid[-1]+1]+1].tobytes())
+        for key, val in chunk_stats.items():
+            lib_stats[key] = lib_stats.get(key, 0) + val
+        for key, val in chunk_unmatched.items():
+            unmatched_stats[key] = unmatched_stats.get(key, 0) + val
+        for exp_id, member in members.items():
+            fastq_files[exp_id].write(member)
+        num_reads = "%.1f" % (lib_stats["all_reads"]/float(1000000))
+        num_bar = "%.1f" % (len(db_random)/float(1000000))
+        print("{library_id}, EXTRACT : {num_reads} M reads, unique random barcodes = {num_bar} M".format(library_id=library_id, num_reads=num_reads, num_bar=num_bar))
+        f_log.write(library_id + ": EXTRACT : %sM reads" % num_reads + ", unique random barcodes = %sM\n" % num_bar)
+        last_read = start + len(inverse) - 1
+        if last_read>=checkpoint_at[0]:
+            files = dict(fastq_files)
+            files["rnd"] = rnd_file
+            save_checkpoint(checkpoint_fname, files, snapshots, {"settings":settings, "fastq_index":fastq_index, "file_reads":file_reads, "read_number":last_read, "lib_stats":list(lib_stats.items()), "unmatched_stats":list(unmatched_stats.items())})
+            checkpoint_at[0] = last_read + checkpoint_reads
+
+    # at most 2 chunks per worker are in memory, results are stored in input order
+    processes = max(1, apa.config.cores)
+    pool = multiprocessing.Pool(processes=processes, initializer=extract_init, initargs=(lib.dcode_len, demulti_codes, compress_level))
+    pending = collections.deque()
+    for fastq_index, fastq_filename in enumerate(lib.fastq_files): # iterate over all fastq files in library
+        skip = 0
+        if checkpoint!=None:
+            if fastq_index<checkpoint["fastq_index"]:
                 continue
-
-            dcode = read_id.split("#")[-1][:lib.dcode_len] # experiment demulti code
-            rnd_code = read_id.split("#")[-1][lib.dcode_len:] + sequence[:6]  # now: rnd_code #N from first_5 definition and first 6 nt of read
-
-            # for each rnd_code of the read, check if you already have it in the database
-            # if not, assign a new integer id
-            rnd_code_id, rnd_code_freq = db_random.get(rnd_code, (None, None))
-            if rnd_code_id==None:
-                db_random[rnd_code] = (rnd_code_number, 1)
-                rnd_code_id = rnd_code_number
-                rnd_code_number += 1
-            else:
-                rnd_code_freq += 1
-                db_random[rnd_code] = (rnd_code_id, rnd_code_freq)
-            rnd_file.seek(read_number*4)
-            rnd_file.write(struct.pack("I", rnd_code_id))
-
-            exp_id = demulti_codes.get(dcode, "unmatched")
-            lib_stats[exp_id] = lib_stats.get(exp_id, 0) + 1
-            if exp_id=="unmatched":
-                unmatched_stats[dcode] = unmatched_stats.get(dcode, 0) + 1
-            fastq_files[exp_id].write("@%s\n%s\n+\n%s\n" % (read_number, sequence, quality))
-
-            if f.count%100000==0:
-                num_reads = "%.1f" % (f.count/float(1000000))
-                num_bar = "%.1f" % (rnd_code_number/float(1000000))
-                print("{library_id}, EXTRACT : {num_reads} M reads, unique random barcodes = {num_bar} M".format(library_id=library_id, num_reads=num_reads, num_bar=num_bar))
-                f_log.write(library_id + ": EXTRACT : %.1fM reads" % (f.count/float(1000000)) + ", unique random barcodes = %.1fM\n" % (rnd_code_number/float(1000000)))
+            if fastq_index==checkpoint["fastq_index"]:
+                skip = checkpoint["file_reads"]
+        print(fastq_filename)
+        file_reads = skip
+        for chunk in fastq_chunks(os.path.join(apa.path.data_folder, library_id, fastq_filename), chunk_size, skip=skip):
+            file_reads += len(chunk)
+            pending.append((pool.apply_async(extract_chunk, ((read_number+1, chunk),)), fastq_index, file_reads))
+            read_number += len(chunk)
+            if len(pending)>=2*processes:
+                result, chunk_index, chunk_reads = pending.popleft()
+                store(result.get(), chunk_index, chunk_reads)
+    while len(pending)>0:
+        result, chunk_index, chunk_reads = pending.popleft()
+        store(result.get(), chunk_index, chunk_reads)
+    pool.close()
+    pool.join()
 
     # close files
     rnd_file.close()
 
     for f in fastq_files.values():
+        if f.tell()==0: # no reads: empty gzip stream instead of a 0 byte file (rejected by zcat and STAR)
+            f.write(gzip.compress(b"", compress_level))
         f.close()
 
     # write down random barcodes and their ids (just for readability)
-    rnd_txt_file = open(os.path.join(apa.path.data_folder, library_id, "%s.rnd.txt" % (library_id)), "wt")
-    rnd_txt_file.write("freq\trandom_code\trandom_code_id\n")
-    L = [(rnd_code_freq, rnd_code, rnd_code_id) for rnd_code, (rnd_code_id, rnd_code_freq) in db_random.items()]
-    L.sort(reverse=True)
-    for (rnd_code_freq, rnd_code, rnd_code_id) in L:
-        rnd_txt_file.write("%s\t%s\t%s\n" % (rnd_code_freq, rnd_code, rnd_code_id))
-    rnd_txt_file.close()
+    if sketch:
+        f = open(os.path.join(apa.path.data_folder, library_id, "%s.rnd.txt" % (library_id)), "wt")
+        f.write("freq\trandom_code\trandom_code_id\n")
+        for (rnd_code_freq, rnd_code, rnd_code_id) in snapshots["barcodes_top"].items():
+            f.write("%s\t%s\t%s\n" % (rnd_code_freq, rnd_code, rnd_code_id))
+        f.close()
+    else:
+        db_random.write(os.path.join(apa.path.data_folder, library_id, "%s.rnd.txt" % (library_id)), top=rnd_top)
 
     # print out unmatched code stats
-    L = [(val, k) for k, val in unmatched_stats.items()]
-    L.sort(reverse=True)
+    if sketch:
+        L = [(val, k) for (val, k, _) in snapshots["unmatched_top"].items()]
+    else:
+        L = [(val, k) for k, val in unmatched_stats.items()]
+        L.sort(reverse=True)
     f = open(os.path.join(apa.path.data_folder, library_id, "unmatched", "demulti_codes.txt"), "wt")
     f.write("# codes not matching any annotated experiment code\n")
     f.write("code\tfreq\n")
@@ -289,5 +740,103 @@ def process_lib(library_id, force=False):
 
     f_log.close()
     stop_time = time.time()
+    f_status = open(status_fname, "wt")
     f_status.write(library_id + " : time=%sm\n" % (int(stop_time-start_time)/60))
     f_status.close()
+    remove_checkpoint(checkpoint_fname)
+    lock.release()
+
+def save_checkpoint(filename, files, snapshots, state):
+    """
+    Store extraction state: input position (fastq_index, file_reads), read_number, stats, snapshots of the barcode
+    table and sketches (numbered .npz files) and the sizes of the output files (files are flushed first). The
+    checkpoint file is replaced atomically, snapshots of older checkpoints are removed afterwards.
+    """
+    previous = json.load(open(filename, "rt")) if os.path.exists(filename) else None
+    state["positions"] = {}
+    for key, f in files.items():
+        f.flush()
+        os.fsync(f.fileno())
+        state["positions"][str(key)] = f.tell()
+    state["number"] = 1 if previous==None else previous["number"]+1
+    state["snapshots"] = {}
+    for name, snapshot in snapshots.items():
+        state["snapshots"][name] = "%s.%s.%s.npz" % (filename, state["number"], name)
+        snapshot.save(state["snapshots"][name])
+    f = open(filename+".temp", "wt")
+    json.dump(state, f)
+    f.close()
+    os.rename(filename+".temp", filename)
+    if previous!=None:
+        remove_snapshots(previous)
+
+def remove_snapshots(state):
+    for snapshot_fname in state["snapshots"].values():
+        if os.path.exists(snapshot_fname):
+            os.remove(snapshot_fname)
+
+def remove_checkpoint(filename):
+    if os.path.exists(filename):
+        remove_snapshots(json.load(open(filename, "rt")))
+        os.remove(filename)
+
+def store_barcodes(db_random, pending, rnd_file):
+    """
+    Assign ids to random barcodes of pending reads [(read_number, rnd_code), ...] and store them to rnd_file.
+    """
+    if len(pending)==0:
+        return
+    ids = db_random.add([rnd_code for _, rnd_code in pending])
+    for (read_number, _), rnd_code_id in zip(pending, ids.tolist()):
+        rnd_file.set(read_number, rnd_code_id)
+    del pending[:]
+
+def fastq_chunks(filename, chunk_size, skip=0):
+    """
+    Yield lists of (read_id, sequence, quality) with chunk_size reads from FASTQ file, after skipping the first skip reads.
+    """
+    f = pybio.data.Fastq(filename)
+    for _ in range(skip):
+        f.read()
+    chunk = []
+    while f.read():
+        chunk.append((f.id, f.sequence, f.quality))
+        if len(chunk)==chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk)>0:
+        yield chunk
+
+def extract_init(dcode_len, demulti_codes, compress_level):
+    global extract_pars
+    extract_pars = (dcode_len, demulti_codes, compress_level)
+
+def extract_chunk(pars):
+    """
+    Demultiplex chunk of reads numbered from start. Returns random barcodes of the chunk in order of first occurrence
+    with their counts, index of barcode for each read (-1 for too short reads), stats and gzip compressed FASTQ text
+    per experiment.
+    """
+    start, chunk = pars
+    dcode_len, demulti_codes, compress_level = extract_pars
+    codes = {}
+    inverse = np.full(len(chunk), -1, dtype=np.int64)
+    stats = {"all_reads" : len(chunk)}
+    unmatched_stats = {}
+    texts = {}
+    for i, (read_id, sequence, quality) in enumerate(chunk):
+        read_id = read_id.rstrip("/2")
+        if len(sequence)<min_read_length: # do not process too short reads
+            stats["too_short"] = stats.get("too_short", 0) + 1
+            continue
+        dcode = read_id.split("#")[-1][:dcode_len] # experiment demulti code
+        rnd_code = read_id.split("#")[-1][dcode_len:] + sequence[:6]  # now: rnd_code #N from first_5 definition and first 6 nt of read
+        inverse[i] = codes.setdefault(rnd_code, len(codes))
+        exp_id = demulti_codes.get(dcode, "unmatched")
+        stats[exp_id] = stats.get(exp_id, 0) + 1
+        if exp_id=="unmatched":
+            unmatched_stats[dcode] = unmatched_stats.get(dcode, 0) + 1
+        texts.setdefault(exp_id, []).append("@%s\n%s\n+\n%s\n" % (start+i, sequence, quality))
+    counts = np.bincount(inverse[inverse>=0], minlength=len(codes))
+    members = dict((exp_id, gzip.compress("".join(lines).encode(), compress_level)) for exp_id, lines in texts.items())
+    return start, list(codes.keys()), inverse, counts, stats, unmatched_stats, members
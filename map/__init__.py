@@ -5,11 +5,12 @@ import pybio
 import sys
 import json
 import shutil
-import regex
 import gzip
+import pysam
 from queue import *
 from threading import *
 from multiprocessing import Process # http://stackoverflow.com/questions/4496680/python-threads-all-executing-on-a-single-core
+import multiprocessing
 
 def map_experiment(lib_id, exp_id, map_id = 1, force=False, mapper="star", cpu=1, minlen=0.66, append=""):
     lib = apa.annotation.libs[lib_id]
@@ -50,53 +51,144 @@ def map_experiment(lib_id, exp_id, map_id = 1, force=False, mapper="star", cpu=1
             pybio.map.star_pair(exp_data["map_to"], fastq_file1, fastq_file2, map_folder, "%s_e%s_m%s%s" % (lib_id, exp_id, map_id, append), cpu=cpu, minlen=minlen)
 
 def preprocess_lexfwd(lib_id):
-    threads = []
+    """
+    Preprocess (trim) raw FASTQ files of all lib_id experiments with a pool of apa.config.cores workers. Experiments
+    are scheduled largest FASTQ file first and workers take the next experiment as soon as they are free. Per
+    experiment stats are collected into the library report ${lib_id}_preprocess.tab.
+    """
+    tasks = []
     for exp_id, exp_data in apa.annotation.libs[lib_id].experiments.items():
-        t = Process(target=preprocess_lexfwd_thread, args=[exp_id, lib_id])
-        threads.append(t)
-
-    while len(threads)>0:
-        to_process = min(apa.config.cores, len(threads))
-        for i in range(to_process):
-            threads[i].start()
-        for i in range(to_process):
-            threads[i].join()
-        threads[:to_process] = []
-
-def preprocess_lexfwd_thread(exp_id, lib_id):
+        fastq_file_raw = apa.path.map_fastq_file_raw(lib_id, exp_id)
+        if os.path.exists(fastq_file_raw):
+            tasks.append((os.path.getsize(fastq_file_raw), exp_id))
+    if len(tasks)==0:
+        return
+    tasks.sort(key=lambda task: task[0], reverse=True)
+    pool = multiprocessing.Pool(processes=max(1, min(apa.config.cores, len(tasks))))
+    stats = {}
+    for exp_id, exp_stats in pool.imap_unordered(preprocess_lexfwd_task, [(exp_id, lib_id) for _, exp_id in tasks]):
+        stats[exp_id] = exp_stats
+    pool.close()
+    pool.join()
+
+    fname = os.path.join(apa.path.lib_folder(lib_id), "%s_preprocess.tab" % lib_id)
+    f = open(fname, "wt")
+    f.write("exp_id\tprocessed\tcut\tkept\tcut [%]\tkept [%]\n")
+    total = [0, 0, 0]
+    for exp_id in sorted(stats.keys()):
+        processed, cut, written = stats[exp_id]
+        total = [total[0]+processed, total[1]+cut, total[2]+written]
+        f.write("e%s\t%s\t%s\t%s\t%.2f\t%.2f\n" % (exp_id, processed, cut, written, float(cut)/max(1, processed)*100.0, float(written)/max(1, processed)*100.0))
+    f.write("all\t%s\t%s\t%s\t%.2f\t%.2f\n" % (total[0], total[1], total[2], float(total[1])/max(1, total[0])*100.0, float(total[2])/max(1, total[0])*100.0))
+    f.close()
+
+def preprocess_lexfwd_task(pars):
+    exp_id, lib_id = pars
+    return exp_id, preprocess_lexfwd_thread(exp_id, lib_id)
+
+def preprocess_lexfwd_thread(exp_id, lib_id, batch_size=10000, compress_level=6, fastq_file=None):
+    """
+    Trim raw FASTQ of experiment (see :func:`trim_lexfwd`) into fastq_file (default: the mapping FASTQ file, can also
+    be a named pipe) and store stats to ${lib_id}_e${exp_id}_preprocess.tab; returns (processed, cut, written).
+    """
     fastq_file_raw = apa.path.map_fastq_file_raw(lib_id, exp_id)
-    fastq_file = apa.path.map_fastq_file(lib_id, exp_id)
+    if fastq_file==None:
+        fastq_file = apa.path.map_fastq_file(lib_id, exp_id)
     if not os.path.exists(fastq_file_raw):
         return
-    processed, written, cut = 0, 0, 0
-    fout = gzip.open(fastq_file, "wb")
-    f = pybio.data.Fastq(fastq_file_raw)
-    prog = regex.compile(r'AAA(?:AAAAAAA){s<=2}') # first AAA, then 7A with possible 2 mismatches
-    while f.read():
-        processed += 1
-        i = prog.search(f.sequence)
-        if i!=None:
-            seq = f.sequence[:i.start(0)]
-            cut += 1
-        else:
-            seq = f.sequence
-        qual = f.quality[:len(seq)]
-        if len(seq)>12:
-            seq = seq[12:]
-            qual = qual[12:]
-        if len(seq)>10:
-            fout.write("%s\n%s\n+\n%s\n" % (f.id, seq, qual))
-            written += 1
-        if processed%100000==0:
-            sys.stdout.write("e%s, processed=%.2fM, cut=%s, kept=%s\n" % (exp_id, processed/1000000.0, "%.2f%%" % (float(cut)/processed*100.0), "%.2f%%" % (float(written)/processed*100.0)))
+    fout = apa.extract.GzipWriter(fastq_file, level=compress_level)
+    processed, cut, written = trim_lexfwd(fastq_file_raw, fout, exp_id, batch_size=batch_size)
     fout.close()
     fname = os.path.join(apa.path.data_folder, lib_id, "e%s" % exp_id, "%s_e%s_preprocess.tab" % (lib_id, exp_id))
     f = open(fname, "wt")
-    f.write("e%s\nprocessed=%.2fM\ncut=%s\nkept=%s" % (exp_id, processed/1000000.0, "%.2f%%" % (float(cut)/processed*100.0), "%.2f%%" % (float(written)/processed*100.0)))
+    f.write("e%s\nprocessed=%.2fM\ncut=%s\nkept=%s" % (exp_id, processed/1000000.0, "%.2f%%" % (float(cut)/max(1, processed)*100.0), "%.2f%%" % (float(written)/max(1, processed)*100.0)))
     f.close()
-    return
+    return (processed, cut, written)
+
+def trim_lexfwd(fastq_file_raw, fout, exp_id, batch_size=10000):
+    """
+    Cut reads at the first A-run (:func:`apa.trim.find_a_runs`), remove first 12 nt and write reads longer than 10 nt
+    to fout; returns (processed, cut, written).
+    """
+    processed, written, cut = 0, 0, 0
+    f = pybio.data.Fastq(fastq_file_raw)
+    reads = []
+    more = True
+    while more:
+        more = f.read()
+        if more:
+            reads.append((f.id, f.sequence, f.quality))
+        if len(reads)<batch_size and more:
+            continue
+        # first AAA, then 7A with possible 2 mismatches (regex AAA(?:AAAAAAA){s<=2})
+        starts = apa.trim.find_a_runs([sequence for _, sequence, _ in reads])
+        for (read_id, sequence, quality), i in zip(reads, starts):
+            processed += 1
+            if i!=None:
+                seq = sequence[:i]
+                cut += 1
+            else:
+                seq = sequence
+            qual = quality[:len(seq)]
+            if len(seq)>12:
+                seq = seq[12:]
+                qual = qual[12:]
+            if len(seq)>10:
+                fout.write("%s\n%s\n+\n%s\n" % (read_id, seq, qual))
+                written += 1
+            if processed%100000==0:
+                sys.stdout.write("e%s, processed=%.2fM, cut=%s, kept=%s\n" % (exp_id, processed/1000000.0, "%.2f%%" % (float(cut)/processed*100.0), "%.2f%%" % (float(written)/processed*100.0)))
+        reads = []
+    return (processed, cut, written)
+
+def map_experiment_stream(lib_id, exp_id, map_id=1, cpu=1, minlen=0.66, bed=False, compress_level=1, ip_filter=True, parallel=False, tile_size=None):
+    """
+    Trim and map lexfwd experiment in one pass: trimmed reads are written by a separate process into a named pipe
+    which is given to the aligner (STAR) instead of the trimmed FASTQ file, so the trimmed reads are never stored.
+    The pipe carries a fast (compress_level) gzip stream, the aligner reads it as any .fastq.gz file. Only lexfwd
+    experiments can be streamed (reads are trimmed with :func:`trim_lexfwd`).
+
+    With bed=True the R and T bedGraph files are made right after mapping in the same job (:func:`apa.bed.bed_raw`
+    with ip_filter, parallel and tile_size); bed_raw reads the BAM file written by the aligner.
+    """
+    exp_id = int(exp_id)
+    exp_data = apa.annotation.libs[lib_id].experiments[exp_id]
+    if exp_data["method"]!="lexfwd":
+        raise ValueError("%s_e%s : MAP (stream) : only lexfwd experiments can be streamed, method is %s" % (lib_id, exp_id, exp_data["method"]))
+    map_folder = apa.path.map_folder(lib_id, exp_id, map_id=map_id)
+    if not os.path.exists(map_folder):
+        os.makedirs(map_folder)
+    fifo = os.path.join(map_folder, "%s_e%s_m%s.stream.fastq.gz" % (lib_id, exp_id, map_id))
+    if os.path.exists(fifo):
+        os.remove(fifo)
+    os.mkfifo(fifo)
+    print("{lib_id}_e{exp_id} : MAP (stream) : {map_folder}".format(lib_id=lib_id, exp_id=exp_id, map_folder=map_folder))
+    writer = multiprocessing.Process(target=preprocess_lexfwd_thread, args=(exp_id, lib_id), kwargs={"compress_level":compress_level, "fastq_file":fifo})
+    bam_file = apa.path.bam_filename(lib_id, exp_id, map_id=map_id)
+    if os.path.exists(bam_file): # BAM of a previous run is not taken as the result of this one
+        os.remove(bam_file)
+    writer.start()
+    pybio.map.star(exp_data["map_to"], fifo, map_folder, "%s_e%s_m%s" % (lib_id, exp_id, map_id), cpu=cpu, minlen=minlen)
+    # the writer exits right after closing the pipe; still alive: the aligner stopped before reading all reads or
+    # never opened the pipe (writer blocks in open)
+    writer.join(60)
+    if writer.is_alive():
+        writer.terminate()
+    writer.join()
+    os.remove(fifo)
+    if writer.exitcode!=0:
+        raise RuntimeError("%s_e%s : MAP (stream) : trimming writer failed (exit code %s), aligner did not read all reads" % (lib_id, exp_id, writer.exitcode))
+    if not os.path.exists(bam_file):
+        raise RuntimeError("%s_e%s : MAP (stream) : aligner failed, BAM file missing: %s" % (lib_id, exp_id, bam_file))
+    if bed:
+        apa.bed.bed_raw(lib_id, exp_id, map_id=map_id, force=True, ip_filter=ip_filter, parallel=parallel, tile_size=tile_size)
 
 def stats_to_tab(lib_id, map_id=1, append=""):
+    """
+    Write the stats table from the stats JSON. #reads are the reads given to the aligner, #mapped the mapped
+    alignments of the BAM file (samtools idxstats, reads mapped to multiple loci are counted once per alignment), the
+    same units as samtools view -c (see :func:`stats_experiment_task`).
+    """
     fname_json = os.path.join(apa.path.lib_folder(lib_id), "%s_m%s%s.stats.json" % (lib_id, map_id, append))
     data = json.loads(open(fname_json).readline())
     fname = os.path.join(apa.path.lib_folder(lib_id), "%s_m%s%s.stats.tab" % (lib_id, map_id, append))
@@ -116,43 +208,108 @@ def stats_to_tab(lib_id, map_id=1, append=""):
     f.close()
 
 def stats(lib_id, map_id=1, append=""):
-    for exp_id, exp_data in apa.annotation.libs[lib_id].experiments.items():
-        stats_experiment(lib_id, exp_id, map_id=map_id)
-    return
+    """
+    Collect mapping statistics of all lib_id experiments with a pool of apa.config.cores workers (see
+    :func:`stats_experiment_task`); the stats JSON and table are written once per library.
+    """
+    tasks = [(lib_id, exp_id, map_id, append) for exp_id in apa.annotation.libs[lib_id].experiments.keys()]
+    pool = multiprocessing.Pool(max(1, min(apa.config.cores, len(tasks))))
+    results = pool.map(stats_experiment_task, tasks)
+    pool.close()
+    pool.join()
+    save_stats(lib_id, results, map_id=map_id, append=append)
 
 def stats_experiment(lib_id, exp_id, map_id=1, append=""):
-    lib = apa.annotation.libs[lib_id]
+    result = stats_experiment_task((lib_id, exp_id, map_id, append))
+    save_stats(lib_id, [result], map_id=map_id, append=append)
+
+def save_stats(lib_id, results, map_id=1, append=""):
+    """
+    Update the stats JSON with (exp_id, stats) results (experiments without a BAM file have stats None) and write the
+    stats table.
+    """
     fname_json = os.path.join(apa.path.lib_folder(lib_id), "%s_m%s%s.stats.json" % (lib_id, map_id, append))
-    map_folder = apa.path.map_folder(lib_id, exp_id, map_id=map_id, append=append)
-    bam_file = os.path.join(map_folder, "%s_e%s_m%s%s.bam" % (lib_id, exp_id, map_id, append))
-    if lib.seq_type=="single":
-        fastq_files = [apa.path.map_fastq_file(lib_id, exp_id, append=append)]
-    if lib.seq_type=="paired":
-        fastq_files = [apa.path.map_fastq_file(lib_id, exp_id, append="_R1"), apa.path.map_fastq_file(lib_id, exp_id, append="_R2")]
     if os.path.exists(fname_json):
         data = json.loads(open(fname_json).readline())
     else:
         data = {}
+    for exp_id, exp_stats in results:
+        if exp_stats!=None:
+            data[str(exp_id)] = exp_stats
+    f = open(fname_json, "wt")
+    f.write(json.dumps(data))
+    f.close()
+    stats_to_tab(lib_id, map_id=map_id, append=append)
+
+def stats_experiment_task(pars):
+    """
+    Mapping statistics of one experiment, without reading the alignments: mapped alignments from the BAM index
+    (:func:`bam_mapped`), number of reads given to the aligner from the STAR final log or, without a log, by reading
+    the FASTQ files. Returns (exp_id, {"num_reads", "map_reads"}).
+    """
+    lib_id, exp_id, map_id, append = pars
+    lib = apa.annotation.libs[lib_id]
+    map_folder = apa.path.map_folder(lib_id, exp_id, map_id=map_id, append=append)
+    bam_file = os.path.join(map_folder, "%s_e%s_m%s%s.bam" % (lib_id, exp_id, map_id, append))
     print("processing statistics: {lib_id}_e{exp_id}".format(lib_id=lib_id, exp_id=exp_id))
     if not os.path.exists(bam_file):
-        return
-    num_reads = 0
-    for fastq_file in fastq_files:
-        if not os.path.exists(fastq_file):
+        return (exp_id, None)
+    map_reads = bam_mapped(bam_file)
+    num_reads = None
+    log_files = glob.glob(os.path.join(map_folder, "%s_e%s_m%s%s*Log.final.out" % (lib_id, exp_id, map_id, append)))
+    if len(log_files)>0:
+        num_reads = star_log(log_files[0]).get("Number of input reads", None)
+        if num_reads!=None and lib.seq_type=="paired": # STAR counts read pairs, FASTQ files (R1 + R2) reads
+            num_reads *= 2
+    if num_reads==None:
+        if lib.seq_type=="single":
+            fastq_files = [apa.path.map_fastq_file(lib_id, exp_id, append=append)]
+        if lib.seq_type=="paired":
+            fastq_files = [apa.path.map_fastq_file(lib_id, exp_id, append="_R1"), apa.path.map_fastq_file(lib_id, exp_id, append="_R2")]
+        num_reads = 0
+        for fastq_file in fastq_files:
+            if os.path.exists(fastq_file):
+                num_reads += fastq_reads(fastq_file)
+    return (exp_id, {"num_reads":num_reads, "map_reads":map_reads})
+
+def star_log(fname):
+    """
+    Read counts (integer values) from the STAR Log.final.out file.
+    """
+    result = {}
+    for line in open(fname, "rt"):
+        line = line.split("|")
+        if len(line)!=2:
             continue
-        output, error = pybio.utils.Cmd("bzcat {fastq_file} | wc -l".format(fastq_file=fastq_file)).run()
-        temp_reads = output.split("\n")[0] # get last line of output
-        temp_reads = int(temp_reads)/4
-        num_reads += temp_reads
-    output, error = pybio.utils.Cmd("samtools view -c {bam_file}".format(bam_file=bam_file)).run()
-    map_reads = output.split("\n")[0] # get last line of output
-    map_reads = int(map_reads)
-    data[exp_id] = {"num_reads":num_reads, "map_reads":map_reads}
-    f = open(fname_json, "wt")
-    f.write(json.dumps(data))
+        key, val = line[0].strip(), line[1].strip()
+        if val.isdigit():
+            result[key] = int(val)
+    return result
+
+def bam_mapped(bam_file):
+    """
+    Number of mapped alignments from the BAM index (samtools idxstats), the index is created if missing. For BAM files
+    without unmapped records (STAR default) this is samtools view -c, without reading the alignments.
+    """
+    if not os.path.exists(bam_file+".bai"):
+        pysam.index(bam_file)
+    bam = pysam.AlignmentFile(bam_file)
+    map_reads = sum(x.mapped for x in bam.get_index_statistics())
+    bam.close()
+    return map_reads
+
+def fastq_reads(fastq_file):
+    """
+    Number of reads in the (gzip) FASTQ file.
+    """
+    num_lines = 0
+    f = gzip.open(fastq_file, "rb") if fastq_file.endswith(".gz") else open(fastq_file, "rb")
+    block = f.read(1<<20)
+    while block:
+        num_lines += block.count(b"\n")
+        block = f.read(1<<20)
     f.close()
-    stats_to_tab(lib_id)
-    return
+    return num_lines//4
 
 # make transcript expression table (salmon)
 def salmon(lib_id):
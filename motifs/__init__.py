@@ -43,6 +43,7 @@ def process(comps_id):
                 fasta_files[k] = open(fname, "wt")
 
     stats = Counter()
+    pas_regions = {} # -30..0 sequence of proximal and distal sites, for PAS stats (see pas_stats)
 
     f = open(tab_file, "rt")
     header = f.readline().replace("\r", "").replace("\n", "").split("\t")
@@ -79,6 +80,10 @@ def process(comps_id):
         seq_up = pybio.genomes.seq(genome, chr, strand, proximal_pos, start=-200, stop=200)
         seq_down = pybio.genomes.seq(genome, chr, strand, distal_pos, start=-200, stop=200)
 
+        for site, reg, seq in [("proximal", proximal_reg, seq_up), ("distal", distal_reg, seq_down)]:
+            pas_regions.setdefault((site, pair_type, reg), []).append(seq[170:200])
+            pas_regions.setdefault((site, "all", reg), []).append(seq[170:200])
+
         seq_proximal_distal = pybio.genomes.seq_direct(genome, chr, strand, proximal_pos, distal_pos)
         fasta_files["%s_%s" % (pair_type, proximal_reg)].write(">%s:%s %s%s:%s-%s\n%s\n" % (gene_id, gene_name, strand, chr, proximal_pos, distal_pos, seq_proximal_distal))
         fasta_files["%s_%s" % ("all", proximal_reg)].write(">%s:%s %s%s:%s-%s\n%s\n" % (gene_id, gene_name, strand, chr, proximal_pos, distal_pos, seq_proximal_distal))
@@ -118,8 +123,25 @@ def process(comps_id):
         for reg in ["repressed", "enhanced", "control"]:
             f_stats.write("%s\t%s\t%s\n" % (pair_type, reg, stats["%s.%s" % (reg, pair_type)]))
     f_stats.close()
+    pas_stats(os.path.join(dest_folder, "pas_stats.tab"), pas_regions)
     #dreme(comps_id)
 
+def pas_stats(filename, pas_regions):
+    """
+    Store PAS stats of sites: pas_regions maps (site, pair_type, reg) to -30..0 sequences of sites. For each key the number
+    of sites, sites with a PAS hexamer and sites by their strongest PAS hexamer (:func:`apa.pas.first_pas`) are written.
+    """
+    f_stats = open(filename, "wt")
+    f_stats.write("\t".join(["site", "pair_type", "reg", "sites", "PAS"] + apa.pas.PAS_hexamers)+"\n")
+    for site in ["proximal", "distal"]:
+        for pair_type in ["same", "composite", "skipped", "all"]:
+            for reg in ["repressed", "enhanced", "control"]:
+                hits = apa.pas.first_pas(pas_regions.get((site, pair_type, reg), []))
+                counts = Counter(hit[1] for hit in hits if hit!=None)
+                row = [site, pair_type, reg, len(hits), sum(counts.values())] + [counts[i] for i in range(len(apa.pas.PAS_hexamers))]
+                f_stats.write("\t".join(str(el) for el in row)+"\n")
+    f_stats.close()
+
 def dreme(comps_id):
     name_folder = "motifs"
     fasta_folder = os.path.join(apa.path.comps_folder, comps_id, name_folder, "fasta")
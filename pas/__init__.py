@@ -0,0 +1,112 @@
+"""
+Poly-A signal (PAS) hexamer scanner, shared by :mod:`apa.bed`, :mod:`apa.polya` and :mod:`apa.motifs`.
+
+Nucleotides are encoded with 2 bits and all hexamers of a sequence are read with a rolling code (4^6 values). A lookup
+table maps each code to the priority index of the PAS hexamer (position in PAS_hexamers) or -1, so all hits of all
+hexamers are found in one pass. :func:`scan` processes many sequences at once, :func:`hits` and :func:`match_pas` are
+the single sequence versions.
+"""
+
+import numpy as np
+
+# Gruber et al.
+PAS_hexamers = ['AATAAA', 'ATTAAA', 'TATAAA', 'AGTAAA', 'AATACA', 'CATAAA', 'AATATA', 'GATAAA', 'AATGAA', 'AAGAAA', 'ACTAAA', 'AATAGA', 'AATAAT', 'AACAAA', 'ATTACA', 'ATTATA', 'AACAAG', 'AATAAG']
+
+nt_codes = np.full(256, 4, dtype=np.int64) # other than ACGT (also lower case): 4
+for i, nt in enumerate("ACGT"):
+    nt_codes[ord(nt)] = i
+
+def hexamer_code(h):
+    c = 0
+    for nt in h:
+        c = c*4 + "ACGT".index(nt)
+    return c
+
+def reverse_complement(seq):
+    return seq[::-1].translate(str.maketrans("ACGT", "TGCA"))
+
+def pas_hexamers(strand="+"):
+    """
+    PAS hexamers in priority order, reverse complements for strand -.
+    """
+    if strand=="+":
+        return list(PAS_hexamers)
+    return [reverse_complement(h) for h in PAS_hexamers]
+
+def pas_table(strand="+"):
+    """
+    Lookup table of 4^6 hexamer codes: priority index of the PAS hexamer (on strand), -1 for other hexamers.
+    """
+    table = np.full(4**6, -1, dtype=np.int64)
+    for i, h in enumerate(pas_hexamers(strand)):
+        table[hexamer_code(h)] = i
+    return table
+
+pas_tables = {"+":pas_table("+"), "-":pas_table("-")}
+
+# weights of the 6 nucleotides in a hexamer code (np.convolve reverses them: first nucleotide 4^5)
+hexamer_weights = 4**np.arange(6, dtype=np.int64)
+
+def hexamer_codes(seq):
+    """
+    Rolling codes of all hexamers in seq; returns (codes, valid) arrays of length len(seq)-5, valid is False for
+    hexamers with other nucleotides than ACGT.
+    """
+    code = nt_codes[np.frombuffer(seq.encode("latin-1", "replace"), dtype=np.uint8)]
+    if len(code)<6:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+    codes = np.convolve(np.minimum(code, 3), hexamer_weights, "valid")
+    valid = np.convolve(code==4, np.ones(6, dtype=np.int64), "valid")==0
+    return codes, valid
+
+def scan(sequences, strand="+", start=0, stop=None):
+    """
+    All PAS hexamer hits in sequences, only hexamers inside [start, stop) of each sequence; returns arrays (sequence
+    index, position, priority index) sorted by sequence index and position.
+    """
+    if len(sequences)==0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+    offsets = np.cumsum(lengths+1) - (lengths+1) # sequences are separated by N
+    codes, valid = hexamer_codes("N".join(sequences))
+    index = np.where(valid, pas_tables[strand][codes], -1)
+    found = np.flatnonzero(index>=0)
+    seq_index = np.searchsorted(offsets, found, side="right")-1
+    positions = found - offsets[seq_index]
+    keep = positions>=start
+    if stop!=None:
+        keep &= positions+6<=np.minimum(stop, lengths[seq_index])
+    return seq_index[keep], positions[keep], index[found[keep]]
+
+def hits(seq, strand="+", start=0, stop=None):
+    """
+    All PAS hexamer hits in seq[start:stop] as list of (position, hexamer, priority index), sorted by position.
+    """
+    stop = len(seq) if stop==None else min(stop, len(seq))
+    codes, valid = hexamer_codes(seq)
+    index = np.where(valid, pas_tables[strand][codes], -1)
+    found = np.flatnonzero(index[start:max(start, stop-5)]>=0) + start
+    hexamers = pas_hexamers(strand)
+    return [(pos, hexamers[i], i) for pos, i in zip(found.tolist(), index[found].tolist())]
+
+def match_pas(seq, strand="+"):
+    """
+    True if seq contains any PAS hexamer.
+    """
+    codes, valid = hexamer_codes(seq)
+    return bool(np.any(valid & (pas_tables[strand][codes]>=0)))
+
+def first_pas(sequences, strand="+", start=0, stop=None):
+    """
+    Strongest PAS of each sequence (hexamer inside [start, stop)): (hexamer, priority index, position) of the hexamer
+    with the lowest priority index, at its first position; None if there is no PAS hexamer.
+    """
+    seq_index, positions, index = scan(sequences, strand=strand, start=start, stop=stop)
+    result = [None] * len(sequences)
+    hexamers = pas_hexamers(strand)
+    order = np.lexsort((positions, index, seq_index))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = seq_index[order][1:]!=seq_index[order][:-1]
+    for i, pos, pas in zip(seq_index[order][first].tolist(), positions[order][first].tolist(), index[order][first].tolist()):
+        result[i] = (hexamers[pas], pas, pos)
+    return result
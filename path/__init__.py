@@ -88,6 +88,32 @@ def polyadb_filename(poly_id, poly_type=None, filetype="bed"):
         return os.path.join(apa.path.polya_folder, "%s.pdf" % poly_id)
     return os.path.join(apa.path.polya_folder, "%s.%s" % (poly_id, filetype))
 
+def ip_mask_filename(genome, chr, strand):
+    """
+    Returns constructed path to the internal priming bitmap of genome, chr and strand (see :func:`apa.bed.ip_mask_build`):
+
+    .. code-block:: bash
+
+        ${pybio_folder}/genomes/${genome}.ip_mask/${chr}.plus.bin
+        ${pybio_folder}/genomes/${genome}.ip_mask/${chr}.minus.bin
+    """
+    return os.path.join(apa.path.pybio_folder, "genomes", "%s.ip_mask" % genome, "%s.%s.bin" % (chr, {"+":"plus", "-":"minus"}[strand]))
+
+def polyadb_accumulator_filename(poly_id, chr=None, strand=None):
+    """
+    Returns constructed path to the atlas accumulator state of poly_id or, if chr and strand are given, to the
+    accumulator part of chr and strand (see :func:`apa.polya.update`):
+
+    .. code-block:: bash
+
+        ${polya_folder}/${poly_id}.accumulator/state.json
+        ${polya_folder}/${poly_id}.accumulator/${chr}.plus.npz
+        ${polya_folder}/${poly_id}.accumulator/${chr}.minus.npz
+    """
+    if chr==None:
+        return os.path.join(apa.path.polya_folder, "%s.accumulator" % poly_id, "state.json")
+    return os.path.join(apa.path.polya_folder, "%s.accumulator" % poly_id, "%s.%s.npz" % (chr, {"+":"plus", "-":"minus"}[strand]))
+
 def polyadb_ann_filename(species):
     return os.path.join(apa.path.polya_folder, "polyadb.%s.tab.gz" % species)
 
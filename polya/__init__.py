@@ -8,6 +8,11 @@ import glob
 import gzip
 import numpy as np
 import shutil
+import heapq
+import bisect
+import itertools
+import multiprocessing
+import json
 import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
@@ -18,8 +23,16 @@ mpl.rcParams['xtick.labelsize'] = 10
 mpl.rcParams['ytick.labelsize'] = 10
 mpl.rcParams['legend.fontsize'] = 9
 
-# Gruber et al.
-PAS_hexamers = ['AATAAA', 'ATTAAA', 'TATAAA', 'AGTAAA', 'AATACA', 'CATAAA', 'AATATA', 'GATAAA', 'AATGAA', 'AAGAAA', 'ACTAAA', 'AATAGA', 'AATAAT', 'AACAAA', 'ATTACA', 'ATTATA', 'AACAAG', 'AATAAG']
+interval_types = {"3":"3utr", "5": "5utr", "o":"orf", "i":"intron"}
+
+# minimal cDNA (raw) of atlas sites, default 10
+cDNA_filters = {"hg19_derti":0, "hg19_tian":0}
+
+# sites closer than block_size nt are read from the genome together (see site_sequences)
+block_size = 100000
+
+# sorted gene intervals by species, built once per process (see gene_lookup)
+gene_intervals_db = {}
 
 def get_species(poly_id):
     if poly_id in ["hg19_tian", "hg19_derti"]:
@@ -49,21 +62,11 @@ def make_config(lib_id):
         f.write("%s_e%s\n" % (lib_id, exp_id))
     f.close()
 
-def process(poly_id, map_id=1, min_distance=25):
+def poly_experiments(poly_id):
     """
-    Creates polyA database.
-    It loads multiple experiments (T files). Scales each experiment individually and adds up the raw counts and the scaled values.
-    Also, each experiment is identified with an id (filename). All this is done by pybio.data.Bedgraph.load()
-    cpm: counts per milion: when scaled, each experiment position if tested: scale vaue >= cpm, and file id is added to the "support" database accordingly
-    After all T files are combined and read into the master bed file, clustering is performed on raw data, scale data, support data and meta data.
-
-    bed.save(polyadb_filename+".%02gmincDNA.%03gcpm" % (min_cDNA, cpm), db_filter="support", db_save="raw", min_cDNA=min_cDNA)
-
-    This saves all positions where the minimal number of experiments that contributed to the position >= min_cDNA. This is the filtering, but
-    raw data (sum of all experiments) is saved.
+    List of (lib_id, exp_id) of poly_id: all experiments mapped to the genome if poly_id is a genome assembly name,
+    otherwise the experiments listed in the poly_id config file.
     """
-    species = get_species(poly_id)
-
     experiments = []
     if poly_id in pybio.genomes.genomes_list():
         # is the poly_id a genome assembly name?
@@ -81,26 +84,482 @@ def process(poly_id, map_id=1, min_distance=25):
             lib_id = "_".join(r.split("_")[:-1])
             exp_id = int(r.split("_")[-1][1:])
             experiments.append((lib_id, exp_id))
-            map_to = apa.annotation.libs[lib_id].experiments[exp_id]["map_to"]
             r = f.readline()
         f.close()
+    return experiments
+
+def process(poly_id, map_id=1, min_distance=25, min_support=1, max_open=500):
+    """
+    Creates polyA database.
 
-    bed = pybio.data.Bedgraph()
-    num_read = 0
+    The T files of all poly_id experiments are combined by a streaming k-way merge (:func:`merge_tails`): raw counts
+    of each position are summed up and the number of experiments with reads at the position (support) is counted on
+    the fly. Positions with support >= min_support are then filtered by a sweep (:func:`filter_sites`): going down
+    the positions by raw count, only positions that are min_distance apart are kept (same as
+    pybio.data.Bedgraph.filter). Only the current cluster of positions is held in memory, regardless of the number of
+    experiments. At most max_open T files are merged at once, more experiments are first merged in batches.
+
+    Merged sites are stored to the atlas accumulator, one part per chromosome and strand (:func:`save_parts`), which
+    are filtered and annotated by a pool of apa.config.cores workers (:func:`annotate_parts`). The accumulator is kept
+    for incremental updates of the atlas (:func:`update`).
+    """
+    experiments = poly_experiments(poly_id)
+    polyadb_temp = apa.path.polyadb_filename(poly_id, filetype="temp")
+    # merged sites are split into chromosome/strand parts, filtered and annotated in parallel
+    accumulator_folder = os.path.dirname(apa.path.polyadb_accumulator_filename(poly_id))
+    if os.path.exists(accumulator_folder):
+        shutil.rmtree(accumulator_folder)
+    os.makedirs(accumulator_folder)
+    sites, batch_filenames = merge_experiments(experiments, polyadb_temp, map_id=map_id, max_open=max_open, label=poly_id)
+    groups = save_parts(sites, poly_id)
+    for batch_filename in batch_filenames:
+        os.remove(batch_filename)
+    state = {"map_id":map_id, "min_distance":min_distance, "min_support":min_support, "groups":groups, "experiments":{}}
     for lib_id, exp_id in experiments:
-        num_read += 1
-        meta = ["%s_e%s" % (lib_id, exp_id)] # list of metadata
         t_filename = apa.path.t_filename(lib_id, exp_id, map_id=map_id)
-        print(t_filename)
         if os.path.exists(t_filename):
-            bed.load(t_filename, meta=meta)
-            print("%s: %s %s %s %s %.2fM" % (num_read, lib_id, exp_id, poly_id, os.path.exists(t_filename), bed.total_raw/1000000.0))
+            state["experiments"]["%s_e%s" % (lib_id, exp_id)] = t_fingerprint(t_filename)
+    annotate_parts(poly_id, [("%s.%s.%s" % (polyadb_temp, chr, strand), (chr, strand), min_distance, min_support) for chr, strand in groups])
+    save_state(poly_id, state)
 
-    #bed.filter(min_distance=25) # Gregor: alternative: -25..25 (201702 test)
-    bed.filter(min_distance=min_distance)
-    bed.save(apa.path.polyadb_filename(poly_id, filetype="temp"), db_save="raw")
+def merge_experiments(experiments, temp_filename, map_id=1, max_open=500, label=""):
+    """
+    Streaming k-way merge of the T files of experiments (:func:`merge_tails`); returns (sites, batch filenames), the
+    batch files (temp_filename.*) are to be removed after sites were read.
+
+    T files written by :func:`apa.bed.bed_raw` are streamed if their BAM references are in the common chromosome order
+    (:func:`chromosome_order`, checked up front with :func:`reference_order`). Other T files (older runs, BAM files with
+    another reference order or without BAM file) are sorted one at a time to batch files. At most max_open files are
+    merged at once, more files are first merged in batches.
+    """
+    chr_rank = chromosome_order(experiments, map_id=map_id)
+    t_filenames = []
+    streamed = []
+    for num_read, (lib_id, exp_id) in enumerate(experiments):
+        t_filename = apa.path.t_filename(lib_id, exp_id, map_id=map_id)
+        print("%s: %s %s %s %s" % (num_read+1, lib_id, exp_id, label, os.path.exists(t_filename)))
+        if not os.path.exists(t_filename):
+            continue
+        t_filenames.append(t_filename)
+        in_order = reference_order(apa.path.bam_filename(lib_id, exp_id, map_id=map_id), chr_rank)
+        if tail_streamed(t_filename) and not in_order:
+            print("%s: %s %s references not in common chromosome order, T file is sorted in memory" % (label, lib_id, exp_id))
+        streamed.append(tail_streamed(t_filename) and in_order)
+
+    batch_filenames = []
+    # T files that can not be streamed are sorted one at a time to batch files, the merge then streams all
+    for i, t_filename in enumerate(t_filenames):
+        if not streamed[i]:
+            batch_filename = "%s.sorted%s" % (temp_filename, i)
+            save_sites(tail_sites(t_filename, chr_rank, presorted=False), batch_filename)
+            batch_filenames.append(batch_filename)
+            t_filenames[i] = batch_filename
+    while len(t_filenames)>max_open:
+        batch_filename = "%s.batch%s" % (temp_filename, len(batch_filenames))
+        save_sites(merge_tails([tail_sites(t_filename, chr_rank, presorted=True) for t_filename in t_filenames[:max_open]]), batch_filename)
+        batch_filenames.append(batch_filename)
+        t_filenames = [batch_filename] + t_filenames[max_open:]
+    return merge_tails([tail_sites(t_filename, chr_rank, presorted=True) for t_filename in t_filenames]), batch_filenames
+
+def reference_order(bam_filename, chr_rank):
+    """
+    True if the references of bam_filename are in chr_rank order (T files written in BAM reference order can then be
+    merged as they are); False if they are not or if there is no BAM file.
+    """
+    if not os.path.exists(bam_filename):
+        return False
+    bam_file = pysam.AlignmentFile(bam_filename)
+    ranks = [chr_rank.get(chr, len(chr_rank)) for chr in bam_file.references]
+    bam_file.close()
+    return all(ranks[i]<ranks[i+1] for i in range(len(ranks)-1))
 
-    annotate(poly_id)
+def chromosome_order(experiments, map_id=1):
+    """
+    Returns dictionary chr -> rank: order of references in the BAM files of experiments, T files are written in this
+    order (:func:`apa.bed.bed_raw`). Chromosomes missing from the BAM headers are ranked after, in order of appearance.
+    """
+    chr_rank = {}
+    for lib_id, exp_id in experiments:
+        bam_filename = apa.path.bam_filename(lib_id, exp_id, map_id=map_id)
+        if not os.path.exists(bam_filename):
+            continue
+        bam_file = pysam.AlignmentFile(bam_filename)
+        for chr in bam_file.references:
+            chr_rank.setdefault(chr, len(chr_rank))
+        bam_file.close()
+    return chr_rank
+
+def tail_sites(t_filename, chr_rank, presorted=False):
+    """
+    Reads bedGraph t_filename and yields (chr_rank, strand, pos, raw, support, chr) sorted by (chr_rank, strand, pos);
+    strand is 0 for + and 1 for -, support is 1 or read from the 5th column (batches written by :func:`save_sites`).
+
+    Presorted files (T files written by :func:`apa.bed.bed_raw` in chr_rank order, batches) are streamed and raise
+    ValueError if a site is out of order, other files are sorted in memory.
+    """
+    def sites():
+        f = gzip.open(t_filename, "rt")
+        for r in f:
+            if r.startswith("track") or r.startswith("#"):
+                continue
+            r = r.rstrip("\r\n").split("\t")
+            if r==[""]:
+                continue
+            raw = float(r[3])
+            if raw==int(raw):
+                raw = int(raw)
+            strand = 0 if raw>=0 else 1
+            support = int(r[4]) if len(r)>4 else 1
+            if r[0] not in chr_rank:
+                chr_rank[r[0]] = len(chr_rank)
+            for pos in range(int(r[1]), int(r[2])):
+                yield (chr_rank[r[0]], strand, pos, abs(raw), support, r[0])
+        f.close()
+    if not presorted:
+        for site in sorted(sites()):
+            yield site
+        return
+    last = None
+    for site in sites():
+        if last!=None and site[:3]<=last[:3]:
+            raise ValueError("%s : sites not sorted in chromosome order (%s:%s after %s:%s)" % (t_filename, site[5], site[2], last[5], last[2]))
+        last = site
+        yield site
+
+def tail_streamed(t_filename):
+    """
+    True if T file was written by :func:`apa.bed.bed_raw` (it has a manifest), sites are then in BAM reference order.
+    """
+    return os.path.exists(apa.bed.manifest_filename(t_filename))
+
+def merge_tails(readers):
+    """
+    k-way merge of sorted T file readers (:func:`tail_sites`), yields (chr_rank, strand, pos, raw, support, chr) with
+    raw and support summed over files for each position.
+    """
+    last = None
+    for site in heapq.merge(*readers):
+        if last!=None and site[:3]==last[:3]:
+            last = last[:3] + (last[3]+site[3], last[4]+site[4], last[5])
+            continue
+        if last!=None:
+            yield last
+        last = site
+    if last!=None:
+        yield last
+
+def filter_sites(sites, min_distance=25):
+    """
+    Sweep over sorted sites (:func:`merge_tails`): positions of the same chromosome and strand that are at most
+    min_distance apart form a cluster. In each cluster positions are taken by raw count (descending; on equal counts
+    the downstream position first) and a position is kept if no kept position is within min_distance. Yields kept
+    sites in sorted order.
+    """
+    cluster = []
+    for site in sites:
+        if len(cluster)>0 and (site[:2]!=cluster[-1][:2] or site[2]-cluster[-1][2]>min_distance):
+            for kept in filter_cluster(cluster, min_distance):
+                yield kept
+            cluster = []
+        cluster.append(site)
+    for kept in filter_cluster(cluster, min_distance):
+        yield kept
+
+def filter_cluster(cluster, min_distance):
+    if len(cluster)==1:
+        return cluster
+    mp = 1 if cluster[0][1]==0 else -1 # if same value, take downstream position first
+    positions = [site[2] for site in cluster]
+    order = sorted(range(len(cluster)), key=lambda i: (cluster[i][3], mp*positions[i]), reverse=True)
+    removed = [False] * len(cluster)
+    kept = []
+    for i in order:
+        if removed[i]:
+            continue
+        kept.append(i)
+        for j in range(bisect.bisect_left(positions, positions[i]-min_distance), bisect.bisect_right(positions, positions[i]+min_distance)):
+            removed[j] = True
+    return [cluster[i] for i in sorted(kept)]
+
+def save_sites(sites, filename):
+    """
+    Write sorted sites to gzip bedGraph filename (batch file), with support in the 5th column.
+    """
+    f = gzip.open(filename, "wt")
+    write_sites(sites, f, support=True)
+    f.close()
+
+def write_sites(sites, f, support=False):
+    """
+    Write sorted sites as bedGraph lines to open file f. Without support, runs of equal raw values at consecutive
+    positions are written as one line (as pybio.data.Bedgraph.save).
+    """
+    start, last = None, None
+    for site in sites:
+        if last!=None and (site[:2]!=last[:2] or site[2]!=last[2]+1 or site[3]!=last[3] or support):
+            f.write(site_line(start, last, support))
+            start = None
+        if start==None:
+            start = site[2]
+        last = site
+    if last!=None:
+        f.write(site_line(start, last, support))
+
+def site_line(start, site, support=False):
+    """
+    bedGraph line of site covering start..site position (with support in the 5th column if support is True).
+    """
+    strand_str = "" if site[1]==0 else "-"
+    raw = "%s%.5f" % (strand_str, site[3]) if type(site[3])==float else "%s%s" % (strand_str, site[3])
+    if support:
+        return "%s\t%s\t%s\t%s\t%s\n" % (site[5], start, site[2]+1, raw, site[4])
+    return "%s\t%s\t%s\t%s\n" % (site[5], start, site[2]+1, raw)
+
+def save_parts(sites, poly_id):
+    """
+    Store sorted merged sites to the poly_id accumulator, one part per chromosome and strand (:func:`save_accumulator`);
+    returns list of [chr, strand] ordered by :func:`group_order`.
+    """
+    groups = []
+    for (_, strand), group_sites in itertools.groupby(sites, key=lambda site: site[:2]):
+        positions, raws, supports = [], [], []
+        for site in group_sites:
+            positions.append(site[2])
+            raws.append(site[3])
+            supports.append(site[4])
+        groups.append([site[5], "+-"[strand]])
+        save_accumulator(poly_id, site[5], "+-"[strand], np.array(positions, dtype=np.int64), np.array(raws, dtype=np.float64), np.array(supports, dtype=np.int64))
+    return sorted(groups, key=group_order)
+
+def group_order(group):
+    """
+    Sort key of [chr, strand] parts: chromosomes in natural order (:func:`apa.bed.chr_order`, as the chromosomes of
+    pybio.data.Bedgraph.save), + strand first. The polyadb files are written in this order.
+    """
+    chr, strand = group
+    return (apa.bed.chr_order(chr), "+-".index(strand))
+
+def row_order(key):
+    """
+    Sort key of polyadb rows (chr, strand, pos) as yielded by :func:`polyadb_rows`, same order as :func:`group_order`.
+    """
+    return (apa.bed.chr_order(key[0]), key[1], key[2])
+
+def load_accumulator(poly_id, chr, strand):
+    """
+    Returns (positions, raws, supports) arrays of accumulator part chr, strand (empty arrays if there is none).
+    """
+    fname = apa.path.polyadb_accumulator_filename(poly_id, chr=chr, strand=strand)
+    if not os.path.exists(fname):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64), np.zeros(0, dtype=np.int64)
+    data = np.load(fname)
+    return data["positions"], data["raws"], data["supports"]
+
+def save_accumulator(poly_id, chr, strand, positions, raws, supports):
+    fname = apa.path.polyadb_accumulator_filename(poly_id, chr=chr, strand=strand)
+    if len(positions)==0:
+        if os.path.exists(fname):
+            os.remove(fname)
+        return
+    np.savez(fname+".temp.npz", positions=positions, raws=raws, supports=supports)
+    os.rename(fname+".temp.npz", fname)
+
+def accumulator_sites(chr, strand, positions, raws, supports):
+    """
+    Yields sites (chr_rank, strand, pos, raw, support, chr) of accumulator part arrays, raw is int if integral (as in
+    :func:`tail_sites`).
+    """
+    strand = "+-".index(strand)
+    for pos, raw, support in zip(positions.tolist(), raws.tolist(), supports.tolist()):
+        if raw==int(raw):
+            raw = int(raw)
+        yield (0, strand, pos, raw, support, chr)
+
+def load_state(poly_id):
+    fname = apa.path.polyadb_accumulator_filename(poly_id)
+    if not os.path.exists(fname):
+        return None
+    return json.loads(open(fname, "rt").read())
+
+def save_state(poly_id, state):
+    fname = apa.path.polyadb_accumulator_filename(poly_id)
+    f = open(fname+".temp", "wt")
+    f.write(json.dumps(state))
+    f.close()
+    os.rename(fname+".temp", fname)
+
+def t_fingerprint(t_filename):
+    stat = os.stat(t_filename)
+    return [t_filename, stat.st_size, stat.st_mtime_ns]
+
+def update(poly_id, map_id=1, min_distance=25, min_support=1):
+    """
+    Incremental update of the poly_id atlas after experiments were added to or removed from poly_id (config file or
+    experiments mapped to the genome). The atlas accumulator (raw sum and support of each position, written by
+    :func:`process`) is updated with the T files of added (removed) experiments only. Clustering (:func:`filter_sites`)
+    is recomputed only for clusters with changed positions and only sites of those clusters are re-annotated, other
+    rows of the polyadb tab, bed and fasta files are copied (annotation of sites already in the atlas is reused).
+    The result is the same as rebuilding the atlas with :func:`process`.
+
+    The atlas is rebuilt with :func:`process` (map_id, min_distance, min_support) if there is no accumulator, if the
+    atlas was built with other map_id, min_distance or min_support, or if T files of experiments in the atlas have
+    changed since they were added.
+    """
+    state = load_state(poly_id)
+    if state==None:
+        print("%s : no atlas accumulator, rebuilding atlas" % poly_id)
+        process(poly_id, map_id=map_id, min_distance=min_distance, min_support=min_support)
+        return
+    if [state["map_id"], state["min_distance"], state["min_support"]]!=[map_id, min_distance, min_support]:
+        print("%s : atlas built with map_id=%s, min_distance=%s, min_support=%s, rebuilding atlas" % (poly_id, state["map_id"], state["min_distance"], state["min_support"]))
+        process(poly_id, map_id=map_id, min_distance=min_distance, min_support=min_support)
+        return
+    current = {}
+    for lib_id, exp_id in poly_experiments(poly_id):
+        t_filename = apa.path.t_filename(lib_id, exp_id, map_id=map_id)
+        if os.path.exists(t_filename):
+            current["%s_e%s" % (lib_id, exp_id)] = t_fingerprint(t_filename)
+    added = [name for name in current.keys() if name not in state["experiments"]]
+    removed = [name for name in state["experiments"].keys() if name not in current]
+    changed = [name for name in current.keys() if name in state["experiments"] and current[name]!=state["experiments"][name]]
+    for name in removed:
+        t_filename = state["experiments"][name][0]
+        if not os.path.exists(t_filename) or t_fingerprint(t_filename)!=state["experiments"][name]:
+            changed.append(name) # contributions of the experiment are not available anymore
+    if len(changed)>0:
+        print("%s : T files changed (%s), rebuilding atlas" % (poly_id, ", ".join(changed)))
+        process(poly_id, map_id=map_id, min_distance=min_distance, min_support=min_support)
+        return
+    if len(added)==0 and len(removed)==0:
+        print("%s : atlas up to date" % poly_id)
+        return
+
+    # contributions of added (+) and removed (-) experiments by chromosome and strand
+    deltas = {}
+    for name, sign in [(name, 1) for name in added] + [(name, -1) for name in removed]:
+        t_filename = current[name][0] if sign==1 else state["experiments"][name][0]
+        print("%s : %s %s" % (poly_id, "add" if sign==1 else "remove", name))
+        for (_, strand), group_sites in itertools.groupby(tail_sites(t_filename, {}, presorted=tail_streamed(t_filename)), key=lambda site: site[:2]):
+            group_sites = list(group_sites)
+            delta = deltas.setdefault((group_sites[0][5], "+-"[strand]), ([], [], []))
+            delta[0].append(np.array([site[2] for site in group_sites], dtype=np.int64))
+            delta[1].append(sign*np.array([site[3] for site in group_sites], dtype=np.float64))
+            delta[2].append(np.full(len(group_sites), sign, dtype=np.int64))
+
+    # update accumulator, find changed clusters and their new sites
+    changes = {}
+    for (chr, strand), delta in deltas.items():
+        positions, raws, supports = load_accumulator(poly_id, chr, strand)
+        old_filtered = positions[supports>=min_support]
+        positions, inverse = np.unique(np.concatenate([positions]+delta[0]), return_inverse=True)
+        new_raws = np.zeros(len(positions), dtype=np.float64)
+        new_supports = np.zeros(len(positions), dtype=np.int64)
+        np.add.at(new_raws, inverse, np.concatenate([raws]+delta[1]))
+        np.add.at(new_supports, inverse, np.concatenate([supports]+delta[2]))
+        keep = new_supports>0
+        positions, raws, supports = positions[keep], new_raws[keep], new_supports[keep]
+        save_accumulator(poly_id, chr, strand, positions, raws, supports)
+        filtered = supports>=min_support
+        spans = changed_clusters(old_filtered, positions[filtered], np.concatenate(delta[0]), min_distance)
+        if len(spans)==0:
+            continue
+        span_index = np.searchsorted(spans[:, 0], positions, side="right")-1
+        in_span = filtered & (span_index>=0) & (positions<=spans[np.maximum(span_index, 0), 1])
+        sites = accumulator_sites(chr, strand, positions[in_span], raws[in_span], supports[in_span])
+        changes[(chr, strand)] = (spans, list(filter_sites(sites, min_distance=min_distance)))
+        if [chr, strand] not in state["groups"]:
+            state["groups"].append([chr, strand])
+    state["groups"] = sorted([group for group in state["groups"] if os.path.exists(apa.path.polyadb_accumulator_filename(poly_id, chr=group[0], strand=group[1]))], key=group_order)
+    update_outputs(poly_id, changes)
+    for name in added:
+        state["experiments"][name] = current[name]
+    for name in removed:
+        del state["experiments"][name]
+    save_state(poly_id, state)
+
+def changed_clusters(old_positions, new_positions, changed, min_distance):
+    """
+    Returns array of [start, stop] spans of clusters (positions at most min_distance apart) in the union of old and new
+    positions that contain changed positions. Outside these spans the old and new clusters are the same.
+    """
+    positions = np.union1d(old_positions, new_positions)
+    changed = np.intersect1d(changed, positions)
+    if len(changed)==0:
+        return np.zeros((0, 2), dtype=np.int64)
+    cluster = np.concatenate([[0], np.cumsum(np.diff(positions)>min_distance)])
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(cluster))+1])
+    stops = np.concatenate([starts[1:], [len(positions)]])-1
+    clusters = np.unique(cluster[np.searchsorted(positions, changed)])
+    return np.column_stack([positions[starts[clusters]], positions[stops[clusters]]])
+
+def update_outputs(poly_id, changes):
+    """
+    Rewrite polyadb tab, bed and fasta files: rows of sites inside changed spans are replaced by rows of the new sites
+    (changes: (chr, strand) -> (spans, sites)). Annotation of sites already in the atlas is reused, new sites are
+    annotated (:func:`annotate_site`).
+    """
+    species = get_species(poly_id)
+    polyadb_tab = apa.path.polyadb_filename(poly_id, filetype="tab")
+    polyadb_bed = apa.path.polyadb_filename(poly_id, filetype="bed")
+    polyadb_fasta = apa.path.polyadb_filename(poly_id, filetype="fasta")
+
+    def changed(key):
+        if (key[0], "+-"[key[1]]) not in changes:
+            return False
+        spans = changes[(key[0], "+-"[key[1]])][0]
+        i = np.searchsorted(spans[:, 0], key[2], side="right")-1
+        return i>=0 and key[2]<=spans[i, 1]
+
+    reuse = {}
+    for key, row in polyadb_rows(polyadb_tab, polyadb_bed, polyadb_fasta):
+        if changed(key):
+            reuse[key] = row
+    rows = []
+    cDNA_filter = cDNA_filters.get(poly_id, 10)
+    for group, (spans, sites) in changes.items():
+        for site in sites:
+            if site[3]<=cDNA_filter:
+                continue
+            r = site_line(site[2], site).rstrip("\n").split("\t")
+            key = (site[5], site[1], site[2])
+            if key in reuse:
+                tab, _, fasta = reuse[key]
+                tab = tab.split("\t")
+                tab[6] = str(float(r[-1]))
+                rows.append((key, ("\t".join(tab), "\t".join(r)+"\n", fasta)))
+            else:
+                rows.append((key, annotate_site(species, r)))
+    rows.sort(key=lambda row: row_order(row[0]))
+    print("%s : %s sites in changed clusters, %s annotated" % (poly_id, len(rows), len([key for key, _ in rows if key not in reuse])))
+
+    outputs = polyadb_outputs(poly_id, temp=True)
+    for key, row in heapq.merge(((key, row) for key, row in polyadb_rows(polyadb_tab, polyadb_bed, polyadb_fasta) if not changed(key)), rows, key=lambda row: row_order(row[0])):
+        for f, text in zip(outputs, row):
+            f.write(text.encode())
+    for f, filename in zip(outputs, [polyadb_tab, polyadb_bed, polyadb_fasta]):
+        f.close()
+        os.rename(os.path.join(os.path.dirname(apa.path.polyadb_accumulator_filename(poly_id)), os.path.basename(filename)), filename)
+
+def polyadb_rows(polyadb_tab, polyadb_bed, polyadb_fasta):
+    """
+    Yields ((chr, strand, pos), (tab line, bed line, fasta record)) of sites in the polyadb files; chr is as in the bed
+    file, strand is 0 for + and 1 for -.
+    """
+    ftab = gzip.open(polyadb_tab, "rt")
+    fbed = gzip.open(polyadb_bed, "rt")
+    ffasta = open(polyadb_fasta, "rt")
+    ftab.readline()
+    fbed.readline()
+    bed = fbed.readline()
+    while bed!="":
+        tab = ftab.readline()
+        fasta = ffasta.readline() + ffasta.readline()
+        r = bed.split("\t")
+        yield ((r[0], 1 if r[3].startswith("-") else 0, int(r[1])), (tab, bed, fasta))
+        bed = fbed.readline()
+    ftab.close()
+    fbed.close()
+    ffasta.close()
 
 def get_gene(species, gid):
     # only used by apa.sition
@@ -115,87 +574,268 @@ def get_gene(species, gid):
             gene["gene_stop"] = gene["gene_stop"][-1]
     return gene
 
+class AtlasAnnotation:
+    """
+    Gene annotation of atlas sites keyed by (chr, strand, pos), read from the polyadb tab written by :func:`annotate`
+    or taken from its rows already read by :func:`read_polydb` (polydb). The genome annotation
+    (pybio.genomes.annotate) is only called for sites missing from the atlas.
+    """
+
+    def __init__(self, poly_id, species=None, polydb=None):
+        self.species = get_species(poly_id) if species==None else species
+        self.sites = {}
+        self.cache = {}
+        interval_codes = dict((v, k) for k, v in interval_types.items())
+        for data in (polydb_tab_rows(poly_id) if polydb==None else polydb.values()):
+            gene_id = data["gene_id"] if data["gene_id"]!="" else None
+            gene_interval = None
+            if data["interval"]!="":
+                start, stop, itype = data["interval"].split(":")
+                gene_interval = (int(start), int(stop), interval_codes[itype])
+            self.sites[(data["chr"], data["strand"], int(data["pos"]))] = (gene_id, data["gene_name"], gene_interval)
+
+    def get(self, chr, strand, pos, extension=0):
+        """
+        Returns (gene_id, gene_name, gene_interval) of the site; gene_id is None for intergenic sites.
+        Atlas sites without a gene are re-annotated if extension>0 (the atlas is annotated without extension).
+        """
+        site = self.sites.get((chr.replace("chr", ""), strand, pos), None) # atlas chromosomes are stored without the chr prefix
+        if site!=None and (site[0]!=None or extension==0):
+            return site
+        site = self.cache.get((chr, strand, pos, extension), None)
+        if site==None:
+            _, gene_id, _, gene_interval, _ = pybio.genomes.annotate(self.species, chr, strand, pos, extension=extension)
+            gene_name = get_gene(self.species, gene_id).get("gene_name", "") if gene_id!=None else ""
+            site = (gene_id, gene_name, gene_interval)
+            self.cache[(chr, strand, pos, extension)] = site
+        return site
+
 def annotate(poly_id):
-    species = get_species(poly_id)
-    interval_types = {"3":"3utr", "5": "5utr", "o":"orf", "i":"intron"}
+    """
+    Annotate the temp bedGraph (raw data) of poly_id and write the polyadb tab, bed and fasta files. The temp file is
+    split into chromosome/strand parts (in file order) which are annotated in parallel (:func:`annotate_parts`).
+    """
     polyadb_temp = apa.path.polyadb_filename(poly_id, filetype="temp")
-    polyadb_tab = apa.path.polyadb_filename(poly_id, filetype="tab")
-    polyadb_bed = apa.path.polyadb_filename(poly_id, filetype="bed")
-    polyadb_fasta = apa.path.polyadb_filename(poly_id, filetype="fasta")
-
-    db = {}
-    db_values = []
-    gene_values = {}
     print(polyadb_temp)
+    parts = []
     f = gzip.open(polyadb_temp, "rt")
-    r = f.readline()
-    r = f.readline()
-    while r:
-        r = r.replace("\n", "").replace("\r", "").split("\t")
-        chr = r[0].replace("chr", "")
-        pos = int(r[1])
-        cDNA = float(r[-1])
-        strand = "+" if cDNA>=0 else "-"
-        gid_up, gid, gid_down, gid_interval, _ = pybio.genomes.annotate(species, chr, strand, pos)
-        key = "%s:%s:%s" % (chr, strand, pos)
-        db[key] = (cDNA, gid, gid_interval)
-        db_values.append(abs(cDNA))
-        if gid!=None:
-            gene_values.setdefault(gid, []).append(abs(cDNA))
-        r = f.readline()
+    f.readline()
+    f_part = None
+    last = None
+    for r in f:
+        data = r.rstrip("\r\n").split("\t")
+        key = (data[0], data[-1].startswith("-"))
+        if key!=last:
+            if f_part!=None:
+                f_part.close()
+            parts.append("%s.%s" % (polyadb_temp, len(parts)))
+            f_part = open(parts[-1], "wt")
+            last = key
+        f_part.write(r)
+    if f_part!=None:
+        f_part.close()
     f.close()
+    annotate_parts(poly_id, [(part, None, None, None) for part in parts])
+    os.remove(polyadb_temp)
+    #classify_polya(poly_id)
+    #polyadb_class_histogram(poly_id)
 
-    # at least cDNA 10 to accept polyA database position
-    cDNA_filter = {"hg19_derti":0, "hg19_tian":0}.get(poly_id, 10)
-    accepted = {}
-    for key, (cDNA, gid, gid_interval) in db.items():
-        if abs(cDNA)>cDNA_filter:
-            accepted[key] = 1
+def annotate_parts(poly_id, parts):
+    """
+    Annotate parts (part filename, group, min_distance, min_support) with a pool of apa.config.cores workers
+    (:func:`annotate_part`) and concatenate the partial outputs, in order of parts, into the polyadb tab, bed and fasta
+    files. The output does not depend on the number of workers (gzip files are written with mtime 0).
+
+    Each worker loads the genome annotation of species (pybio.genomes) on its own, so memory use grows with
+    apa.config.cores (about one annotated genome per worker); lower apa.config.cores if memory is short.
+    """
+    species = get_species(poly_id)
+    tasks = [(poly_id, species, part, group, min_distance, min_support) for part, group, min_distance, min_support in parts]
+    if apa.config.cores>1 and len(tasks)>1:
+        pool = multiprocessing.Pool(min(apa.config.cores, len(tasks)))
+        results = pool.map(annotate_part, tasks, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        results = [annotate_part(task) for task in tasks]
 
-    ftab = gzip.open(polyadb_tab, "wt")
-    ftab.write("\t".join(["chr", "strand", "pos", "gene_id", "gene_name", "interval", "cDNA", "pas_type", "pas_loci", "cs_loci", "PAShex_PASloci_PASindex", "seq_-100_100"]) + "\n")
-    fbed = gzip.open(polyadb_bed, "wt")
-    fbed.write("track type=bedGraph name=\"%s\" description=\"%s\" altColor=\"200,120,59\" color=\"120,101,172\" maxHeightPixels=\"100:50:0\" visibility=\"full\" priority=\"20\"" % (poly_id, poly_id))
+    for index, f in enumerate(polyadb_outputs(poly_id)):
+        for result in results:
+            f_part = open(result[index], "rb")
+            shutil.copyfileobj(f_part, f)
+            f_part.close()
+            os.remove(result[index])
+        f.close()
+    for part, group, _, _ in parts:
+        if group==None:
+            os.remove(part)
+
+def polyadb_outputs(poly_id, temp=False):
+    """
+    Open polyadb tab, bed and fasta files (binary, gzip files with mtime 0) and write the headers; with temp, the files
+    are opened in the accumulator folder (same file names, to be moved over the atlas files).
+    """
+    outputs = []
+    heads = ["\t".join(["chr", "strand", "pos", "gene_id", "gene_name", "interval", "cDNA", "pas_type", "pas_loci", "cs_loci", "PAShex_PASloci_PASindex", "seq_-100_100"]) + "\n", "track type=bedGraph name=\"%s\" description=\"%s\" altColor=\"200,120,59\" color=\"120,101,172\" maxHeightPixels=\"100:50:0\" visibility=\"full\" priority=\"20\"\n" % (poly_id, poly_id), ""]
+    for filetype, head in zip(["tab", "bed", "fasta"], heads):
+        filename = apa.path.polyadb_filename(poly_id, filetype=filetype)
+        if temp:
+            filename = os.path.join(os.path.dirname(apa.path.polyadb_accumulator_filename(poly_id)), os.path.basename(filename))
+        f = gzip.GzipFile(filename, "wb", mtime=0) if filename.endswith(".gz") else open(filename, "wb")
+        f.write(head.encode())
+        outputs.append(f)
+    return outputs
+
+def annotate_part(pars):
+    """
+    Annotate one chromosome/strand part in a single pass. If group (chr, strand) is given, the sites of the accumulator
+    part (:func:`save_parts`) are filtered (:func:`filter_sites`), otherwise part holds temp bedGraph lines.
+    Sites are accepted by cDNA first (cDNA_filters), only accepted sites are annotated (:func:`annotate_site`), their
+    sequences are read in position sorted blocks (:func:`site_sequences`) and scanned for PAS together
+    (:func:`site_pas`), their genes are looked up in the sorted gene intervals of the worker (:func:`site_genes`). Writes partial tab, bed and fasta outputs (part.tab, part.bed, part.fasta) and returns their
+    filenames.
+    """
+    poly_id, species, part, group, min_distance, min_support = pars
+    if group!=None:
+        positions, raws, supports = load_accumulator(poly_id, group[0], group[1])
+        filtered = supports>=min_support
+        sites = filter_sites(accumulator_sites(group[0], group[1], positions[filtered], raws[filtered], supports[filtered]), min_distance=min_distance)
+        lines = (site_line(site[2], site) for site in sites)
+    else:
+        lines = open(part, "rt")
 
+    # at least cDNA 10 to accept polyA database position
+    cDNA_filter = cDNA_filters.get(poly_id, 10)
+    ftab = open(part+".tab", "wt")
+    fbed = open(part+".bed", "wt")
     # store upstream sequences for polyar to classify weak/strong/other poly-A sites
-    ffasta = open(polyadb_fasta, "wt")
-    f = gzip.open(polyadb_temp, "rt")
-    r = f.readline()
-    r = f.readline()
-    while r:
-        r = r.replace("\n", "").replace("\r", "").split("\t")
-        chr = r[0].replace("chr", "")
-        pos = int(r[1])
-        cDNA = float(r[-1])
-        strand = "+" if cDNA>=0 else "-"
-        # get upstream sequence
-        seq = pybio.genomes.seq(species, chr, strand, pos, start=-100, stop=100)
-        pas = ""
-        for i, h in enumerate(PAS_hexamers):
-            loci = seq[70:100].find(h)
-            if loci!=-1:
-                pas = "%s_%s_%s" % (h, i, loci-30)
-                break
-        gid_up, gid, gid_down, gid_interval, _ = pybio.genomes.annotate(species, chr, strand, pos)
-        key = "%s:%s:%s" % (chr, strand, pos)
-        if accepted.get(key, None)!=None:
-            if gid==None:
-                row = [chr, strand, pos, "", "", "", cDNA, "", "", "", pas, seq]
-            else:
-                gene = get_gene(species, gid)
-                interval = "%s:%s:%s" % (str(gid_interval[0]), str(gid_interval[1]), interval_types[gid_interval[2]])
-                row = [chr, strand, pos, gid, gene["gene_name"], interval, cDNA, "", "", "", pas, seq]
-            ftab.write("\t".join(str(e) for e in row)+"\n")
-            fbed.write("\t".join(r)+"\n")
-            ffasta.write(">%s\n%s\n" % ("%s%s:%s" % (strand, chr, pos), seq))
-        r = f.readline()
-    f.close()
+    ffasta = open(part+".fasta", "wt")
+    block = []
+    for r in itertools.chain(lines, [None]):
+        if r!=None:
+            r = r.replace("\n", "").replace("\r", "").split("\t")
+            if abs(float(r[-1]))<=cDNA_filter:
+                continue
+        if len(block)>0 and (r==None or int(r[1])-int(block[0][1])>block_size or len(block)>=1000):
+            strand = "+" if float(block[0][-1])>=0 else "-"
+            seqs = site_sequences(species, block[0][0].replace("chr", ""), strand, [int(site[1]) for site in block], start=-100, stop=100)
+            genes = site_genes(species, block[0][0].replace("chr", ""), strand, [int(site[1]) for site in block])
+            for site, seq, pas, gene in zip(block, seqs, site_pas(seqs), genes):
+                tab, bed, fasta = annotate_site(species, site, seq=seq, pas=pas, gene=gene)
+                ftab.write(tab)
+                fbed.write(bed)
+                ffasta.write(fasta)
+            block = []
+        if r!=None:
+            block.append(r)
+    if group==None:
+        lines.close()
     ftab.close()
     fbed.close()
     ffasta.close()
-    os.remove(polyadb_temp)
-    #classify_polya(poly_id)
-    #polyadb_class_histogram(poly_id)
+    return (part+".tab", part+".bed", part+".fasta")
+
+def site_sequences(species, chr, strand, positions, start=-100, stop=100):
+    """
+    Sequences of sites at sorted positions on chr and strand, same as pybio.genomes.seq(species, chr, strand, pos,
+    start=start, stop=stop) for each position, but read from the genome with one pybio.genomes.seq_direct call. Sites
+    near chromosome ends are read one by one.
+    """
+    if strand=="+":
+        lo, hi = positions[0]+start, positions[-1]+stop
+    else:
+        lo, hi = positions[0]-stop, positions[-1]-start
+    seq = pybio.genomes.seq_direct(species, chr, strand, lo, hi) if lo>=0 else ""
+    if len(seq)!=hi-lo+1:
+        return [pybio.genomes.seq(species, chr, strand, pos, start=start, stop=stop) for pos in positions]
+    if strand=="+":
+        return [seq[pos+start-lo:pos+stop-lo+1] for pos in positions]
+    return [seq[hi-pos+start:hi-pos+stop+1] for pos in positions] # reverse complement: genome position g is at hi-g
+
+def site_pas(seqs):
+    """
+    PAS of sites with -100..100 sequences seqs: strongest PAS hexamer in -30..0 as hexamer_index_loci (loci relative
+    to the site), empty string if there is none (see :func:`apa.pas.first_pas`).
+    """
+    result = []
+    for hit in apa.pas.first_pas([seq[70:100] for seq in seqs]):
+        result.append("" if hit==None else "%s_%s_%s" % (hit[0], hit[1], hit[2]-30))
+    return result
+
+def gene_lookup(species):
+    """
+    Gene intervals (gene_intervals of pybio.genomes.genes) of species by (chr, strand) as arrays sorted by start:
+    (starts, stops, covered, gene ids, intervals); covered is the largest stop of the intervals before each interval.
+    Built once per process, each :func:`annotate_parts` worker builds its own.
+    """
+    if species in gene_intervals_db:
+        return gene_intervals_db[species]
+    pybio.genomes.load(species)
+    data = {}
+    for gene_id, gene in pybio.genomes.genes.get(species, {}).items():
+        for interval in gene["gene_intervals"]:
+            data.setdefault((str(gene["gene_chr"]), gene["gene_strand"]), []).append((interval[0], interval[1], gene_id, interval))
+    for key, rows in data.items():
+        rows.sort(key=lambda row: (row[0], row[1]))
+        starts = np.array([row[0] for row in rows], dtype=np.int64)
+        stops = np.array([row[1] for row in rows], dtype=np.int64)
+        covered = np.concatenate([[-1], np.maximum.accumulate(stops)[:-1]])
+        data[key] = (starts, stops, covered, [row[2] for row in rows], [row[3] for row in rows])
+    gene_intervals_db[species] = data
+    return data
+
+def site_genes(species, chr, strand, positions):
+    """
+    (gene_id, gene_interval) of sites at positions on chr and strand, looked up in the sorted gene intervals
+    (:func:`gene_lookup`) with np.searchsorted; (None, None) for intergenic sites. Sites covered by more than one
+    interval (overlapping genes, shared interval ends) are None and annotated with pybio.genomes.annotate.
+    """
+    lookup = gene_lookup(species).get((chr, strand), None)
+    if lookup==None:
+        return [(None, None)] * len(positions)
+    starts, stops, covered, gene_ids, intervals = lookup
+    positions = np.array(positions, dtype=np.int64)
+    index = np.searchsorted(starts, positions, side="right")-1
+    inside = (index>=0) & (stops[np.maximum(index, 0)]>=positions)
+    ambiguous = (index>=0) & (covered[np.maximum(index, 0)]>=positions)
+    result = []
+    for i, is_inside, is_ambiguous in zip(index.tolist(), inside.tolist(), ambiguous.tolist()):
+        if is_ambiguous:
+            result.append(None)
+        elif is_inside:
+            result.append((gene_ids[i], intervals[i]))
+        else:
+            result.append((None, None))
+    return result
+
+def annotate_site(species, r, seq=None, pas=None, gene=None):
+    """
+    Annotate site of temp bedGraph line r (list of fields); returns (tab line, bed line, fasta record) of the site.
+    seq is the -100..100 sequence of the site, read from the genome if not given, pas is its :func:`site_pas` and
+    gene its (gene_id, gene_interval) from :func:`site_genes`.
+    """
+    chr = r[0].replace("chr", "")
+    pos = int(r[1])
+    cDNA = float(r[-1])
+    strand = "+" if cDNA>=0 else "-"
+    # get upstream sequence
+    if seq==None:
+        seq = pybio.genomes.seq(species, chr, strand, pos, start=-100, stop=100)
+    if pas==None:
+        pas = site_pas([seq])[0]
+    if gene==None:
+        gene = site_genes(species, chr, strand, [pos])[0]
+    if gene==None:
+        _, gid, _, gid_interval, _ = pybio.genomes.annotate(species, chr, strand, pos)
+    else:
+        gid, gid_interval = gene
+    if gid==None:
+        row = [chr, strand, pos, "", "", "", cDNA, "", "", "", pas, seq]
+    else:
+        gene = get_gene(species, gid)
+        interval = "%s:%s:%s" % (str(gid_interval[0]), str(gid_interval[1]), interval_types[gid_interval[2]])
+        row = [chr, strand, pos, gid, gene["gene_name"], interval, cDNA, "", "", "", pas, seq]
+    return ("\t".join(str(e) for e in row)+"\n", "\t".join(r)+"\n", ">%s\n%s\n" % ("%s%s:%s" % (strand, chr, pos), seq))
 
 def classify_polya(poly_id):
     """
@@ -368,21 +1008,24 @@ def annotate_pair(species, chr, strand, pos1, pos2, extension=5000):
         return "skipped"
     return "other"
 
-def read_polydb(poly_id):
-    db = {}
+def polydb_tab_rows(poly_id):
+    """
+    Yields rows (dictionaries by header) of the polyadb tab of poly_id.
+    """
     polyadb_tab = apa.path.polyadb_filename(poly_id, filetype="tab")
     if not os.path.exists(polyadb_tab):
-        return db
-    f = gzip.open(polyadb_tab)
+        return
+    f = gzip.open(polyadb_tab, "rt")
     header = f.readline().replace("\r", "").replace("\n", "").split("\t")
     r = f.readline()
     while r:
         r = r.replace("\n", "").replace("\r", "").split("\t")
-        data = dict(zip(header, r))
-        chr = data["chr"]
-        strand = data["strand"]
-        pos = data["pos"]
-        db["%s_%s_%s" % (chr, strand, pos)] = data
+        yield dict(zip(header, r))
         r = f.readline()
     f.close()
+
+def read_polydb(poly_id):
+    db = {}
+    for data in polydb_tab_rows(poly_id):
+        db["%s_%s_%s" % (data["chr"], data["strand"], data["pos"])] = data
     return db
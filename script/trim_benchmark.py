@@ -0,0 +1,67 @@
+# compare apa.trim kernels with the per read implementations (string slicing, regex) on random reads
+# usage: python3 trim_benchmark.py [num_reads]
+
+import sys
+import time
+import random
+import regex
+import apa
+
+tail_window = 20
+A_percentage = 0.85
+
+def remove_tail_slicing(sequence):
+    for i in range(10, len(sequence)):
+        tail = sequence[i:i+tail_window]
+        tail_len = len(tail)
+        num_A = tail.count("A")
+        if tail.startswith("AAAAAAAAAAAAAAA"): # 15A? trim here
+            return i
+        if not tail.startswith("A"):
+            continue
+        if len(tail)>1 and not tail.startswith("AA"):
+            continue
+        if len(tail)>2 and not tail.startswith("AAA"):
+            continue
+        percentage_A = num_A / float(tail_len)
+        if percentage_A>=A_percentage:
+            return i
+    return len(sequence)
+
+def random_read(length=75):
+    # read with a tail (A rich, with some errors) in about half of the cases
+    insert = "".join(random.choice("ACGT") for _ in range(random.randint(10, length)))
+    tail = "".join("A" if random.random()<0.9 else random.choice("CGTN") for _ in range(length-len(insert)))
+    return insert+tail if random.random()<0.5 else "".join(random.choice("ACGT") for _ in range(length))
+
+num_reads = int(sys.argv[1]) if len(sys.argv)>1 else 200000
+random.seed(42)
+sequences = [random_read() for _ in range(num_reads)]
+prog = regex.compile(r'AAA(?:AAAAAAA){s<=2}')
+
+start = time.time()
+cuts_old = [remove_tail_slicing(seq) for seq in sequences]
+time_old = time.time()-start
+start = time.time()
+cuts_new = []
+for i in range(0, num_reads, 10000):
+    cuts_new.extend(apa.trim.remove_tails(sequences[i:i+10000], window=tail_window, percentage=A_percentage).tolist())
+time_new = time.time()-start
+print("remove_tail : slicing %.2fs, apa.trim batch %.2fs, speedup %.1fx, same cuts=%s" % (time_old, time_new, time_old/max(time_new, 1e-9), cuts_old==cuts_new))
+start = time.time()
+cuts_new = [apa.trim.remove_tail(seq, window=tail_window, percentage=A_percentage) for seq in sequences]
+time_new = time.time()-start
+print("remove_tail : slicing %.2fs, apa.trim single %.2fs, speedup %.1fx, same cuts=%s" % (time_old, time_new, time_old/max(time_new, 1e-9), cuts_old==cuts_new))
+
+start = time.time()
+runs_old = []
+for seq in sequences:
+    match = prog.search(seq)
+    runs_old.append(None if match==None else match.start(0))
+time_old = time.time()-start
+start = time.time()
+runs_new = []
+for i in range(0, num_reads, 10000):
+    runs_new.extend(apa.trim.find_a_runs(sequences[i:i+10000]))
+time_new = time.time()-start
+print("A-run       : regex %.2fs, apa.trim %.2fs, speedup %.1fx, same cuts=%s" % (time_old, time_new, time_old/max(time_new, 1e-9), runs_old==runs_new))
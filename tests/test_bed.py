@@ -0,0 +1,154 @@
+import os
+import gzip
+import types
+import socket
+import numpy as np
+import pysam
+import apa
+from test_polya import make_bam
+
+def write_bedgraph(filename, rows):
+    f = gzip.open(filename, "wt")
+    f.write("track type=bedGraph name=\"test\"\n")
+    for chr, pos, value in rows:
+        f.write("%s\t%s\t%s\t%s\n" % (chr, pos, pos+1, value))
+    f.close()
+
+def test_atlas_overlay_nearby_sites(tmp_path, monkeypatch):
+    monkeypatch.setattr(apa.path, "polya_folder", str(tmp_path))
+    sites = [1000, 1030, 1200]
+    write_bedgraph(apa.path.polyadb_filename("test"), [("1", pos, 10) for pos in sites] + [("1", pos, -10) for pos in sites])
+    reads = [(pos+offset, 1) for pos in sites for offset in range(-10, 11)]
+    r_filename = str(tmp_path / "r.bed.gz")
+    write_bedgraph(r_filename, [("1", pos, value) for pos, value in reads] + [("1", pos, -value) for pos, value in reads])
+    atlas = apa.bed.AtlasIndex("test")
+    counts = atlas.overlay(r_filename, upstream=100, downstream=25)
+    for strand in ["+", "-"]:
+        # windows are narrowed to half the distance to the neighbouring sites, reads are not counted twice
+        assert counts[("1", strand)].tolist()==[21, 21, 21]
+        assert counts[("1", strand)].sum()==len(reads)
+
+def test_atlas_save_integers(tmp_path, monkeypatch):
+    monkeypatch.setattr(apa.path, "polya_folder", str(tmp_path))
+    write_bedgraph(apa.path.polyadb_filename("test"), [("1", 1000, 1)])
+    r_filename = str(tmp_path / "r.bed.gz")
+    write_bedgraph(r_filename, [("1", 1000, 2000000)])
+    atlas = apa.bed.AtlasIndex("test")
+    e_filename = str(tmp_path / "e.bed.gz")
+    atlas.save(atlas.overlay(r_filename, upstream=100, downstream=25), e_filename, track_id="test")
+    assert gzip.open(e_filename, "rt").read().splitlines()[1]=="1\t1000\t1001\t2000000"
+
+def test_manifest_lock_and_missing_inputs(tmp_path):
+    output = str(tmp_path / "out.bed.gz")
+    manifest = apa.bed.Manifest([output], [str(tmp_path / "missing.bin"), None], {})
+    open(output + ".lock", "wt").write("%s %s" % (socket.gethostname(), os.getppid()))
+    # no writing of outputs while another job (live process) is writing them
+    assert not manifest.start()
+    os.remove(output + ".lock")
+    assert manifest.start()
+    open(output, "wt").close()
+    manifest.done()
+    assert manifest.current()
+    assert not os.path.exists(output + ".lock")
+
+def test_lock_stale(tmp_path):
+    lock = apa.bed.Lock(str(tmp_path / "out.lock"))
+    pid = os.fork()
+    if pid==0:
+        os._exit(0)
+    os.waitpid(pid, 0)
+    open(lock.filename, "wt").write("%s %s" % (socket.gethostname(), pid)) # lock of a finished process
+    assert lock.acquire()
+    lock.release()
+    assert not os.path.exists(lock.filename)
+
+def site_sets(rows):
+    """
+    Baseline counting: set of read ids per (key, position).
+    """
+    data = {}
+    for key, pos, read_id in rows:
+        data.setdefault((key, pos), set()).add(read_id)
+    return dict((site, len(read_ids)) for site, read_ids in data.items())
+
+def counter_dict(counter):
+    keys, positions, counts = counter.counts()
+    return dict(((key, pos), count) for key, pos, count in zip(keys.tolist(), positions.tolist(), counts.tolist()))
+
+def random_rows(rng, n, keys=6, positions=500, ids=40):
+    return list(zip(rng.integers(0, keys, n).tolist(), rng.integers(0, positions, n).tolist(), rng.integers(0, ids, n).tolist()))
+
+def add_rows(counter, rows):
+    counter.add([row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows])
+
+def test_site_counter_exact():
+    rng = np.random.default_rng(1)
+    rows = random_rows(rng, 20000)
+    counter = apa.bed.SiteCounter()
+    for i in range(0, len(rows), 1000):
+        add_rows(counter, rows[i:i+1000])
+    assert counter_dict(counter)==site_sets(rows)
+    # merge of shards (buffered, compacted only when the buffer is large)
+    total = apa.bed.SiteCounter()
+    for i in range(0, len(rows), 500):
+        shard = apa.bed.SiteCounter()
+        add_rows(shard, rows[i:i+500])
+        total.merge(shard)
+    expected = site_sets(rows)
+    # sites of references before tid 1 (keys 0 and 1) are popped, the rest stays
+    assert counter_dict(total.pop(1))=={site:count for site, count in expected.items() if site[0]<2}
+    assert counter_dict(total)=={site:count for site, count in expected.items() if site[0]>=2}
+
+def test_site_counter_approximate():
+    rng = np.random.default_rng(2)
+    rows = random_rows(rng, 20000, ids=40) + [(7, 1, read_id) for read_id in range(5000)]
+    expected = site_sets(rows)
+    counter = apa.bed.SiteCounter(approximate=True, registers=64)
+    shard = apa.bed.SiteCounter(approximate=True, registers=64)
+    add_rows(counter, rows[:10000])
+    add_rows(shard, rows[10000:])
+    counter.merge(shard)
+    counts = counter_dict(counter)
+    assert set(counts)==set(expected)
+    # within 3 standard errors (1.04/sqrt(64)), small counts within one
+    for site, count in expected.items():
+        assert abs(counts[site]-count)<=1+3*1.04/8*count
+
+def test_bed_raw_parallel_serial(tmp_path, monkeypatch):
+    monkeypatch.setattr(apa.path, "data_folder", str(tmp_path))
+    lib = types.SimpleNamespace(experiments={1:{"method":"pAseq", "map_to":"test"}})
+    monkeypatch.setitem(apa.annotation.libs, "test", lib)
+    os.makedirs(os.path.dirname(apa.path.bam_filename("test", 1)))
+    rng = np.random.default_rng(3)
+    reads = sorted([(int(tid), int(pos), bool(reverse)) for tid, pos, reverse in zip(rng.integers(0, 2, 3000), rng.integers(0, 5000, 3000), rng.integers(0, 2, 3000))])
+    bam_filename = apa.path.bam_filename("test", 1)
+    make_bam(bam_filename, ["2", "1"], reads)
+    pysam.index(bam_filename)
+    outputs = {}
+    for parallel in [False, True]:
+        apa.bed.bed_raw("test", 1, ip_filter=False, parallel=parallel, tile_size=700, force=True)
+        outputs[parallel] = [gzip.open(fname, "rt").read() for fname in [apa.path.r_filename("test", 1), apa.path.t_filename("test", 1)]]
+    assert outputs[False]==outputs[True]
+    # same counts as the baseline (set of read ids per site)
+    expected = site_sets([(2*tid+reverse, pos if reverse else pos+49, i) for i, (tid, pos, reverse) in enumerate(reads)])
+    lines = [line.split("\t") for line in outputs[True][1].splitlines()]
+    assert dict((((["2", "1"].index(chr))*2+(value[0]=="-"), int(pos)), abs(int(value))) for chr, pos, _, value in lines)==expected
+
+def test_bed_expression_engines(tmp_path, monkeypatch):
+    monkeypatch.setattr(apa.path, "polya_folder", str(tmp_path))
+    monkeypatch.setattr(apa.path, "data_folder", str(tmp_path))
+    lib = types.SimpleNamespace(experiments={1:{"method":"lexrev", "map_to":"test"}, 2:{"method":"pAseq", "map_to":"test"}})
+    monkeypatch.setitem(apa.annotation.libs, "test", lib)
+    write_bedgraph(apa.path.polyadb_filename("test"), [("1", 1000, 10), ("1", 1030, 10), ("1", 1200, -10)])
+    for exp_id in [1, 2]:
+        os.makedirs(os.path.dirname(apa.path.r_filename("test", exp_id)))
+        write_bedgraph(apa.path.r_filename("test", exp_id), [("1", pos, value) for pos, value in [(995, 2), (1003, 1), (1020, 3), (1198, -4), (1202, -1)]])
+    outputs = [apa.path.e_filename("test", 1, poly_id="test"), apa.path.e_filename_norm("test", 1, poly_id="test"), apa.path.e_filename("test", 2, poly_id="test")]
+    apa.bed.bed_expression_lib("test")
+    data = [gzip.open(fname, "rt").read() for fname in outputs]
+    # the per experiment path writes the same files with the same engine
+    for exp_id in [1, 2]:
+        apa.bed.bed_expression("test", exp_id, force=True)
+    assert [gzip.open(fname, "rt").read() for fname in outputs]==data
+    assert data[0].splitlines()[1:]==["1\t1000\t1001\t3", "1\t1200\t1201\t-5"]
+    assert data[2].splitlines()[1:]==["1\t1000\t1001\t3", "1\t1030\t1031\t3", "1\t1200\t1201\t-5"]
@@ -0,0 +1,228 @@
+import os
+import gzip
+import types
+import concurrent.futures
+import random
+import numpy as np
+import pytest
+import apa
+
+def random_barcodes(n, seed=1):
+    random.seed(seed)
+    # short barcodes with repeats, barcodes with N (not packed) and long barcodes (longer than 31 nt, not packed)
+    pool = ["".join(random.choice("ACGT") for _ in range(random.choice([8, 11]))) for _ in range(300)]
+    pool += ["ACGN" + "".join(random.choice("ACGT") for _ in range(6)) for _ in range(20)] + ["A"*32, "C"*40, ""]
+    return [random.choice(pool) for _ in range(n)]
+
+def baseline_table(codes):
+    """
+    Baseline extract: dict random_code -> (random_code_id, freq), ids from 1 in order of first occurrence.
+    """
+    db_random = {}
+    ids = []
+    for rnd_code in codes:
+        rnd_code_id, rnd_code_freq = db_random.get(rnd_code, (len(db_random)+1, 0))
+        db_random[rnd_code] = (rnd_code_id, rnd_code_freq+1)
+        ids.append(rnd_code_id)
+    return db_random, ids
+
+def test_barcode_table(tmp_path):
+    codes = random_barcodes(20000)
+    db_random, expected_ids = baseline_table(codes)
+    table = apa.extract.BarcodeTable(capacity=64) # small capacity, the table has to grow
+    ids = []
+    for i in range(0, len(codes), 3000):
+        if i==9000: # snapshot and restore in between
+            table.save(str(tmp_path / "table.npz"))
+            table = apa.extract.BarcodeTable()
+            table.load(str(tmp_path / "table.npz"))
+        ids.extend(table.add(codes[i:i+3000]).tolist())
+    assert ids==expected_ids
+    assert len(table)==len(db_random)
+    table.write(str(tmp_path / "rnd.txt"))
+    L = [(rnd_code_freq, rnd_code, rnd_code_id) for rnd_code, (rnd_code_id, rnd_code_freq) in db_random.items()]
+    L.sort(reverse=True)
+    assert open(str(tmp_path / "rnd.txt")).read()=="freq\trandom_code\trandom_code_id\n" + "".join("%s\t%s\t%s\n" % row for row in L)
+    table.write(str(tmp_path / "rnd_top.txt"), top=10)
+    assert open(str(tmp_path / "rnd_top.txt")).read().splitlines()[1:]==["%s\t%s\t%s" % row for row in L[:10]]
+
+def test_barcode_pack():
+    codes = ["", "A", "ACGT"*7 + "ACG", "ACNT", "A"*32]
+    keys = apa.extract.encode_barcodes(codes)
+    assert keys.tolist()[3:]==[0, 0] # not packed
+    assert apa.extract.decode_barcodes(keys[:3]).tolist()==codes[:3]
+
+def test_heavy_hitters(tmp_path):
+    random.seed(2)
+    # heavy tailed frequencies: item i is drawn with weight 1/(i+1)
+    items = ["item%s" % i for i in range(5000)]
+    stream = random.choices(items, weights=[1.0/(i+1) for i in range(len(items))], k=100000)
+    exact = {}
+    for item in stream:
+        exact[item] = exact.get(item, 0) + 1
+    hh = apa.extract.HeavyHitters(k=50)
+    for i in range(0, len(stream), 7000):
+        if i==49000:
+            hh.save(str(tmp_path / "hh.npz"))
+            hh = apa.extract.HeavyHitters(k=50)
+            hh.load(str(tmp_path / "hh.npz"))
+        chunk = {}
+        for item in stream[i:i+7000]:
+            chunk[item] = chunk.get(item, 0) + 1
+        hh.add(list(chunk.keys()), list(chunk.values()), values=[int(item[4:]) for item in chunk])
+    top = hh.items()
+    assert len(top)==50
+    # count-min estimates are upper bounds, the most frequent items are all found
+    for estimate, item, value in top:
+        assert estimate>=exact[item] and value==int(item[4:])
+    exact_top = sorted(exact, key=lambda item: -exact[item])
+    assert set(exact_top[:20])<=set(item for _, item, _ in top)
+    assert [item for _, item, _ in top[:5]]==exact_top[:5]
+
+def write_library(folder, lib, reads=3000):
+    random.seed(5)
+    for fastq_filename in lib.fastq_files:
+        f = gzip.open(os.path.join(folder, fastq_filename), "wt")
+        for i in range(reads):
+            length = random.choice([5, 30, 50])
+            sequence = "".join(random.choice("ACGT") for _ in range(length))
+            f.write("@r%s#%s%s/2\n%s\n+\n%s\n" % (i, random.choice(["AC", "GT", "TT"]), random.choice(["A", "C", "N"]), sequence, "I"*length))
+        f.close()
+
+def baseline_extract(folder, lib):
+    """
+    Outputs of the baseline (single process) extraction: FASTQ text per experiment, rnd.bin, rnd.txt and stats.txt.
+    """
+    demulti_codes = dict((exp_data["dcode"], exp_id) for exp_id, exp_data in lib.experiments.items())
+    texts = dict((exp_id, "") for exp_id in list(lib.experiments.keys()) + ["unmatched"])
+    db_random = {}
+    rnd = {}
+    lib_stats = {"all_reads" : 0}
+    read_number = 0
+    for fastq_filename in lib.fastq_files:
+        f = gzip.open(os.path.join(folder, fastq_filename), "rt")
+        lines = f.read().splitlines()
+        for read_id, sequence, quality in zip(lines[0::4], lines[1::4], lines[3::4]):
+            read_number += 1
+            lib_stats["all_reads"] += 1
+            read_id = read_id.rstrip("/2")
+            if len(sequence)<apa.extract.min_read_length:
+                lib_stats["too_short"] = lib_stats.get("too_short", 0) + 1
+                continue
+            dcode = read_id.split("#")[-1][:lib.dcode_len]
+            rnd_code = read_id.split("#")[-1][lib.dcode_len:] + sequence[:6]
+            rnd_code_id, rnd_code_freq = db_random.get(rnd_code, (len(db_random)+1, 0))
+            db_random[rnd_code] = (rnd_code_id, rnd_code_freq+1)
+            rnd[read_number] = rnd_code_id
+            exp_id = demulti_codes.get(dcode, "unmatched")
+            lib_stats[exp_id] = lib_stats.get(exp_id, 0) + 1
+            texts[exp_id] += "@%s\n%s\n+\n%s\n" % (read_number, sequence, quality)
+    rnd_bin = np.zeros(max(rnd)+1, dtype=np.uint32)
+    rnd_bin[list(rnd.keys())] = list(rnd.values())
+    L = sorted([(rnd_code_freq, rnd_code, rnd_code_id) for rnd_code, (rnd_code_id, rnd_code_freq) in db_random.items()], reverse=True)
+    rnd_txt = "freq\trandom_code\trandom_code_id\n" + "".join("%s\t%s\t%s\n" % row for row in L)
+    stats = "exp_id\tnum_reads\n" + "".join("%s\t%s\n" % (k, val) for val, k in sorted([(val, k) for k, val in lib_stats.items()], reverse=True))
+    return texts, rnd_bin.tobytes(), rnd_txt, stats
+
+def extract_outputs(folder, lib):
+    texts = {}
+    for exp_id in lib.experiments:
+        texts[exp_id] = gzip.open(os.path.join(folder, "e%s" % exp_id, "lib_e%s.fastq.gz" % exp_id), "rt").read()
+    texts["unmatched"] = gzip.open(os.path.join(folder, "unmatched", "lib_unmatched.fastq.gz"), "rt").read()
+    return texts, open(os.path.join(folder, "lib.rnd.bin"), "rb").read(), open(os.path.join(folder, "lib.rnd.txt")).read(), open(os.path.join(folder, "lib.stats.txt")).read()
+
+def extract_library(tmp_path, monkeypatch):
+    monkeypatch.setattr(apa.path, "data_folder", str(tmp_path))
+    # experiment 3 gets no reads
+    lib = types.SimpleNamespace(experiments={1:{"dcode":"AC"}, 2:{"dcode":"GT"}, 3:{"dcode":"GG"}}, dcode_len=2, fastq_files=["a.fastq.gz", "b.fastq.gz"])
+    monkeypatch.setitem(apa.annotation.libs, "lib", lib)
+    os.makedirs(str(tmp_path / "lib"))
+    write_library(str(tmp_path / "lib"), lib)
+    return str(tmp_path / "lib"), lib
+
+def test_process_lib_single_process(tmp_path, monkeypatch):
+    folder, lib = extract_library(tmp_path, monkeypatch)
+    # chunks processed by the worker pool give the same outputs as the baseline single process extraction
+    apa.extract.process_lib("lib", chunk_size=250)
+    assert extract_outputs(folder, lib)==baseline_extract(folder, lib)
+    assert os.path.getsize(os.path.join(folder, "e3", "lib_e3.fastq.gz"))>0 # valid empty gzip stream
+
+def test_sidecar_writer(tmp_path):
+    fname = str(tmp_path / "rnd.bin")
+    writer = apa.extract.SidecarWriter(fname, np.uint32, block_size=4)
+    for read_number, value in [(1, 7), (3, 8), (4, 9), (10, 5), (11, 6)]:
+        writer.set(read_number, value)
+    with pytest.raises(ValueError): # before the current block: would be written to the wrong offset
+        writer.set(2, 1)
+    writer.close()
+    assert np.fromfile(fname, dtype=np.uint32).tolist()==[0, 7, 0, 8, 9, 0, 0, 0, 0, 0, 5, 6]
+
+def test_gzip_writers_shared_pool(tmp_path):
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    writers = [apa.extract.GzipWriter(str(tmp_path / ("%s.fastq.gz" % i)), block_size=1000, threads=2, pool=pool) for i in range(3)]
+    texts = ["", "", ""]
+    for i in range(2000):
+        line = "@%s\nACGT\n+\nIIII\n" % i
+        writers[i%2].write(line) # writer 2 gets no text
+        texts[i%2] += line
+    for writer in writers:
+        writer.close()
+    pool.shutdown()
+    assert [gzip.open(str(tmp_path / ("%s.fastq.gz" % i)), "rt").read() for i in range(3)]==texts
+    assert os.path.getsize(str(tmp_path / "2.fastq.gz"))>0
+
+class Crash(Exception):
+    pass
+
+def crash_at(monkeypatch, n):
+    """
+    Crash the extraction when the n-th chunk is stored (BarcodeTable.add).
+    """
+    add = apa.extract.BarcodeTable.add
+    calls = [0]
+    def crash_add(self, *args, **kwargs):
+        calls[0] += 1
+        if calls[0]==n:
+            raise Crash()
+        return add(self, *args, **kwargs)
+    monkeypatch.setattr(apa.extract.BarcodeTable, "add", crash_add)
+
+def test_process_lib_resume(tmp_path, monkeypatch):
+    folder, lib = extract_library(tmp_path, monkeypatch)
+    expected = baseline_extract(folder, lib)
+    # crash at any chunk (before the first checkpoint, between checkpoints, right after one), resume without force
+    for n in range(1, 25, 2):
+        with monkeypatch.context() as m:
+            crash_at(m, n)
+            with pytest.raises(Crash):
+                apa.extract.process_lib("lib", chunk_size=250, checkpoint_reads=1000, force=True)
+        assert not os.path.exists(os.path.join(folder, "status", "extract.status"))
+        apa.extract.process_lib("lib", chunk_size=250, checkpoint_reads=1000)
+        assert extract_outputs(folder, lib)==expected
+        assert os.path.exists(os.path.join(folder, "status", "extract.status"))
+        assert not os.path.exists(os.path.join(folder, "status", "extract.checkpoint"))
+    # crash while storing a checkpoint: before the new checkpoint replaces the old one and before old snapshots are removed
+    def crash(*args):
+        raise Crash()
+    for target in ["rename", "remove_snapshots"]:
+        with monkeypatch.context() as m:
+            if target=="rename":
+                m.setattr(apa.extract.os, "rename", crash)
+            else:
+                m.setattr(apa.extract, "remove_snapshots", crash)
+            with pytest.raises(Crash):
+                apa.extract.process_lib("lib", chunk_size=250, checkpoint_reads=1000, force=True)
+        apa.extract.process_lib("lib", chunk_size=250, checkpoint_reads=1000)
+        assert extract_outputs(folder, lib)==expected
+    assert apa.extract.process_lib("lib")==False # complete
+
+def test_process_lib_resume_settings(tmp_path, monkeypatch):
+    folder, lib = extract_library(tmp_path, monkeypatch)
+    with monkeypatch.context() as m:
+        crash_at(m, 10)
+        with pytest.raises(Crash):
+            apa.extract.process_lib("lib", chunk_size=250, checkpoint_reads=1000)
+    # other input files: the checkpoint is not resumed, extraction starts from scratch
+    lib.fastq_files = ["b.fastq.gz"]
+    apa.extract.process_lib("lib", chunk_size=250, checkpoint_reads=1000)
+    assert extract_outputs(folder, lib)==baseline_extract(folder, lib)
@@ -0,0 +1,33 @@
+import os
+import gzip
+import types
+import pysam
+import pytest
+import apa
+from test_polya import make_bam
+
+def test_stream_only_lexfwd(tmp_path, monkeypatch):
+    monkeypatch.setattr(apa.path, "data_folder", str(tmp_path))
+    lib = types.SimpleNamespace(experiments={1:{"method":"lexrev", "map_to":"test"}})
+    monkeypatch.setitem(apa.annotation.libs, "test", lib)
+    # reads would be trimmed as lexfwd reads
+    with pytest.raises(ValueError):
+        apa.map.map_experiment_stream("test", 1)
+
+def test_stats_units(tmp_path, monkeypatch):
+    monkeypatch.setattr(apa.path, "data_folder", str(tmp_path))
+    lib = types.SimpleNamespace(seq_type="single", experiments={1:{"method":"pAseq", "map_to":"test"}})
+    monkeypatch.setitem(apa.annotation.libs, "test", lib)
+    os.makedirs(apa.path.map_folder("test", 1))
+    f = gzip.open(apa.path.map_fastq_file("test", 1), "wt")
+    for i in range(5):
+        f.write("@%s\nACGT\n+\nIIII\n" % i)
+    f.close()
+    make_bam(apa.path.bam_filename("test", 1), ["1"], [(0, 100, False), (0, 200, False), (0, 300, True), (0, 400, False)])
+    bam = pysam.AlignmentFile(apa.path.bam_filename("test", 1))
+    records = len(list(bam.fetch(until_eof=True)))
+    bam.close()
+    # mapped alignments from the index (samtools view -c), reads given to the aligner from the FASTQ file
+    assert apa.map.stats_experiment_task(("test", 1, 1, ""))==(1, {"num_reads":5, "map_reads":records})
+    open(os.path.join(apa.path.map_folder("test", 1), "test_e1_m1Log.final.out"), "wt").write("                          Number of input reads |\t5\n")
+    assert apa.map.stats_experiment_task(("test", 1, 1, ""))==(1, {"num_reads":5, "map_reads":records})
@@ -0,0 +1,40 @@
+import random
+import apa
+
+def baseline_match_pas(seq, hexamers):
+    for hexamer in hexamers:
+        if seq.find(hexamer)!=-1:
+            return True
+    return False
+
+def baseline_hits(seq, hexamers, start, stop):
+    stop = len(seq) if stop==None else min(stop, len(seq))
+    return [(i, seq[i:i+6], hexamers.index(seq[i:i+6])) for i in range(start, stop-5) if seq[i:i+6] in hexamers]
+
+def baseline_first_pas(seq, hexamers):
+    for i, h in enumerate(hexamers):
+        loci = seq.find(h)
+        if loci!=-1:
+            return (h, i, loci)
+    return None
+
+def random_sequences(count):
+    rand = random.Random(1)
+    sequences = ["", "A", "AATA", "AATAA", "AATAAA", "aataaa", "NATAAA", "AATAAAT"]
+    for _ in range(count):
+        # A/T rich sequences to have many PAS hexamers, some N and lower case nucleotides
+        seq = "".join(rand.choice("AAAATTTCGN") for _ in range(rand.randint(0, 60)))
+        if rand.random()<0.1:
+            seq = seq.lower()
+        sequences.append(seq)
+    return sequences
+
+def test_pas_scanner():
+    sequences = random_sequences(3000)
+    for strand in ["+", "-"]:
+        hexamers = apa.pas.pas_hexamers(strand)
+        for seq in sequences:
+            assert apa.pas.match_pas(seq, strand=strand)==baseline_match_pas(seq, hexamers)
+            for start, stop in [(0, None), (3, 30), (10, 12), (0, 200)]:
+                assert apa.pas.hits(seq, strand=strand, start=start, stop=stop)==baseline_hits(seq, hexamers, start, stop)
+        assert apa.pas.first_pas(sequences, strand=strand)==[baseline_first_pas(seq, hexamers) for seq in sequences]
@@ -0,0 +1,140 @@
+import os
+import types
+import random
+import pysam
+import pytest
+import pybio
+import apa
+
+def make_bam(filename, references, reads):
+    header = {"HD":{"VN":"1.0", "SO":"coordinate"}, "SQ":[{"SN":chr, "LN":100000} for chr in references]}
+    f = pysam.AlignmentFile(filename, "wb", header=header)
+    for i, (tid, pos, reverse) in enumerate(reads):
+        a = pysam.AlignedSegment()
+        a.query_name = "r%s" % i
+        a.query_sequence = "ACGT"*12 + "AC"
+        a.flag = 16 if reverse else 0
+        a.reference_id = tid
+        a.reference_start = pos
+        a.mapping_quality = 255
+        a.cigarstring = "50M"
+        f.write(a)
+    f.close()
+
+def test_bed_raw_tails_streamed(tmp_path, monkeypatch):
+    monkeypatch.setattr(apa.path, "data_folder", str(tmp_path))
+    lib = types.SimpleNamespace(experiments={1:{"method":"pAseq", "map_to":"test"}})
+    monkeypatch.setitem(apa.annotation.libs, "test", lib)
+    os.makedirs(os.path.dirname(apa.path.bam_filename("test", 1)))
+    references = ["2", "1"] # not in name order
+    reads = [(0, 100, False), (0, 100, False), (0, 500, True), (1, 200, False)]
+    make_bam(apa.path.bam_filename("test", 1), references, reads)
+    apa.bed.bed_raw("test", 1, ip_filter=False)
+    t_filename = apa.path.t_filename("test", 1)
+    # T files of bed_raw are streamed (in BAM reference order), not sorted in memory
+    assert apa.polya.tail_streamed(t_filename)
+    chr_rank = apa.polya.chromosome_order([("test", 1)])
+    sites = [(site[5], site[1], site[2], site[3]) for site in apa.polya.tail_sites(t_filename, chr_rank, presorted=True)]
+    assert sites==[("2", 0, 149, 2), ("2", 1, 500, 1), ("1", 0, 249, 1)]
+
+def test_merge_reference_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(apa.path, "data_folder", str(tmp_path))
+    lib = types.SimpleNamespace(experiments={1:{"method":"pAseq", "map_to":"test"}, 2:{"method":"pAseq", "map_to":"test"}})
+    monkeypatch.setitem(apa.annotation.libs, "test", lib)
+    reads = [(0, 100, False), (0, 500, True), (1, 200, False), (1, 300, False)]
+    for exp_id, references in [(1, ["2", "1"]), (2, ["1", "2"])]:
+        os.makedirs(os.path.dirname(apa.path.bam_filename("test", exp_id)))
+        make_bam(apa.path.bam_filename("test", exp_id), references, reads)
+        apa.bed.bed_raw("test", exp_id, ip_filter=False)
+    experiments = [("test", 1), ("test", 2)]
+    chr_rank = apa.polya.chromosome_order(experiments)
+    # experiment 2 has another reference order: streaming it fails with a clear error, the merge sorts it in memory
+    with pytest.raises(ValueError):
+        list(apa.polya.tail_sites(apa.path.t_filename("test", 2), chr_rank, presorted=True))
+    sites, batch_filenames = apa.polya.merge_experiments(experiments, str(tmp_path / "temp"))
+    sites = [(site[5], site[1], site[2], site[3], site[4]) for site in sites]
+    for batch_filename in batch_filenames:
+        os.remove(batch_filename)
+    assert sites==[(chr, strand, pos, 1, 1) for chr in "21" for strand, pos in [(0, 149), (0, 249), (0, 349), (1, 500)]]
+
+def test_save_parts_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(apa.path, "polya_folder", str(tmp_path))
+    os.makedirs(os.path.dirname(apa.path.polyadb_accumulator_filename("test")))
+    sites = [(rank, strand, 100, 1, 1, chr) for rank, chr in enumerate(["X", "10", "2"]) for strand in [1, 0]]
+    # parts are annotated and joined in natural chromosome order, + strand first
+    assert apa.polya.save_parts(sites, "test")==[["2", "+"], ["2", "-"], ["10", "+"], ["10", "-"], ["X", "+"], ["X", "-"]]
+
+genes = {"g1":{"gene_name":"G1", "gene_chr":"1", "gene_strand":"+", "gene_start":0, "gene_stop":2999, "gene_intervals":[[0, 1499, "o"], [1500, 2999, "3"]]},
+         "g2":{"gene_name":"G2", "gene_chr":"2", "gene_strand":"-", "gene_start":1000, "gene_stop":4999, "gene_intervals":[[1000, 2999, "3"], [3000, 4999, "i"]]}}
+
+def fake_genome(monkeypatch):
+    """
+    Genome test with two genes and a sequence made of the positions, in place of pybio.genomes.
+    """
+    def seq_direct(species, chr, strand, start, stop):
+        seq = "".join("ACGTTA"[(pos*pos+int(chr)) % 6] for pos in range(max(0, start), stop+1))
+        return seq if strand=="+" else seq[::-1].translate(str.maketrans("ACGT", "TGCA"))
+    def seq(species, chr, strand, pos, start=0, stop=0):
+        return seq_direct(species, chr, strand, pos+start, pos+stop) if strand=="+" else seq_direct(species, chr, strand, pos-stop, pos-start)
+    def annotate(species, chr, strand, pos, extension=0):
+        for gene_id, gene in genes.items():
+            for interval in gene["gene_intervals"]:
+                if (gene["gene_chr"], gene["gene_strand"])==(chr, strand) and interval[0]<=pos<=interval[1]:
+                    return None, gene_id, None, interval, None
+        return None, None, None, None, None
+    monkeypatch.setattr(pybio.genomes, "genomes_list", lambda: [], raising=False)
+    monkeypatch.setattr(pybio.genomes, "load", lambda species: None, raising=False)
+    monkeypatch.setattr(pybio.genomes, "genes", {"test":genes}, raising=False)
+    monkeypatch.setattr(pybio.genomes, "seq_direct", seq_direct, raising=False)
+    monkeypatch.setattr(pybio.genomes, "seq", seq, raising=False)
+    monkeypatch.setattr(pybio.genomes, "annotate", annotate, raising=False)
+    monkeypatch.setattr(apa.polya, "gene_intervals_db", {})
+    return annotate
+
+def atlas_files(poly_id):
+    result = []
+    for filetype in ["tab", "bed", "fasta"]:
+        f = open(apa.path.polyadb_filename(poly_id, filetype=filetype), "rb")
+        result.append(f.read())
+        f.close()
+    return result
+
+def test_update_rebuild(tmp_path, monkeypatch):
+    monkeypatch.setattr(apa.path, "data_folder", str(tmp_path / "data"))
+    monkeypatch.setattr(apa.path, "polya_folder", str(tmp_path / "polya"))
+    os.makedirs(apa.path.polya_folder)
+    fake_genome(monkeypatch)
+    lib = types.SimpleNamespace(experiments=dict((exp_id, {"method":"pAseq", "map_to":"test"}) for exp_id in [1, 2, 3]))
+    monkeypatch.setitem(apa.annotation.libs, "test", lib)
+    for exp_id in [1, 2, 3]:
+        rand = random.Random(exp_id)
+        reads = sorted((tid, rand.randrange(900, 5000, 61), rand.random()<0.5) for tid in [0, 1] for _ in range(600))
+        os.makedirs(os.path.dirname(apa.path.bam_filename("test", exp_id)))
+        make_bam(apa.path.bam_filename("test", exp_id), ["1", "2"], reads)
+        apa.bed.bed_raw("test", exp_id, ip_filter=False)
+
+    def configure(exp_ids):
+        f = open(os.path.join(apa.path.polya_folder, "test.config"), "wt")
+        f.write("".join("test_e%s\n" % exp_id for exp_id in exp_ids))
+        f.close()
+
+    configure([1, 2])
+    apa.polya.process("test", min_distance=50)
+    # update (add, remove, settings changed) gives the same atlas files as a rebuild
+    for exp_ids, min_distance in [([1, 2, 3], 50), ([2, 3], 50), ([2, 3], 75)]:
+        configure(exp_ids)
+        apa.polya.update("test", min_distance=min_distance)
+        updated = atlas_files("test")
+        apa.polya.process("test", min_distance=min_distance)
+        assert updated==atlas_files("test")
+        assert updated[2].count(b">")>20
+
+def test_site_genes(monkeypatch):
+    annotate = fake_genome(monkeypatch)
+    monkeypatch.setitem(genes, "g3", {"gene_name":"G3", "gene_chr":"1", "gene_strand":"+", "gene_start":2500, "gene_stop":3999, "gene_intervals":[[2500, 3999, "3"]]})
+    for chr, strand in [("1", "+"), ("1", "-"), ("2", "-"), ("3", "+")]:
+        positions = list(range(0, 6000, 7)) + [999, 1000, 1499, 1500, 2499, 2500, 2999, 3000, 3999, 4000, 4999, 5000]
+        for pos, gene in zip(positions, apa.polya.site_genes("test", chr, strand, positions)):
+            _, gene_id, _, interval, _ = annotate("test", chr, strand, pos)
+            # only positions in overlapping genes (g1 and g3) are left to pybio.genomes.annotate
+            assert gene==(None if (chr, strand)==("1", "+") and 2500<=pos<=2999 else (gene_id, interval))
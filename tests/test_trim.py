@@ -0,0 +1,51 @@
+import random
+import regex
+import apa
+
+def remove_tail_baseline(sequence, window=20, percentage=0.85):
+    """
+    Baseline apa.extract.remove_tail (string slicing at every position).
+    """
+    for i in range(10, len(sequence)):
+        tail = sequence[i:i+window]
+        if tail.startswith("AAAAAAAAAAAAAAA"):
+            return i
+        if not tail.startswith("A"*min(3, len(tail))):
+            continue
+        if tail.count("A")/float(len(tail))>=percentage:
+            return i
+    return len(sequence)
+
+def find_a_run_baseline(sequence):
+    """
+    Baseline lexfwd trimming (apa.map.preprocess_lexfwd): first AAA, then 7A with possible 2 mismatches.
+    """
+    match = regex.search(r"AAA(?:AAAAAAA){s<=2}", sequence)
+    return None if match==None else match.start(0)
+
+def random_reads(n, seed=1):
+    random.seed(seed)
+    reads = []
+    for _ in range(n):
+        length = random.randint(0, 80)
+        insert = "".join(random.choice("ACGTN") for _ in range(random.randint(0, length)))
+        tail = "".join("A" if random.random()<0.85 else random.choice("CGTN") for _ in range(length-len(insert)))
+        reads.append(insert+tail)
+    return reads
+
+# empty read, all A, N bases, tail at position 0 and at the start limit, runs crossing the end of the read
+edge_reads = ["", "A", "AAAAAAAAAA", "A"*80, "AAAAAAAAAAAAAAAACGT", "NNNNNNNNNNAAAAAAAAAA", "ACGTACGTAC" + "AANAAAAAAA", "CCCCCCCCCCCAAAAAAAA", "CCCCCCCCCC" + "AAA" + "CCCCCCCCCCC", "ACGTACGTACGAAAAAAAAAAAAAAAG", "AAANNAAAAA", "AAANNNAAAA", "GGGGGGGGGGGGAAAAAAACCA"]
+
+def test_remove_tails():
+    reads = edge_reads + random_reads(3000)
+    expected = [remove_tail_baseline(seq) for seq in reads]
+    assert apa.trim.remove_tails(reads).tolist()==expected
+    assert [apa.trim.remove_tail(seq) for seq in reads]==expected
+    assert apa.trim.remove_tails([]).tolist()==[]
+    assert apa.trim.remove_tail("A"*30)==10 and apa.trim.remove_tail("C"*10+"A"*20)==10
+
+def test_find_a_runs():
+    reads = edge_reads + random_reads(3000, seed=2)
+    assert apa.trim.find_a_runs(reads)==[find_a_run_baseline(seq) for seq in reads]
+    assert apa.trim.find_a_runs([])==[]
+    assert apa.trim.find_a_runs(["AAAAAAAAAA", "", "AAANNAAAAA", "AAAAAAAAA", "CAAAAAAAAAA"])==[0, None, 0, None, 1]
@@ -0,0 +1,108 @@
+"""
+Poly-A tail trimming kernels, shared by :mod:`apa.extract` and :mod:`apa.map`.
+
+Reads are processed in batches: sequences are packed into a padded matrix and running A counts (cumulative sums) and
+A-run lengths are computed for all offsets at once, so each rule is linear in the read length.
+"""
+
+import numpy as np
+
+A_code = ord("A")
+
+def a_matrix(sequences):
+    """
+    Returns (A, lengths): A[r, i] is True if sequences[r][i] is A (padding is not A), lengths of sequences.
+    """
+    lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+    width = int(lengths.max())+1 if len(sequences)>0 else 1 # +1: at least one non A column after each sequence
+    A = np.zeros((len(sequences), width), dtype=bool)
+    values = np.frombuffer("".join(sequences).encode("latin-1", "replace"), dtype=np.uint8)==A_code
+    rows = np.repeat(np.arange(len(sequences)), lengths)
+    columns = np.arange(len(values)) - np.repeat(np.cumsum(lengths)-lengths, lengths)
+    A[rows, columns] = values
+    return A, lengths
+
+def a_counts(A):
+    """
+    Cumulative A counts: C[r, i] = number of A in sequences[r][:i].
+    """
+    C = np.zeros((A.shape[0], A.shape[1]+1), dtype=np.int32)
+    np.cumsum(A, axis=1, out=C[:, 1:])
+    return C
+
+def a_runs(A):
+    """
+    Length of the run of A starting at each position.
+    """
+    positions = np.arange(A.shape[1])
+    next_other = np.where(A, A.shape[1], positions) # position of first non A at or after i
+    next_other = np.minimum.accumulate(next_other[:, ::-1], axis=1)[:, ::-1]
+    return next_other - positions
+
+def first_true(M, lengths):
+    """
+    First column where M is True per row, lengths where there is none.
+    """
+    found = M.any(axis=1)
+    return np.where(found, M.argmax(axis=1), lengths)
+
+def remove_tails(sequences, window=20, percentage=0.85, start=10):
+    """
+    Position of the poly-A tail in each sequence (length of sequence if there is no tail), searched from start on:
+    the first position i where 15 A start, or where at least 3 A start (fewer if the sequence ends) and the window
+    sequence[i:i+window] contains at least percentage of A.
+    """
+    if len(sequences)==0:
+        return np.zeros(0, dtype=np.int64)
+    A, lengths = a_matrix(sequences)
+    C = a_counts(A)
+    runs = a_runs(A)
+    positions = np.arange(A.shape[1])
+    stops = np.minimum(positions[None, :] + window, lengths[:, None])
+    tail_len = stops - positions[None, :]
+    valid = (positions[None, :]>=start) & (tail_len>0)
+    num_A = np.take_along_axis(C, np.maximum(stops, 0), axis=1) - C[:, :-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rich = (runs>=np.minimum(3, tail_len)) & (num_A/tail_len.astype(np.float64)>=percentage)
+    M = valid & ((runs>=15) | rich)
+    return first_true(M, lengths)
+
+def remove_tail(sequence, window=20, percentage=0.85, start=10):
+    """
+    :func:`remove_tails` for a single sequence; only positions where an A starts are checked.
+    """
+    i = sequence.find("A", start)
+    while i!=-1:
+        tail = sequence[i:i+window]
+        if tail.startswith("A"*min(3, len(tail))) and (tail.startswith("A"*15) or tail.count("A")/float(len(tail))>=percentage):
+            return i
+        i = sequence.find("A", i+1)
+    return len(sequence)
+
+def find_a_runs(sequences, exact=3, fuzzy=7, mismatches=2):
+    """
+    Start of the first A-run in each sequence, None if there is none: exact A followed by fuzzy nucleotides with at most
+    mismatches non A (same matches as regex AAA(?:AAAAAAA){s<=2} for the defaults).
+
+    The batch is one array (sequences separated by exact+fuzzy N, no padding matrix); the run condition is computed for
+    all positions with byte additions and the first run of each sequence is found with searchsorted.
+    """
+    if len(sequences)==0:
+        return []
+    size = exact + fuzzy
+    lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+    offsets = np.cumsum(lengths+size) - (lengths+size)
+    A = (np.frombuffer((("N"*size).join(sequences) + "N"*size).encode("latin-1", "replace"), dtype=np.uint8)==A_code).view(np.uint8)
+    n = len(A)-size+1 # run start positions
+    runs = A[:n].copy()
+    for k in range(1, exact):
+        runs &= A[k:k+n]
+    count = A[exact:exact+n].copy()
+    for k in range(exact+1, size):
+        count += A[k:k+n]
+    runs &= count>=fuzzy-mismatches
+    positions = np.flatnonzero(runs)
+    first = np.searchsorted(positions, offsets)
+    cuts = positions[np.minimum(first, max(0, len(positions)-1))] - offsets if len(positions)>0 else lengths
+    found = (first<len(positions)) & (cuts+size<=lengths) # runs crossing the end of the sequence are not valid
+    return [cut if ok else None for cut, ok in zip(cuts.tolist(), found.tolist())]